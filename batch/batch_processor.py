@@ -8,6 +8,11 @@ import time
 import numpy as np
 import lib.signal as signal
 import motor_control.stepper as stepper
+import motor_control.motion_model as motion_model
+from batch.plate_model import PlateModel
+import batch.path_planner as path_planner
+from motor_control.motion_program import MotionProgram
+import lib.snapshotWriter as snapshotWriter
 
 from PySide2.QtCore import Slot, QEventLoop, QTimer, QThread
 
@@ -31,6 +36,11 @@ class BatchProcessor():
     start_time = 0
     end_time = 0
     logging = True
+    plate_model = None ## PlateModel, predicts the well positions from the wells located so far
+    nominal_positions = None ## dict of the (x, y) position [mm] of each target well according to batch.ini
+    path_planning = path_planner.AUTO ## method to order the target wells, see path_planner.plan
+    visiting_order = None ## list of the target wells in the order they are visited in each run
+    stream_runs = True ## stream the wells that need no visual correction as one motion program, see stream_wells
 
     
     ## @brief BatchProcessor()::__init__ sets the batch settings
@@ -51,6 +61,8 @@ class BatchProcessor():
         self.batch_info = info
         self.duration = dur
         self.interleave = interl
+        self.plate_model = PlateModel()
+        self.nominal_positions = self.nominal_well_positions()
         self.path = os.path.sep.join([path, ID])
         if not os.path.exists(self.path):
             os.makedirs(self.path)
@@ -79,8 +91,18 @@ class BatchProcessor():
         self.batch_info = info
         self.duration = dur
         self.interleave = interl
+        self.plate_model.reset()
+        self.nominal_positions = self.nominal_well_positions()
         return
 
+    ## @brief BatchProcessor()::nominal_well_positions(self) are the positions of the target wells according to batch.ini, before any adaptation.
+    ## @return dict with the (x, y) position in mm of each target well ID.
+    def nominal_well_positions(self):
+        positions = {}
+        for target in self.Well_Targets:
+            positions[str(target[0][2])] = (float(self.Well_Map[1][target[0][0]][0]), float(self.Well_Map[target[0][1]][1][1]))
+        return positions
+
     ## @brief BatchProcessor()::startBatch(self) starts the batch process by setting the current (start)time and the endtime. 
     ## It disables the manual motor control and emits the batch_active signal
     ## @todo call updateBatchSettings function
@@ -89,6 +111,13 @@ class BatchProcessor():
         self.start_time = current_milli_time()
         self.end_time = current_milli_time() + (self.duration*1000)
         self.well_positioner.reset_current_well()
+        ## A new batch may run on another plate, the well positions located in the previous batch do not apply to it
+        self.plate_model.reset()
+        self.plan_visiting_order()
+        ## Remove the snapshots a crash left half-written, the journal of each well directory lists the complete ones
+        for directory, _, _ in os.walk(self.path):
+            for partial in snapshotWriter.recover(directory):
+                self.msg("Removed incomplete snapshot " + partial)
         self.signals.batch_active.emit()
         self.is_active = True
         self.msg("Batch process initialized and started with:\n\tDuration: " + str(self.duration) + "\n\tInterleave: " + str(self.interleave) + "\n\tStart_time: " + str(self.start_time) + "\n\tEnd_time: " + str(self.end_time))
@@ -96,8 +125,21 @@ class BatchProcessor():
         self.runBatch()
         return
 
+    ## @brief BatchProcessor()::plan_visiting_order(self) orders the target wells to minimise the travel time of a run, starting from home.
+    ## The order only depends on the nominal well positions, so it is the same in every run and the time between the snapshots of a well stays uniform.
+    def plan_visiting_order(self):
+        targets = list(self.Well_Targets)
+        positions = [self.nominal_positions[str(target[0][2])] for target in targets]
+        model = self.well_positioner.motion_model if self.well_positioner.motion_model is not None else motion_model.MotionModel.from_config()
+        order, travel_time = path_planner.plan(positions, (0.0, 0.0), method=self.path_planning, model=model)
+        _, ini_time = path_planner.plan(positions, (0.0, 0.0), method=path_planner.UNCHANGED, model=model)
+        self.visiting_order = [targets[i] for i in order]
+        self.msg("Visiting order (" + str(self.path_planning) + "): " + ", ".join(str(target[0][2]) for target in self.visiting_order))
+        self.msg("Estimated travel time per run: {:.1f}s, in batch.ini order: {:.1f}s".format(travel_time, ini_time))
+        return
+
     ## @brief BatchProcessor()::runBatch(self) runs the batch after it is started. 
-    ## @note the interleave is actually the interleave + processingtime of the "for target in self.Well_Targets:" loop
+    ## @note the interleave is actually the interleave + processingtime of the "for target in self.visiting_order:" loop
     def runBatch(self):
         if self.logging:
             recording_file_name = os.path.sep.join([self.path,'batch_positioning_results.csv'])
@@ -105,7 +147,7 @@ class BatchProcessor():
         
             # build csv file heading
             record_str = "run_start_time, run_time,"
-            for target in self.Well_Targets:
+            for target in self.visiting_order:
                 record_str += ',' + str(self.Well_Map[target[0][1]][1][1]) + ',' + str(self.Well_Map[1][target[0][0]][0])
             recording_file.write(record_str + "\n")
         else:
@@ -118,10 +160,29 @@ class BatchProcessor():
             run_start_time = current_milli_time()
             actual_postions = []
             
-            # Home first on avery run
-            self.well_positioner.stepper_control.homeXY()
-                
-            for target in self.Well_Targets:
+            # Home only if the homing policy no longer trusts the stage position
+            homing_policy = self.well_positioner.stepper_control.homing_policy
+            homed = homing_policy.should_home()
+            if homed:
+                self.msg("Homing: " + str(homing_policy.reason()))
+                self.well_positioner.stepper_control.homeXY()
+            else:
+                self.msg("Homing skipped, " + str(homing_policy))
+
+            ## The wells after the last one that needs visual correction are positioned by feedforward only and can be streamed
+            streamed_from = None
+            if self.stream_runs and not first_run:
+                streamed_from = 0 if homed else 1
+                for index, target in enumerate(self.visiting_order):
+                    if self.plate_model.is_outlier(str(target[0][2])):
+                        streamed_from = index + 1
+
+            for index, target in enumerate(self.visiting_order):
+                if index == streamed_from:
+                    if not self.stream_wells(self.visiting_order[index:], actual_postions):
+                        return
+                    break
+
                 if not self.is_active:
                     self.signals.batch_inactive.emit()
                     self.msg("Batch stopped.")
@@ -131,13 +192,36 @@ class BatchProcessor():
                 else:
                     row = target[0][0]
                     column = target[0][1]
-                    self.msg("Target: " + str(target[0][2]) )
+                    well_id = str(target[0][2])
+                    self.msg("Target: " + well_id)
 ##                    print("Target: at (" + str(self.Well_Map[column][1][1]) + ", " + str(self.Well_Map[1][row][0]) +")" + ", first run: " + str(first_run))
-                    if (self.well_positioner.goto_well(self.Well_Map[column][1][1], self.Well_Map[1][row][0], first_run)): ## if found well
-                        self.snapshot_request(str(self.batch_id) + "/" + str(target[0][2]))
+                    ## Feedforward position from the plate model once it is fitted, else the (adapted) position in the well map
+                    ## Without a plate model the positions of the first run are the nominal ones, their corrections are no drift
+                    measures_drift = self.plate_model.fitted() or not first_run
+                    if self.plate_model.fitted():
+                        x_pos, y_pos = (round(v, 2) for v in self.plate_model.predict(self.nominal_positions[well_id]))
+                    else:
+                        x_pos, y_pos = self.Well_Map[1][row][0], self.Well_Map[column][1][1]
+                    ## Visual correction in the first run, unless the plate model predicts the position within tolerance, and for wells that did not fit the plate
+                    adapt_to_well = (first_run and not self.plate_model.confident()) or self.plate_model.is_outlier(well_id)
+                    ## Without homing, the first well of the run is corrected visually to measure the drift
+                    adapt_to_well = adapt_to_well or (index == 0 and not homed)
+                    if (self.well_positioner.goto_well(y_pos, x_pos, adapt_to_well, well_id)): ## if found well
+                        self.snapshot_request(str(self.batch_id) + "/" + well_id)
                         (self.Well_Map[1][row][0], self.Well_Map[column][1][1]) = self.well_positioner.get_current_well()
                         print("  Target adapted to (" + str(self.Well_Map[column][1][1]) + ", " + str(self.Well_Map[1][row][0]) +")")
                         actual_postions.append(self.well_positioner.get_current_well())
+                        if adapt_to_well:
+                            self.plate_model.add(well_id, self.nominal_positions[well_id], self.well_positioner.get_current_well())
+                            self.msg(str(self.plate_model) + (", outliers: " + ", ".join(self.plate_model.outliers) if self.plate_model.outliers else ""))
+                            if measures_drift:
+                                column_pos, row_pos = self.well_positioner.get_current_well()
+                                homing_policy.record_residual((column_pos - float(x_pos), row_pos - float(y_pos)))
+                            ## Home before the next well if the drift or an error made the position unreliable
+                            if homing_policy.should_home():
+                                self.msg("Homing: " + str(homing_policy.reason()))
+                                self.well_positioner.stepper_control.homeXY()
+                                homed = True
                         
                     while self.SnapshotTaken is False:
                         if not self.is_active:
@@ -160,6 +244,8 @@ class BatchProcessor():
                     self.msg("Remaining time " + str(self.end_time-current_milli_time()))
                     print("Remaining time " + str(self.end_time-current_milli_time()) + " ms")
                     
+            homing_policy.run_completed()
+
             # first run is completed, remove this statemant to adapt to well-position in stead of feedforward
             if actual_postions:
                 first_run = False 
@@ -190,6 +276,51 @@ class BatchProcessor():
         print("Finishing batch process")
         return
 
+    ## @brief BatchProcessor()::stream_wells(self, targets, actual_postions) visits the target wells with one streamed motion program and takes a snapshot of each.
+    ## The wells are not corrected visually, their positions are predicted by the plate model or taken from the (adapted) well map.
+    ## Klipper plans the moves without waiting for the host between commands, the host only waits at the capture points.
+    ## @param targets are the target wells in visiting order.
+    ## @param actual_postions is the list the reached positions are appended to.
+    ## @return False if the batch stopped or completed during the program.
+    def stream_wells(self, targets, actual_postions):
+        wells = []
+        for target in targets:
+            well_id = str(target[0][2])
+            if self.plate_model.fitted():
+                x_pos, y_pos = (round(v, 2) for v in self.plate_model.predict(self.nominal_positions[well_id]))
+            else:
+                x_pos, y_pos = self.Well_Map[1][target[0][0]][0], self.Well_Map[target[0][1]][1][1]
+            wells.append((well_id, x_pos, y_pos))
+        program = MotionProgram.from_wells(wells, light=1.0)
+        self.msg("Streaming " + str(len(wells)) + " wells: " + ", ".join(well[0] for well in wells))
+        captured = []
+
+        ## Called while the stage holds at a well
+        def capture(well_id):
+            self.msg("Target: " + well_id)
+            self.snapshot_request(str(self.batch_id) + "/" + well_id)
+            actual_postions.append(self.well_positioner.get_current_well())
+            captured.append(well_id)
+            self.msg(well_id + " finished.")
+            if self.end_time < current_milli_time():
+                self.msg("batch completed")
+                print("batch completed")
+                self.stopBatch()
+                return False
+            return self.is_active
+
+        completed = self.well_positioner.run_program(program, capture)
+        if not self.is_active:
+            self.signals.batch_inactive.emit()
+            self.msg("Batch stopped.")
+            return False
+        if not completed:
+            ## The well positioner reported the failure, the wells that were not reached are skipped in this run
+            self.msg("Streamed run incomplete, " + str(len(wells) - len(captured)) + " wells skipped")
+        else:
+            self.msg("Remaining time " + str(self.end_time-current_milli_time()))
+        return True
+
     ## @brief BatchProcessor()::wait_ms(self, milliseconds) is a delay function.
     ## @param milliseconds is the number of milliseconds to wait.
     def wait_ms(self, milliseconds):
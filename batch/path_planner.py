@@ -0,0 +1,96 @@
+## @package path_planner.py
+## @brief path_planner.py orders the target wells of a batch run to minimise the travel time of the stage.
+
+import numpy as np
+import motor_control.motion_model as motion_model
+
+NEAREST = 'nearest'
+SERPENTINE = 'serpentine'
+AUTO = 'auto'
+UNCHANGED = 'unchanged'
+
+## @brief travel_times(points, model) is the matrix of move durations [s] between all points.
+## @param points is a list of (x, y) positions [mm].
+## @param model is the MotionModel of the stage.
+def travel_times(points, model):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    distances = np.hypot(*(points[:, None, :] - points[None, :, :]).transpose(2, 0, 1))
+    return np.vectorize(model.move_time, otypes=[np.float64])(distances)
+
+## @brief route_time(times, order) is the duration [s] of visiting the points in order, starting at point 0.
+def route_time(times, order):
+    route = [0] + list(order)
+    return float(sum(times[a, b] for a, b in zip(route[:-1], route[1:])))
+
+## @brief nearest_neighbour(times) visits the nearest unvisited point next, starting at point 0, ties go to the lowest index.
+## @return the order of points 1..n.
+def nearest_neighbour(times):
+    unvisited = list(range(1, len(times)))
+    order = []
+    current = 0
+    while unvisited:
+        current = min(unvisited, key=lambda i: times[current, i])
+        unvisited.remove(current)
+        order.append(current)
+    return order
+
+## @brief two_opt(times, order) reverses parts of the route while that shortens it, the route starts at point 0 and is open at the end.
+## @return the improved order.
+def two_opt(times, order):
+    route = [0] + list(order)
+    n = len(route)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n - 1):
+            for k in range(i + 1, n):
+                before = times[route[i - 1], route[i]] + (times[route[k], route[k + 1]] if k + 1 < n else 0.0)
+                after = times[route[i - 1], route[k]] + (times[route[i], route[k + 1]] if k + 1 < n else 0.0)
+                if after < before - 1e-9:
+                    route[i:k + 1] = reversed(route[i:k + 1])
+                    improved = True
+    return route[1:]
+
+## @brief serpentine(points) visits the points row by row, alternating the direction along the rows, starting at the row nearest to point 0.
+## @param points is a list of (x, y) positions [mm], point 0 is the start.
+## @param pitch is the distance [mm] within which positions are on the same row (default 1.0)
+## @return the order of points 1..n.
+def serpentine(points, pitch=1.0):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    indices = sorted(range(1, len(points)), key=lambda i: (points[i][1], points[i][0]))
+    rows = []
+    for i in indices:
+        if rows and abs(points[i][1] - points[rows[-1][0]][1]) < pitch:
+            rows[-1].append(i)
+        else:
+            rows.append([i])
+    if rows and abs(points[rows[-1][0]][1] - points[0][1]) < abs(points[rows[0][0]][1] - points[0][1]):
+        rows.reverse()
+    order = []
+    for r, row in enumerate(rows):
+        row = sorted(row, key=lambda i: points[i][0])
+        order.extend(row if r % 2 == 0 else reversed(row))
+    return order
+
+## @brief plan(positions, start, **kwargs) orders the wells to minimise the travel time, the same positions always give the same order.
+## @param positions is a list of (x, y) well positions [mm].
+## @param start is the (x, y) start position [mm], e.g. home.
+## @param method is NEAREST (nearest neighbour improved by 2-opt), SERPENTINE, UNCHANGED or AUTO, the fastest of nearest and serpentine (default AUTO)
+## @param model is the MotionModel used for the travel times (default from printer.cfg)
+## @return (order, time), the indices into positions in visiting order and the travel time [s].
+def plan(positions, start=(0.0, 0.0), **kwargs):
+    method = kwargs['method'] if 'method' in kwargs else AUTO
+    model = kwargs['model'] if 'model' in kwargs else motion_model.MotionModel.from_config()
+    points = [tuple(start)] + [tuple(p) for p in positions]
+    times = travel_times(points, model)
+    candidates = []
+    if method == UNCHANGED:
+        candidates.append(list(range(1, len(points))))
+    if method in (NEAREST, AUTO):
+        candidates.append(two_opt(times, nearest_neighbour(times)))
+    if method in (SERPENTINE, AUTO):
+        candidates.append(serpentine(points))
+    if not candidates:
+        raise ValueError("Unknown path planning method: " + str(method))
+    order = min(candidates, key=lambda o: route_time(times, o))
+    return [i - 1 for i in order], route_time(times, order)
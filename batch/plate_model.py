@@ -0,0 +1,134 @@
+## @package plate_model.py
+## @brief plate_model.py fits the transform from the nominal well positions of batch.ini to the stage positions where the wells were found,
+## to predict the positions of wells that were not visited yet and to flag wells whose position does not fit the plate.
+
+import numpy as np
+import cv2
+
+## @brief PlateModel fits an affine transform (or a homography) from nominal well coordinates [mm] to observed stage coordinates [mm].
+## The fit uses all wells positioned by the visual correction, wells that do not fit within the outlier distance are rejected one by one,
+## worst first, and flagged as outliers.
+class PlateModel():
+    AFFINE = 'affine'
+    HOMOGRAPHY = 'homography'
+
+    ## @brief PlateModel::__init__(self, **kwargs)
+    ## @param kind is the transform, PlateModel.AFFINE (default) or PlateModel.HOMOGRAPHY
+    ## @param tolerance is the predicted positioning error [mm] below which the visual correction can be skipped (default 0.2)
+    ## @param outlier is the distance [mm] from the fitted transform above which a well is an outlier (default 0.5)
+    ## @param min_wells is the minimum number of inlier wells before predictions are trusted (default 5)
+    ## @param min_spread is the minimum spread [mm] of the nominal positions in both directions, wells on a single row or column cannot determine a 2D transform (default 5.0)
+    def __init__(self, **kwargs):
+        self.kind = kwargs['kind'] if 'kind' in kwargs else PlateModel.AFFINE
+        self.tolerance = kwargs['tolerance'] if 'tolerance' in kwargs else 0.2
+        self.outlier = kwargs['outlier'] if 'outlier' in kwargs else 0.5
+        self.min_wells = kwargs['min_wells'] if 'min_wells' in kwargs else 5
+        self.min_spread = kwargs['min_spread'] if 'min_spread' in kwargs else 5.0
+        self.reset()
+
+    ## @brief PlateModel::reset(self) forgets all observations, e.g. when another plate is inserted.
+    def reset(self):
+        self.observations = {} ## well id: (nominal, observed)
+        self.transform = None ## 3x3 matrix, nominal to observed in homogeneous coordinates
+        self.residuals = {}
+        self.outliers = []
+        self.error = None
+        return
+
+    ## @brief PlateModel::add(self, well_id, nominal, observed) adds or replaces the observed position of a well and refits the model.
+    ## @param well_id identifies the well, e.g. A01
+    ## @param nominal is the (x, y) position [mm] from batch.ini
+    ## @param observed is the (x, y) stage position [mm] where the well was found
+    def add(self, well_id, nominal, observed):
+        self.observations[well_id] = (tuple(float(v) for v in nominal), tuple(float(v) for v in observed))
+        self.fit()
+        return
+
+    ## @brief PlateModel::fit(self) fits the transform to the observations.
+    ## @return True if the observations determine the transform.
+    def fit(self):
+        self.transform = None
+        self.residuals = {}
+        self.outliers = []
+        self.error = None
+        parameters = 6 if self.kind == PlateModel.AFFINE else 8
+        ids = list(self.observations)
+        nominal = np.array([self.observations[i][0] for i in ids], dtype=np.float64).reshape(-1, 2)
+        observed = np.array([self.observations[i][1] for i in ids], dtype=np.float64).reshape(-1, 2)
+        inliers = np.ones(len(ids), dtype=bool)
+        if not self.determined(nominal[inliers], parameters):
+            return False
+        while True:
+            transform = self.solve(nominal[inliers], observed[inliers])
+            if transform is None:
+                return False
+            distances = np.linalg.norm(self.apply(transform, nominal) - observed, axis=1)
+            ## Reject the worst well if it does not fit and the remaining wells still determine the transform
+            worst = np.argmax(np.where(inliers, distances, -1.0))
+            remaining = inliers.copy()
+            remaining[worst] = False
+            if distances[worst] <= self.outlier or np.count_nonzero(remaining) < self.min_wells or not self.determined(nominal[remaining], parameters):
+                break
+            inliers = remaining
+        self.transform = transform
+        self.residuals = dict(zip(ids, distances.tolist()))
+        self.outliers = [i for i, inlier in zip(ids, inliers) if not inlier]
+        ## Expected prediction error, the residual sum of squares corrected for the fitted parameters
+        squares = np.sum(distances[inliers] ** 2)
+        freedom = 2 * np.count_nonzero(inliers) - parameters
+        self.error = float(np.sqrt(2 * squares / freedom)) if freedom > 0 else float('inf')
+        return True
+
+    ## @brief PlateModel::solve(self, nominal, observed) is the least squares transform, or None if it is degenerate.
+    def solve(self, nominal, observed):
+        if self.kind == PlateModel.HOMOGRAPHY:
+            transform, _ = cv2.findHomography(nominal, observed, 0)
+            return transform
+        A = np.hstack([nominal, np.ones((len(nominal), 1))])
+        solution, _, rank, _ = np.linalg.lstsq(A, observed, rcond=None)
+        if rank < 3:
+            return None
+        return np.vstack([solution.T, [0.0, 0.0, 1.0]])
+
+    ## @brief PlateModel::determined(self, nominal, parameters) is True if the nominal positions are enough and spread enough to fit the parameters.
+    def determined(self, nominal, parameters):
+        return 2 * len(nominal) > parameters and self.spread(nominal) >= self.min_spread
+
+    ## @brief PlateModel::spread(points) is the smallest standard deviation of the points along any direction [mm].
+    @staticmethod
+    def spread(points):
+        if len(points) < 3:
+            return 0.0
+        return float(np.linalg.svd(points - points.mean(axis=0), compute_uv=False)[-1] / np.sqrt(len(points)))
+
+    ## @brief PlateModel::apply(transform, points) transforms an array of (x, y) points.
+    @staticmethod
+    def apply(transform, points):
+        points = np.hstack([np.asarray(points, dtype=np.float64).reshape(-1, 2), np.ones((len(points), 1))]) @ transform.T
+        return points[:, :2] / points[:, 2:]
+
+    ## @brief PlateModel::fitted(self) is True if the model can predict positions.
+    def fitted(self):
+        return self.transform is not None
+
+    ## @brief PlateModel::confident(self) is True if the predicted positions are expected to be within tolerance, so the visual correction can be skipped.
+    def confident(self):
+        return self.fitted() and len(self.observations) - len(self.outliers) >= self.min_wells and self.error < self.tolerance
+
+    ## @brief PlateModel::predict(self, nominal) is the expected stage position of a well.
+    ## @param nominal is the (x, y) position [mm] from batch.ini
+    ## @return (x, y) stage position [mm], the nominal position if the model is not fitted.
+    def predict(self, nominal):
+        if self.transform is None:
+            return tuple(float(v) for v in nominal)
+        x, y = self.apply(self.transform, [nominal])[0]
+        return (float(x), float(y))
+
+    ## @brief PlateModel::is_outlier(self, well_id) is True if the last observed position of the well does not fit the plate.
+    def is_outlier(self, well_id):
+        return well_id in self.outliers
+
+    def __repr__(self):
+        if self.transform is None:
+            return "PlateModel({}, {} wells, not fitted)".format(self.kind, len(self.observations))
+        return "PlateModel({}, {} wells, {} outliers, error {:.2f}mm)".format(self.kind, len(self.observations), len(self.outliers), self.error)
@@ -0,0 +1,3 @@
+"""@package docstring
+Offline benchmarks of the image processing stages, see benchmark/run.py.
+"""
@@ -0,0 +1,116 @@
+"""@package docstring
+Offline benchmark of the stage motion against the klipper simulator, no PrintHAT needed.
+
+Starts a KlipperSimulator on a pseudo terminal, connects the StepperControl to it and visits a
+grid of wells: one G0 + M400 round trip per well with StepperControl.move, the same wells as one
+streamed MotionProgram, and the streamed program through StepperWellPositioning.run_program,
+which adds the settling time at each well. Each scenario runs in batch.ini order and in the order
+of the path planner. Reports the wall time per run, the simulated motion time and the host
+overhead (wall time minus scaled motion time) as JSON.
+
+Usage, from the repository root:
+    QT_QPA_PLATFORM=offscreen python3 -m benchmark.motion --time-scale 0.1 --output motion.json
+"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+import sys
+import time
+
+## StepperControl connects to the GcodeSerial when it is imported, the klipper service must be skipped before that
+os.environ['KLIPPER_SERVICE'] = 'off'
+
+from PySide2.QtCore import QCoreApplication
+from motor_control.klipper_sim import KlipperSimulator
+from motor_control.motion_model import MotionModel
+from motor_control.motion_program import MotionProgram, ProgramStreamer
+import motor_control.stepper as stepper
+import batch.path_planner as path_planner
+from benchmark.run import metadata
+
+## @brief gridWells(rows, columns, pitch, origin) are the (name, x, y) of the wells of a plate, in row by row order like batch.ini lists them.
+def gridWells(rows, columns, pitch, origin):
+    return [(chr(ord('A') + row) + str(column + 1), origin[0] + column * pitch, origin[1] + row * pitch)
+            for row in range(rows) for column in range(columns)]
+
+## @brief perMove(steppers, wells, simulator) visits each well with a G0 and waits for its M400.
+def perMove(steppers, wells, simulator):
+    for name, x, y in wells:
+        steppers.move(x, y)
+
+## @brief streamed(steppers, wells, simulator) visits the wells with a streamed program, the host only waits for the sync markers.
+def streamed(steppers, wells, simulator):
+    streamer = ProgramStreamer(steppers.PrintHAT_serial, MotionProgram.from_wells(wells))
+    while streamer.remaining() > 0:
+        streamer.release()
+        streamer.wait()
+
+## @brief positioner(steppers, wells, simulator) visits the wells with StepperWellPositioning.run_program, waiting the modelled settling time at each well.
+def positioner(steppers, wells, simulator):
+    wellPositioning = stepper.StepperWellPositioning(steppers, None, None)
+    wellPositioning.settle_detector = None
+    wellPositioning.motion_model.settle *= simulator.time_scale
+    wellPositioning.run_program(MotionProgram.from_wells(wells))
+
+SCENARIOS = {'per-move': perMove, 'streamed': streamed, 'positioner': positioner}
+
+## @brief benchmarkScenario(function, steppers, wells, simulator, runs) homes the stage and times runs over the wells.
+## @return dict with the wall time, simulated motion time and host overhead per run [s].
+def benchmarkScenario(function, steppers, wells, simulator, runs):
+    steppers.homeXY()
+    walls = []
+    motion = []
+    for run in range(runs):
+        steppers.move(0.0, 0.0)
+        before = simulator.statistics()['motion_time']
+        t = time.perf_counter()
+        function(steppers, wells, simulator)
+        walls.append(time.perf_counter() - t)
+        motion.append(simulator.statistics()['motion_time'] - before)
+    wall = sum(walls) / runs
+    motionTime = sum(motion) / runs
+    return {'wall': wall, 'motion': motionTime, 'overhead': wall - motionTime * simulator.time_scale,
+            'wells': len(wells), 'runs': runs}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmark of the stage motion against the klipper simulator.')
+    parser.add_argument('--rows', type=int, default=4, help='rows of wells')
+    parser.add_argument('--columns', type=int, default=6, help='columns of wells')
+    parser.add_argument('--pitch', type=float, default=9.0, help='well pitch [mm]')
+    parser.add_argument('--runs', type=int, default=2, help='runs per scenario')
+    parser.add_argument('--time-scale', type=float, default=0.1, help='multiplies the simulated durations')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated scenarios')
+    parser.add_argument('--output', help='write the JSON results to this file, default stdout')
+    args = parser.parse_args(argv)
+
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv)
+    simulator = KlipperSimulator(time_scale=args.time_scale)
+    steppers = stepper.StepperControl()
+    steppers.PrintHAT_serial.connect(simulator.start())
+
+    wells = gridWells(args.rows, args.columns, args.pitch, (10.0, 10.0))
+    model = MotionModel.from_config()
+    orders = {}
+    for method in (path_planner.UNCHANGED, path_planner.AUTO):
+        order, travelTime = path_planner.plan([(x, y) for name, x, y in wells], (0.0, 0.0), method=method, model=model)
+        orders[str(method)] = [wells[i] for i in order]
+
+    results = {'meta': metadata(argparse.Namespace(seed=None, frames=None)), 'simulator': {'timeScale': args.time_scale, 'model': repr(simulator.model)}, 'results': {}}
+    for scenario in args.scenarios.split(','):
+        for method, ordered in orders.items():
+            results['results'][scenario + '/' + method] = benchmarkScenario(SCENARIOS[scenario], steppers, ordered, simulator, args.runs)
+    steppers.PrintHAT_serial.disconnect()
+    simulator.stop()
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
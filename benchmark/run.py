@@ -0,0 +1,196 @@
+"""@package docstring
+Offline benchmark of the lib image processing stages on synthetic plates, no camera needed.
+
+Runs the resize, enhancer, segmenter (full detection and tracking), blob detector and well
+position evaluator (full and coarse-to-fine) stages, the full ImageProcessor in worker and pipeline mode, and the
+preview-only worker the GUI runs, at each frame size. Reports throughput, latency percentiles and peak memory as JSON, and optionally
+compares against the JSON of an earlier commit.
+
+Usage, from the repository root:
+    python3 -m benchmark.run --output bench.json
+    python3 -m benchmark.run --sizes 640x480 --frames 50 --compare bench.json
+"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import numpy as np
+import cv2
+import lib.latency as latency
+from lib.imageEnhancer import ImageEnhancer
+from lib.imageSegmenter import ImageSegmenter
+from lib.BlobDetector import BlobDetector
+from lib.imagePyramid import ImagePyramid
+from lib.imageProcessor import ImageProcessor, WellPositionEvaluator
+from lib.frameQueue import FrameQueue
+from benchmark.synthetic import SIZES, renderPlate, renderWell
+
+## @brief timeStage(function, inputs, warmup) calls function on each input and records the latencies.
+## @return dict with throughput [1/s], latency count, max, mean, p50, p95, p99 [ms] and peak traced memory [MB].
+def timeStage(function, inputs, warmup=2):
+    for i in range(min(warmup, len(inputs))):
+        function(inputs[i])
+    histogram = latency.LatencyHistogram('stage')
+    startTime = time.perf_counter_ns()
+    for item in inputs:
+        t = time.perf_counter_ns()
+        function(item)
+        histogram.record(time.perf_counter_ns() - t)
+    elapsed = time.perf_counter_ns() - startTime
+    result = latency.summarise(histogram.counts, histogram.count, histogram.total, histogram.max)
+    result['throughput'] = len(inputs) / (elapsed / 1e9)
+    result['peakMemory'] = peakMemory(function, inputs[0])
+    return result
+
+## @brief peakMemory(function, item) is the peak memory [MB] traced by tracemalloc during one call, this includes numpy buffers but not OpenCV internals.
+def peakMemory(function, item):
+    tracemalloc.start()
+    try:
+        function(item)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 2**20
+
+## @brief benchmarkStages(size, frames, seed) runs each stage separately on synthetic frames of the given size.
+def benchmarkStages(size, frames, seed):
+    plates = [renderPlate(size, seed + i, offset=(i % 5, i % 3))[0] for i in range(frames)]
+    wells = [renderWell(size, seed + i, offset=(8 * (i % 5) - 16, 6 * (i % 3) - 6)) for i in range(frames)]
+    results = {}
+
+    results['resize'] = timeStage(lambda image: ImagePyramid(image).resized((640, 480)), plates)
+
+    enhancer = ImageEnhancer(clahe=2.0, gamma=1.5)
+    results['enhance'] = timeStage(lambda image: enhancer.start(image), plates)
+    enhanced = [enhancer.start(image).copy() for image in plates]
+
+    segmenter = ImageSegmenter()
+    results['segment'] = timeStage(lambda image: segmenter.start(image.copy()), enhanced)
+    tracker = ImageSegmenter(tracking=True)
+    results['segment-tracking'] = timeStage(lambda image: tracker.start(image.copy()), enhanced)
+
+    ROIs = []
+    for image in enhanced:
+        segmenter.start(image.copy())
+        ROIs.append(segmenter.ROIs if segmenter.ROIs is not None else [])
+    detector = BlobDetector()
+    results['detect'] = timeStage(lambda item: detector.start(*item), list(zip(enhanced, ROIs)))
+    results['detect']['blobs'] = int(detector.blobs.size)
+
+    target = (size[0] // 2, size[1] // 2)
+    for name, coarseToFine in [('wellPosition', False), ('wellPosition-coarse', True)]:
+        ## (width, height) like StepperWellPositioning, the radii as narrowed after the light source was found
+        evaluator = WellPositionEvaluator(size, coarseToFine=coarseToFine)
+        evaluator.circle_maxRadius = int(0.45 * size[1])
+        evaluator.circle_minRadius = int(0.35 * size[1])
+        results[name] = timeStage(lambda item: evaluator.evaluate(item[0], target), wells)
+        errors = [evaluator.evaluate(image, target) for image, truth in wells]
+        found = [(e, w[1]['centre']) for e, w in zip(errors, wells) if len(e) == 3]
+        results[name]['found'] = len(found)
+        results[name]['maxError'] = max([float(np.hypot(*(np.add(e[0], target) - c))) for e, c in found], default=None)
+    return results
+
+## @brief benchmarkProcessor(size, frames, seed, **kwargs) measures the throughput of ImageProcessor on a burst of frames.
+## kwargs are passed to ImageProcessor, frames are queued with the block policy so none are dropped.
+def benchmarkProcessor(size, frames, seed, **kwargs):
+    plates = [renderPlate(size, seed + i, offset=(i % 5, i % 3))[0] for i in range(frames)]
+    processor = ImageProcessor(policy=FrameQueue.BLOCK, maxQueue=4, **kwargs)
+    processor.setDetector(True)
+    done = threading.Semaphore(0)
+    processor.signals.finished.connect(done.release)
+    worker = threading.Thread(target=processor.run, daemon=True)
+    worker.start()
+    latency.registry.reset()
+    startTime = time.perf_counter_ns()
+    for image in plates:
+        processor.update(ImagePyramid(image))
+    for image in plates:
+        done.acquire()
+    elapsed = time.perf_counter_ns() - startTime
+    stats = processor.statistics()
+    if processor.pipeline is not None:
+        processor.pipeline.close()
+    else:
+        processor.queue.close()
+    worker.join()
+    return {'throughput': frames / (elapsed / 1e9), 'frames': frames,
+            'stages': latency.snapshot(), 'queue': stats}
+
+def metadata(args):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'seed': args.seed, 'frames': args.frames,
+            'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+            'machine': platform.machine(), 'cpus': os.cpu_count()}
+
+## @brief compare(results, baseline, tolerance) lists the stages whose p50 latency grew, or throughput dropped, by more than tolerance.
+def compare(results, baseline, tolerance):
+    regressions = []
+    for size, stages in results['results'].items():
+        for stage, current in stages.items():
+            previous = baseline.get('results', {}).get(size, {}).get(stage)
+            if previous is None:
+                continue
+            if 'p50' in current and previous.get('p50'):
+                ratio = current['p50'] / previous['p50']
+                print('{:>10} {:<18} p50 {:8.2f} ms  was {:8.2f} ms  x{:.2f}'.format(size, stage, current['p50'], previous['p50'], ratio), file=sys.stderr)
+                if ratio > 1 + tolerance:
+                    regressions.append((size, stage, 'p50', ratio))
+            elif previous.get('throughput'):
+                ratio = current['throughput'] / previous['throughput']
+                print('{:>10} {:<18} {:8.2f} fps  was {:8.2f} fps  x{:.2f}'.format(size, stage, current['throughput'], previous['throughput'], ratio), file=sys.stderr)
+                if ratio < 1 - tolerance:
+                    regressions.append((size, stage, 'throughput', ratio))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmark of the image processing stages on synthetic plates.')
+    parser.add_argument('--sizes', default=','.join('{}x{}'.format(*size) for size in SIZES),
+                        help='comma separated frame sizes, WIDTHxHEIGHT')
+    parser.add_argument('--frames', type=int, default=20, help='frames per stage and size')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the synthetic plates')
+    parser.add_argument('--stages-only', action='store_true', help='skip the full ImageProcessor runs')
+    parser.add_argument('--output', help='write the JSON results to this file, default stdout')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown when comparing')
+    args = parser.parse_args(argv)
+
+    results = {'meta': metadata(args), 'results': {}}
+    for text in args.sizes.split(','):
+        size = tuple(int(v) for v in text.lower().split('x'))
+        stages = benchmarkStages(size, args.frames, args.seed)
+        if not args.stages_only:
+            stages['processor'] = benchmarkProcessor(size, args.frames, args.seed, detection=True)
+            stages['processor-pipeline'] = benchmarkProcessor(size, args.frames, args.seed, pipeline=True)
+            stages['preview-resize'] = benchmarkProcessor(size, args.frames, args.seed)
+        results['results'][text] = stages
+    results['meta']['maxRSS'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # [MB], Linux reports kB
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for size, stage, metric, ratio in regressions:
+            print('Regression: {} {} {} x{:.2f}'.format(size, stage, metric, ratio), file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""@package docstring
+Seeded synthetic well plate images for the offline benchmarks.
+
+renderPlate draws the view of the reader camera on a plate: a vignetted bright background
+with dark grid lines between the wells, a well bottom disc in each cell, dark colonies (blobs)
+inside the wells and sensor noise. renderWell draws a single well under the light source, as
+seen by the WellPositionEvaluator. The same seed and size always give the same image and truth.
+"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import numpy as np
+import cv2
+
+## @brief SIZES are the benchmarked frame sizes (width, height): preview, full HD, and the full camera resolution.
+SIZES = [(640, 480), (1920, 1080), (3200, 2400)]
+
+## @brief renderPlate(size, seed, **kwargs) renders a plate image with grid lines, wells, blobs, noise and vignetting.
+## @param size is the (width, height) of the image.
+## @param seed is the random seed.
+## @param pitch is the grid pitch as a fraction of the image height (default 0.3)
+## @param lineWidth is the grid line width as a fraction of the image height (default 0.02)
+## @param blobs is the number of blobs per well (default 8)
+## @param noise is the standard deviation of the sensor noise [grey levels] (default 4)
+## @param vignetting is the relative intensity drop in the corners (default 0.3)
+## @param offset is the (x, y) shift of the plate [px] (default (0, 0))
+## @return (image, truth), with truth a dict of the grid line positions, well centres and radius, and blob boxes.
+def renderPlate(size, seed=0, **kwargs):
+    pitchFrac = kwargs['pitch'] if 'pitch' in kwargs else 0.3
+    lineFrac = kwargs['lineWidth'] if 'lineWidth' in kwargs else 0.02
+    blobsPerWell = kwargs['blobs'] if 'blobs' in kwargs else 8
+    noise = kwargs['noise'] if 'noise' in kwargs else 4
+    vignetting = kwargs['vignetting'] if 'vignetting' in kwargs else 0.3
+    offset = kwargs['offset'] if 'offset' in kwargs else (0, 0)
+
+    rng = np.random.default_rng(seed)
+    width, height = size
+    pitch = max(8, int(pitchFrac * height))
+    lineWidth = max(2, int(lineFrac * height))
+
+    image = np.full((height, width), 170, dtype=np.float32)
+
+    # Grid lines, starting half a pitch in
+    cols = np.arange(pitch // 2 + int(offset[0]), width - lineWidth, pitch)
+    rows = np.arange(pitch // 2 + int(offset[1]), height - lineWidth, pitch)
+    cols, rows = cols[cols >= 0], rows[rows >= 0]
+    for x in cols:
+        image[:, x:x + lineWidth] -= 80
+    for y in rows:
+        image[y:y + lineWidth, :] -= 80
+
+    # Well bottoms and colonies, in every complete cell
+    radius = int(0.35 * (pitch - lineWidth))
+    wells, blobs = [], []
+    for y0, y1 in zip(rows[:-1] + lineWidth, rows[1:]):
+        for x0, x1 in zip(cols[:-1] + lineWidth, cols[1:]):
+            centre = ((x0 + x1) // 2, (y0 + y1) // 2)
+            cv2.circle(image, centre, radius, 190, -1)
+            wells.append(centre)
+            for i in range(blobsPerWell):
+                r = rng.uniform(0, 0.8 * radius)
+                phi = rng.uniform(0, 2 * np.pi)
+                axes = (int(rng.integers(2, max(3, pitch // 40) + 2)), int(rng.integers(2, max(3, pitch // 40) + 2)))
+                x, y = int(centre[0] + r * np.cos(phi)), int(centre[1] + r * np.sin(phi))
+                cv2.ellipse(image, (x, y), axes, float(rng.uniform(0, 180)), 0, 360, float(rng.uniform(60, 120)), -1)
+                blobs.append((x - axes[0], y - axes[1], 2 * axes[0] + 1, 2 * axes[1] + 1))
+
+    applyVignetting(image, vignetting)
+    image += rng.normal(0, noise, image.shape).astype(np.float32)
+    truth = {'cols': cols.tolist(), 'rows': rows.tolist(), 'lineWidth': lineWidth,
+             'wells': wells, 'radius': radius, 'blobs': blobs}
+    return np.clip(image, 0, 255).astype(np.uint8), truth
+
+## @brief renderWell(size, seed, **kwargs) renders a single well bottom lit by the light source.
+## @param size is the (width, height) of the image.
+## @param seed is the random seed.
+## @param offset is the (x, y) position of the well centre relative to the image centre [px] (default (0, 0))
+## @param radius is the well radius as a fraction of the image height (default 0.4)
+## @param noise is the standard deviation of the sensor noise [grey levels] (default 4)
+## @return (image, truth), with truth a dict of the well centre and radius.
+def renderWell(size, seed=0, **kwargs):
+    offset = kwargs['offset'] if 'offset' in kwargs else (0, 0)
+    radiusFrac = kwargs['radius'] if 'radius' in kwargs else 0.4
+    noise = kwargs['noise'] if 'noise' in kwargs else 4
+
+    rng = np.random.default_rng(seed)
+    width, height = size
+    radius = int(radiusFrac * height)
+    centre = (width // 2 + int(offset[0]), height // 2 + int(offset[1]))
+    image = np.full((height, width), 40, dtype=np.float32)
+    cv2.circle(image, centre, radius, 200, -1)
+    cv2.circle(image, centre, radius, 120, max(1, height // 200))
+    # some colonies in the well
+    for i in range(20):
+        r, phi = rng.uniform(0, 0.8 * radius), rng.uniform(0, 2 * np.pi)
+        cv2.circle(image, (int(centre[0] + r * np.cos(phi)), int(centre[1] + r * np.sin(phi))),
+                   int(rng.integers(2, max(3, height // 100) + 2)), 120, -1)
+    applyVignetting(image, 0.2)
+    image += rng.normal(0, noise, image.shape).astype(np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8), {'centre': centre, 'radius': radius}
+
+def applyVignetting(image, strength):
+    """Darken the image towards the corners, in place."""
+    height, width = image.shape
+    x = (np.arange(width, dtype=np.float32) - width / 2) / (width / 2)
+    y = (np.arange(height, dtype=np.float32) - height / 2) / (height / 2)
+    image *= 1 - strength * 0.5 * (y[:, None] ** 2 + x[None, :] ** 2)
+    return image
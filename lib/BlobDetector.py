@@ -13,9 +13,19 @@ from PySide2.QtCore import *
 import cv2
 import inspect
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from lib.manipulator import Manipulator
 import matplotlib.pyplot as plt
 
+## Blob feature record, one per detected blob in the frame.
+## Coordinates are in frame pixels, roi is the index of the ROI the blob was found in.
+BLOB_DTYPE = np.dtype([('roi', np.uint16),
+                       ('left', np.int32), ('top', np.int32), ('width', np.int32), ('height', np.int32),
+                       ('area', np.int32),
+                       ('sharpness', np.float32),
+                       ('peak', np.float32), ('background', np.float32),
+                       ('snr', np.float32)])
+
 class BlobDetector(Manipulator):
     """Object detector
         detects blobs
@@ -44,17 +54,22 @@ class BlobDetector(Manipulator):
         # Plotting
         self.plot = kwargs['plot'] if 'plot' in kwargs else False
 
+        # Number of threads the ROIs are spread over, 1 runs them serially
+        self.pool = None
+        self.setThreads(kwargs['threads'] if 'threads' in kwargs else 1)
+
         if self.plot:
             cv2.namedWindow(self.name)
             plt.show(block=False)
 
-        """TODO: Add var rects -> detected blobs/rectangles"""
-        self.blobs = list
+        # Detected blobs of the last frame, structured array of BLOB_DTYPE
+        self.blobs = np.zeros(0, dtype=BLOB_DTYPE)
 
         
     def __del__(self):
         """The deconstructor."""
-        None    
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
 
 
     def start(self, Image, ROIs):
@@ -63,8 +78,8 @@ class BlobDetector(Manipulator):
         \param image (the enhanced and segmented image)
         \return image (the annotated image )
 
-         local variable is the list of detected blobs with the following feature columns:
-         [bb_left,bb_top,bb_width,bb_height, cc_area, sharpness, SNR]
+         self.blobs is the structured array (BLOB_DTYPE) of blobs detected in all ROIs, with fields:
+         roi, left, top, width, height, area, sharpness, peak, background, snr
 
          Sharpness is variation of the Laplacian (introduced by Pech-Pacheco
          "Diatom autofocusing in brightfield microscopy: a comparative study."
@@ -75,62 +90,22 @@ class BlobDetector(Manipulator):
             self.image = Image
             self.ROIs = ROIs
 
-            # Iterate ROis
-            for ROI in ROIs:
-                # slice image, assuming ROI:(left,top,width,height)
-                ROI_image = self.image[ROI[1]:ROI[1]+ROI[3],ROI[0]:ROI[0]+ROI[2]]
-
-                # Binarize and find blobs
-                BWImage = cv2.adaptiveThreshold(ROI_image, 255,
-                                                cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                                self.invBin,
-                                                self.blocksize,
-                                                self.offset)
-
-                # ConnectedComponentsWithStats output: number of labels, label matrix, stats(left,top,width,height), area
-                blobFeatures = cv2.connectedComponentsWithStats(BWImage, 8, cv2.CV_32S)
-                
-                # Get blob RoI and area
-                blobFeatures = blobFeatures[2][1:]  # skipping background (label 0)
-                
-                # Filter by blob area
-                self.blobs = blobFeatures[
-                    np.where( (blobFeatures[:, cv2.CC_STAT_AREA] > self.minBlobArea) &
-                              (blobFeatures[:, cv2.CC_STAT_AREA] < self.maxBlobArea) ) ]
-
-                # Increase array size
-                self.blobs = np.concatenate([self.blobs,
-                                             np.zeros((self.blobs.shape[0],2), dtype=int)],
-                                            axis=1)
-
-                # Annotate blobs and compute additional features
-                for blob in self.blobs:
-                    tl = (blob[0], blob[1])
-                    br = (blob[0] + blob[2], blob[1] + blob[3])
-                    
-                    # Compute some metrics of individual blobs
-                    tempImage = self.image[tl[1]:br[1], tl[0]:br[0]]
-                    I_0 = 255.0 - np.min(tempImage) # peak foreground intensity estimate
-                    I_b = 255.0 - np.max(tempImage) # background intensity
-
-                    # Add local sharpness column
-                    blob[5] = int(cv2.Laplacian(tempImage, cv2.CV_64F).var())
-
-                    # Add local SNR column
-                    blob[6] = int((I_0-I_b)/np.sqrt(I_b)) if I_b>0 else 0
+            # Iterate ROis, the features of all blobs in a ROI are computed at once.
+            # ROIs are independent tiles, the pool returns them in ROI order
+            if self.pool is not None and len(ROIs) > 1:
+                results = list(self.pool.map(self.detectROI, ROIs))
+            else:
+                results = [self.detectROI(ROI) for ROI in ROIs]
+            blobs = []
+            for index, (BWImage, ROI_blobs) in enumerate(results):
+                ROI_blobs['roi'] = index
+                blobs.append(ROI_blobs)
 
-                    # Shift coordinates wrt ROI
-                    blob[0] += ROI[0]
-                    blob[1] += ROI[1]
-                    
-                    # Mark in image
-                    if self.plot:
-                        None
-                        #cv2.rectangle(ROI_image, tl, br, (0, 0, 0), 1)
-                        #cv2.putText(ROI_image, str(blob[5]), br, cv2.FONT_HERSHEY_SIMPLEX, .5, (0,0,0), 1, cv2.LINE_AA)
+            # Concatenate the blobs of the whole frame
+            self.blobs = np.concatenate(blobs) if blobs else np.zeros(0, dtype=BLOB_DTYPE)
 
             # Plot last ROI
-            if self.plot:
+            if self.plot and len(ROIs) > 0:
                 cv2.imshow(self.name, BWImage)    
                     
             # Finalize
@@ -144,6 +119,35 @@ class BlobDetector(Manipulator):
 
         return self.image
 
+    def detectROI(self, ROI):
+        """Binarize a ROI, label its blobs and compute their features.
+
+        \param ROI (left,top,width,height)
+        \return (binary image, blobs), blobs as structured array of BLOB_DTYPE in frame coordinates
+        """
+        # slice image, assuming ROI:(left,top,width,height)
+        ROI_image = self.image[ROI[1]:ROI[1]+ROI[3],ROI[0]:ROI[0]+ROI[2]]
+
+        # Binarize and find blobs
+        BWImage = cv2.adaptiveThreshold(ROI_image, 255,
+                                        cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                        self.invBin,
+                                        self.blocksize,
+                                        self.offset)
+
+        # ConnectedComponentsWithStats output: number of labels, label matrix, stats(left,top,width,height,area), centroids
+        _, labels, stats, _ = cv2.connectedComponentsWithStats(BWImage, 8, cv2.CV_32S)
+
+        # Filter by blob area, skipping background (label 0)
+        keep = (stats[:, cv2.CC_STAT_AREA] > self.minBlobArea) & (stats[:, cv2.CC_STAT_AREA] < self.maxBlobArea)
+        keep[0] = False
+        blobs = blobFeatures(ROI_image, labels, stats, keep)
+
+        # Shift coordinates wrt ROI
+        blobs['left'] += ROI[0]
+        blobs['top'] += ROI[1]
+        return BWImage, blobs
+
     @Slot(float)
     def setOffset(self, val):
         if -10.0 <= val <= 10.0:
@@ -157,3 +161,72 @@ class BlobDetector(Manipulator):
             self.blocksize = val
         else:
             raise ValueError('blocksize')
+
+    @Slot(int)
+    def setThreads(self, val):
+        if val >= 1:
+            if self.pool is not None:
+                self.pool.shutdown(wait=True)
+            self.threads = val
+            self.pool = ThreadPoolExecutor(max_workers=val, thread_name_prefix=self.name) if val > 1 else None
+        else:
+            raise ValueError('threads')
+
+def blobFeatures(image, labels, stats, keep):
+    """Compute the features of all labelled blobs at once, using labelled reductions.
+
+    \param image gray scale image
+    \param labels label image, as returned by cv2.connectedComponentsWithStats
+    \param stats label stats (left,top,width,height,area), including background label 0
+    \param keep boolean selection of the labels to return
+    \return structured array of BLOB_DTYPE, one record per kept label
+
+     Sharpness is the Laplacian variance over the blob pixels. The peak intensity is
+     estimated from the darkest blob pixel, the background from the mean of the other
+     pixels in the blob bounding box. Intensities are inverted, as in 255 - I.
+    """
+    selected = np.flatnonzero(keep)
+    blobs = np.zeros(selected.size, dtype=BLOB_DTYPE)
+    if selected.size == 0:
+        return blobs
+    stats = stats[selected]
+    blobs['left'] = stats[:, cv2.CC_STAT_LEFT]
+    blobs['top'] = stats[:, cv2.CC_STAT_TOP]
+    blobs['width'] = stats[:, cv2.CC_STAT_WIDTH]
+    blobs['height'] = stats[:, cv2.CC_STAT_HEIGHT]
+    blobs['area'] = stats[:, cv2.CC_STAT_AREA]
+
+    # Labelled pixels
+    n = keep.size
+    mask = labels > 0
+    index = labels[mask]
+    values = image[mask]
+    count = np.bincount(index, minlength=n)
+
+    # Local sharpness, variance of the Laplacian
+    laplacian = cv2.Laplacian(image, cv2.CV_32F)[mask].astype(np.float64)
+    mean = np.bincount(index, laplacian, minlength=n)[selected] / count[selected]
+    blobs['sharpness'] = np.bincount(index, laplacian**2, minlength=n)[selected] / count[selected] - mean**2
+
+    # Peak foreground intensity estimate, the darkest pixel is the first of its label after sorting.
+    # Label 0 is not in index, its count is 0, so the label starts index keys directly
+    keys = np.sort(index.astype(np.int64) * 256 + values)
+    starts = np.cumsum(count) - count
+    I_0 = 255.0 - (keys[starts[selected]] & 255)
+
+    # Background intensity, the mean of the bounding box excluding the blob
+    integral = cv2.integral(image, sdepth=cv2.CV_64F)
+    l, t = blobs['left'], blobs['top']
+    r, b = l + blobs['width'], t + blobs['height']
+    boxSum = integral[b, r] - integral[t, r] - integral[b, l] + integral[t, l]
+    blobSum = np.bincount(index, values, minlength=n)[selected]
+    boxArea = (blobs['width'] * blobs['height']).astype(np.float64) - count[selected]
+    I_b = np.zeros(selected.size)
+    I_b[boxArea > 0] = 255.0 - (boxSum - blobSum)[boxArea > 0] / boxArea[boxArea > 0]
+
+    # Local SNR
+    blobs['peak'] = I_0
+    blobs['background'] = I_b
+    valid = I_b > 0
+    blobs['snr'][valid] = (I_0[valid] - I_b[valid]) / np.sqrt(I_b[valid])
+    return blobs
@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 import numpy as np
 import lib.signal as signal
+from lib.imagePyramid import ImagePyramid
+from lib.frameRing import FrameRing
 #from PyQt5.QtCore import QObject, QThread, QTimer, QEventLoop, pyqtSignal, pyqtSlot
 from PySide2.QtCore import QObject, QThread, QTimer, QEventLoop, Signal, Slot
 from picamera import PiCamera
@@ -31,6 +33,44 @@ class PiYArray(PiArrayOutput):
         a = np.frombuffer(self.getvalue()[:self.y_len], dtype=np.uint8)
         self.array = a[:self.y_len].reshape((self.fheight, self.fwidth))
 
+## PiRingOutput class writes the camera frames into the slots of a FrameRing.
+## The encoder writes each frame in one or more buffers and flushes it; the buffers are copied straight into a free slot,
+## there is no BytesIO to grow, copy out and truncate. For YUV only the Y plane that fits the slot is kept.
+## When no slot is free the frame is dropped, a slot in use is never overwritten.
+class PiRingOutput:
+    def __init__(self, ring):
+        self.ring = ring
+        self.handle = None
+        self.view = None
+        self.offset = 0
+        self.dropping = False
+
+    def write(self, b):
+        data = memoryview(b).cast('B')
+        if self.handle is None and not self.dropping:
+            self.handle = self.ring.acquire(timeout=0)
+            if self.handle is None:
+                self.dropping = True # the rest of this frame is skipped too
+            else:
+                self.view = memoryview(self.handle.array.reshape(-1))
+                self.offset = 0
+        if self.handle is not None and self.offset < len(self.view):
+            count = min(len(data), len(self.view) - self.offset)
+            self.view[self.offset:self.offset + count] = data[:count]
+            self.offset += count
+        return len(data)
+
+    def flush(self):
+        handle = self.handle
+        if handle is not None:
+            if self.offset == len(self.view):
+                self.ring.publish(handle)
+            handle.release() # the ring holds the published frame now
+        self.handle = None
+        self.view = None
+        self.dropping = False
+        return
+
 ## PiVideoStream class streams camera images to a numpy array
 ## @author Jeroen Veen
 class PiVideoStream(QThread):
@@ -42,13 +82,18 @@ class PiVideoStream(QThread):
     CaptureArray = None
     PreviewArray = None
     CaptureFrame = None
+    CaptureHandle = None
+    CapturePyramid = None
     PreviewFrame = None
     
     ## The constructor.
-    def __init__(self, resolution=(640,480), monochrome=False, framerate=24, effect='none', use_video_port=False):
+    ## @param slots is the number of frames in the ring, the camera drops frames when the consumers keep all of them.
+    def __init__(self, resolution=(640,480), monochrome=False, framerate=24, effect='none', use_video_port=False, slots=6):
         super().__init__()
         resolution = raw_resolution(resolution)
-        self.frame = np.empty(resolution + (1 if monochrome else 3,), dtype=np.uint8)
+        self.slots = slots
+        self.droppedReported = 0 # ring drops already reported
+        self.dropReportTime = 0.0
         self.camera = PiCamera()
         self.initCamera(resolution, monochrome, framerate, effect, use_video_port)
         self.startMillis = None
@@ -69,9 +114,18 @@ class PiVideoStream(QThread):
                     self.msg(self.name + ": paused.")
                     break # return from thread is needed
                 else:
-                    self.rawCapture.truncate(0) # clear the stream in preparation for the next frame
-                    self.rawCapture.seek(0)
-                    self.CaptureFrame = f2.array
+                    handle = self.ring.latest()
+                    if handle is None or (self.CaptureHandle is not None and handle.sequence == self.CaptureHandle.sequence):
+                        if handle is not None:
+                            handle.release()
+                        self.reportDrops()
+                        continue # the frame was dropped, no free slot
+                    previous = self.CaptureHandle
+                    self.CaptureHandle = handle
+                    self.CaptureFrame = handle.array
+                    self.CapturePyramid = ImagePyramid(self.CaptureFrame, handle=handle) # levels are computed on demand and shared by all consumers
+                    if previous is not None:
+                        previous.release()
                     self.signals.capReady.emit()
                     self.fps.update()
                     if self.startMillis is not None:
@@ -115,13 +169,14 @@ class PiVideoStream(QThread):
         self.camera.iso = 100 # should force unity analog gain
         self.monochrome = monochrome # spoils edges
         self.camera.framerate = framerate
+        fwidth, fheight = raw_resolution(self.camera.resolution)
+        self.ring = FrameRing(self.slots, (fheight, fwidth) if self.monochrome else (fheight, fwidth, 3))
+        self.rawCapture = PiRingOutput(self.ring)
         if self.monochrome:
-            self.rawCapture = PiYArray(self.camera, size=self.camera.resolution)
 #             self.PreviewArray = PiYArray(self.camera, size=(640,480))
             self.stream = self.camera.capture_continuous(self.rawCapture, format='yuv', use_video_port=True, splitter_port=0)
 #             self.previewStream = self.camera.capture_continuous(output=self.PreviewArray, format='yuv', use_video_port=True, splitter_port=1, resize=(640,480))
         else:
-            self.rawCapture = PiRGBArray(self.camera, size=self.camera.resolution)
 #             self.PreviewArray = PiRGBArray(self.camera, size=(640,480))
             self.stream = self.camera.capture_continuous(self.rawCapture, format='bgr', use_video_port=True, splitter_port=0)
 #             self.previewStream = self.camera.capture_continuous(output=self.PreviewArray, format='bgr', use_video_port=True, splitter_port=1, resize=(640,480))
@@ -130,11 +185,28 @@ class PiVideoStream(QThread):
         QTimer.singleShot(2, GeneralEventLoop.exit)
         GeneralEventLoop.exec_()            
         
+    ## @brief PiVideoStream::reportDrops(self) reports the frames dropped because the consumers held all ring slots, at most every 5 s.
+    def reportDrops(self):
+        dropped = self.ring.dropped
+        now = time.time()
+        if dropped > self.droppedReported and now - self.dropReportTime >= 5.0:
+            self.msg("Warning: no free frame slot, {} frames dropped, ring {}".format(dropped - self.droppedReported, self.ring.stats()))
+            self.droppedReported = dropped
+            self.dropReportTime = now
+        return
+
+    ## @brief PiVideoStream::retainPyramid(self) retains the pyramid of the current frame for a consumer that keeps it after the capReady signal.
+    ## @return ImagePyramid the consumer must release, or None if there is no frame.
+    def retainPyramid(self):
+        pyramid = self.CapturePyramid
+        return pyramid if pyramid is not None and pyramid.retain() else None
+
     @Slot()
     def stop(self):
         self.pause = True
         self.fps.stop()
-        print(self.name + ": approx. acquisition speed: {:.2f} fps".format(self.fps.fps()))        
+        print(self.name + ": approx. acquisition speed: {:.2f} fps".format(self.fps.fps()))
+        print(self.name + ": frame ring {}".format(self.ring.stats()))        
         self.quit()
         print(self.name + ": closed.")
         
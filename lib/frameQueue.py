@@ -0,0 +1,134 @@
+"""@package docstring
+Bounded frame queue between the camera and the image processing workers.
+
+The overflow policy decides what happens when frames arrive faster than they are processed:
+keep the latest frame only (live preview), drop the oldest frame, or block the producer
+until there is room (batch snapshots, where every frame must be analysed).
+"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import collections
+import threading
+import time
+
+## @brief FrameQueue is a thread safe bounded queue of frames with selectable overflow policy and counters.
+class FrameQueue:
+    KEEP_LATEST = 'keep-latest'
+    DROP_OLDEST = 'drop-oldest'
+    BLOCK = 'block'
+    POLICIES = (KEEP_LATEST, DROP_OLDEST, BLOCK)
+
+    ## @brief FrameQueue::__init__(self, maxsize, policy) creates an empty queue.
+    ## @param maxsize is the maximum number of queued frames.
+    ## @param policy is the overflow policy, one of FrameQueue.POLICIES.
+    def __init__(self, maxsize=1, policy=KEEP_LATEST):
+        if maxsize < 1:
+            raise ValueError('maxsize')
+        self.maxsize = maxsize
+        self.setPolicy(policy)
+        self.frames = collections.deque()
+        self.lock = threading.Lock()
+        self.notEmpty = threading.Condition(self.lock)
+        self.notFull = threading.Condition(self.lock)
+        self.closed = False
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.maxDepth = 0
+        self.onDrop = None  # optional callback, called with each dropped frame
+
+    ## @brief FrameQueue::setPolicy(self, policy) changes the overflow policy.
+    def setPolicy(self, policy):
+        if policy not in self.POLICIES:
+            raise ValueError('frame queue policy')
+        self.policy = policy
+        return
+
+    ## @brief FrameQueue::put(self, frame, timeout=None) queues a frame according to the overflow policy.
+    ## @param frame is the frame to queue.
+    ## @param timeout is the maximum time [s] to block with the block policy, None blocks until there is room.
+    ## @return True if the frame was queued, False if it was dropped.
+    def put(self, frame, timeout=None):
+        dropped = []
+        with self.lock:
+            self.received += 1
+            if self.policy == self.KEEP_LATEST:
+                while self.frames:
+                    dropped.append(self.frames.popleft())
+            elif self.policy == self.DROP_OLDEST:
+                while len(self.frames) >= self.maxsize:
+                    dropped.append(self.frames.popleft())
+            else:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while len(self.frames) >= self.maxsize and not self.closed:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self.notFull.wait(remaining)
+            accepted = not self.closed and len(self.frames) < self.maxsize
+            if accepted:
+                self.frames.append(frame)
+                self.maxDepth = max(self.maxDepth, len(self.frames))
+                self.notEmpty.notify()
+            else:
+                dropped.append(frame)
+            self.dropped += len(dropped)
+        self.release(dropped)
+        return accepted
+
+    ## @brief FrameQueue::get(self, timeout=None) takes the oldest frame from the queue.
+    ## @param timeout is the maximum time [s] to wait for a frame, None waits until a frame arrives or the queue is closed.
+    ## @return the frame, or None on timeout or when the queue is closed.
+    def get(self, timeout=None):
+        with self.lock:
+            if not self.frames and not self.closed:
+                self.notEmpty.wait_for(lambda: self.frames or self.closed, timeout)
+            if not self.frames:
+                return None
+            frame = self.frames.popleft()
+            self.notFull.notify()
+            return frame
+
+    ## @brief FrameQueue::taskDone(self) counts a frame taken by get() as processed.
+    def taskDone(self):
+        with self.lock:
+            self.processed += 1
+        return
+
+    ## @brief FrameQueue::close(self, drain=False) wakes up all waiting producers and consumers, and refuses new frames.
+    ## @param drain keeps the queued frames for the consumers when True, otherwise they are dropped.
+    def close(self, drain=False):
+        with self.lock:
+            self.closed = True
+            dropped = [] if drain else list(self.frames)
+            if not drain:
+                self.frames.clear()
+            self.dropped += len(dropped)
+            self.notEmpty.notify_all()
+            self.notFull.notify_all()
+        self.release(dropped)
+        return
+
+    ## @brief FrameQueue::open(self) reopens a closed queue.
+    def open(self):
+        with self.lock:
+            self.closed = False
+        return
+
+    ## @brief FrameQueue::depth(self) is the current number of queued frames.
+    def depth(self):
+        with self.lock:
+            return len(self.frames)
+
+    ## @brief FrameQueue::stats(self) returns the queue counters.
+    ## @return dict with received, processed and dropped frame counts, and the current and maximum queue depth.
+    def stats(self):
+        with self.lock:
+            return {'policy': self.policy, 'received': self.received, 'processed': self.processed,
+                    'dropped': self.dropped, 'depth': len(self.frames), 'maxDepth': self.maxDepth}
+
+    def release(self, frames):
+        if self.onDrop is not None:
+            for frame in frames:
+                self.onDrop(frame)
+        return
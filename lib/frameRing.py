@@ -0,0 +1,118 @@
+"""@package docstring
+Ring of preallocated camera frame slots with reference counted hand-off.
+
+The camera writes each frame straight into a free slot, instead of into a growing BytesIO that
+is copied out and reallocated for every frame. A finished frame is published as the latest
+frame and handed to the consumers as a FrameHandle. Every consumer that keeps the frame after
+the capture signal (a queue, a background writer) retains the handle and releases it when done;
+a slot is only written again after the ring and all consumers released it. When no slot is free
+the camera frame is dropped instead of overwriting a frame in use.
+"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import threading
+import numpy as np
+
+## @brief FrameHandle is a reference to the frame in one slot of a FrameRing.
+class FrameHandle:
+    def __init__(self, ring, index, sequence):
+        self.ring = ring
+        self.index = index
+        self.sequence = sequence  # frame number, identifies the frame when the slot is reused
+        self.array = ring.slots[index]
+
+    ## @brief FrameHandle::retain(self) adds a reference, the slot is not reused until each reference is released.
+    ## @return self, or None if the frame was already recycled.
+    def retain(self):
+        return self if self.ring.retain(self) else None
+
+    ## @brief FrameHandle::release(self) removes a reference.
+    def release(self):
+        self.ring.release(self)
+        return
+
+## @brief FrameRing is a thread safe ring of preallocated frame slots.
+class FrameRing:
+    """Frame ring
+
+    :param slots: number of frame slots
+    :param shape: shape of a frame, e.g. (height, width) or (height, width, 3)
+    :param dtype: element type (default uint8)
+
+    """
+    def __init__(self, slots, shape, dtype=np.uint8):
+        if slots < 2:
+            raise ValueError('slots')
+        self.slots = [np.empty(shape, dtype=dtype) for i in range(slots)]
+        self.refs = [0] * slots
+        self.sequences = [0] * slots
+        self.free = list(range(slots))
+        self.lock = threading.Lock()
+        self.notFull = threading.Condition(self.lock)
+        self.latestHandle = None
+        self.sequence = 0
+        self.published = 0
+        self.dropped = 0
+
+    ## @brief FrameRing::acquire(self, timeout) takes a free slot to write a frame into, the caller holds the only reference.
+    ## @param timeout is the maximum time [s] to wait for a free slot, 0 does not wait, None waits until a slot is released.
+    ## @return FrameHandle, or None if no slot became free.
+    def acquire(self, timeout=0):
+        with self.lock:
+            if not self.free and timeout != 0:
+                self.notFull.wait_for(lambda: self.free, timeout)
+            if not self.free:
+                self.dropped += 1
+                return None
+            index = self.free.pop(0)
+            self.sequence += 1
+            self.refs[index] = 1
+            self.sequences[index] = self.sequence
+            return FrameHandle(self, index, self.sequence)
+
+    ## @brief FrameRing::publish(self, handle) makes a written frame the latest frame, the ring keeps a reference to it until the next frame is published.
+    def publish(self, handle):
+        with self.lock:
+            self.refs[handle.index] += 1
+            previous = self.latestHandle
+            self.latestHandle = handle
+            self.published += 1
+        if previous is not None:
+            self.release(previous)
+        return
+
+    ## @brief FrameRing::latest(self) retains the latest frame for the caller.
+    ## @return FrameHandle the caller must release, or None if no frame was published yet.
+    def latest(self):
+        with self.lock:
+            handle = self.latestHandle
+            if handle is None:
+                return None
+            self.refs[handle.index] += 1
+            return handle
+
+    ## @brief FrameRing::retain(self, handle) adds a reference to a frame.
+    ## @return False if the frame was recycled, the handle is stale.
+    def retain(self, handle):
+        with self.lock:
+            if self.refs[handle.index] == 0 or self.sequences[handle.index] != handle.sequence:
+                return False
+            self.refs[handle.index] += 1
+            return True
+
+    ## @brief FrameRing::release(self, handle) removes a reference, the slot becomes free when it has none left.
+    def release(self, handle):
+        with self.lock:
+            if self.sequences[handle.index] != handle.sequence or self.refs[handle.index] == 0:
+                raise ValueError('frame {} released more often than retained'.format(handle.sequence))
+            self.refs[handle.index] -= 1
+            if self.refs[handle.index] == 0:
+                self.free.append(handle.index)
+                self.notFull.notify()
+        return
+
+    ## @brief FrameRing::stats(self) returns the ring counters.
+    ## @return dict with the number of slots, free slots, published and dropped frames.
+    def stats(self):
+        with self.lock:
+            return {'slots': len(self.slots), 'free': len(self.free), 'published': self.published, 'dropped': self.dropped}
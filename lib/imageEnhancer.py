@@ -36,10 +36,18 @@ class ImageEnhancer(Manipulator):
         self.rotAngle = round(kwargs['rotAngle'], 1) if 'rotAngle' in kwargs else 0.0
 
         # Set threshold for contrast limiting
-        self.clahe = cv2.createCLAHE(clipLimit=kwargs['clahe'], tileGridSize=(8,8)) if 'clahe' in kwargs else None
+        self.clipLimit = kwargs['clahe'] if 'clahe' in kwargs else 0.0
+        self.clahe = cv2.createCLAHE(clipLimit=self.clipLimit, tileGridSize=(8,8)) if 'clahe' in kwargs else None
 
         # Set gamma correction
         self.gamma = kwargs['gamma'] if 'gamma' in kwargs else 1.0           
+
+        # Number of output buffers the plan cycles through, increase when results are held across frames
+        self.buffers = kwargs['buffers'] if 'buffers' in kwargs else 1
+
+        # Enhancement plan, rebuilt when the parameters or the input shape change
+        self.plan = None
+        self.planKey = None
        
     def __del__(self):
         """The deconstructor."""
@@ -56,36 +64,15 @@ class ImageEnhancer(Manipulator):
             if self.cropRect[3] == 0:
                 self.cropRect[3] = self.image.shape[1]
 
-            # Convert to gray scale
-            if len(self.image.shape) > 2:  # if color image
-                self.image = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
-
-            # Rotate
-            if 0.0 < abs(self.rotAngle) <= 5.0:
-                image_center = tuple(np.array(self.image.shape[1::-1]) / 2)
-                rot_mat = cv2.getRotationMatrix2D(image_center, self.rotAngle, 1.0) ## no scaling
-                self.image = cv2.warpAffine(self.image, rot_mat, self.image.shape[1::-1], flags=cv2.INTER_LINEAR)
-                deltaw = int(.5*np.round(np.arcsin(np.pi*np.abs(self.rotAngle)/180)*self.image.shape[0]))
-                deltah = int(.5*np.round(np.arcsin(np.pi*np.abs(self.rotAngle)/180)*self.image.shape[1]))
-            else:
-                deltaw = deltah = 0
-
-            # Crop
-            p1_y = self.cropRect[0] + deltah
-            p1_x = self.cropRect[1] + deltaw
-            p2_y = self.image.shape[0] - deltah if self.cropRect[2] == 0 else self.cropRect[2] - deltah
-            p2_x = self.image.shape[1] - deltaw if self.cropRect[3] == 0 else self.cropRect[3] - deltaw
-
-            if (p2_y > p1_y) and (p2_x > p1_x):
-                self.image = self.image[p1_y:p2_y, p1_x:p2_x]
-            
-            # Contrast Limited Adaptive Histogram Equalization.
-            if self.clahe is not None:  
-                self.image = self.clahe.apply(self.image)
-                
-            # Change gamma correction
-            if 1.0 < self.gamma < 10.0:  
-                self.image = adjust_gamma(self.image, self.gamma)
+            # (Re)build the enhancement plan only when the input shape or a parameter changed
+            key = (self.image.shape, tuple(self.cropRect), self.rotAngle, self.clipLimit, self.gamma)
+            if self.plan is None or self.planKey != key:
+                self.plan = EnhancementPlan(self.image.shape, self.cropRect, self.rotAngle,
+                                            self.clahe, self.gamma, self.buffers)
+                self.planKey = key
+
+            # Convert to gray scale, crop, rotate, CLAHE and gamma into preallocated buffers
+            self.image = self.plan.apply(self.image)
 
             # Finalize
             self.stopTimer()
@@ -117,8 +104,10 @@ class ImageEnhancer(Manipulator):
     def setClaheClipLimit(self, val):
         if val <= 0.0:
             self.clahe = None
+            self.clipLimit = 0.0
         elif val <= 10.0:
             self.clahe = cv2.createCLAHE(clipLimit=val, tileGridSize=(8,8))  # Sets threshold for contrast limiting
+            self.clipLimit = val
         else:
             raise ValueError('clahe clip limit')
             
@@ -150,9 +139,103 @@ class ImageEnhancer(Manipulator):
         else:
             raise ValueError('crop y2')
   
-def adjust_gamma(image, gamma=1.0):
+
+## @brief EnhancementPlan precomputes everything ImageEnhancer::start needs for one parameter set and input shape:
+## the rotation matrix, the crop window, the CLAHE object, the gamma lookup table and the output buffers.
+## The crop is folded into the rotation matrix, so only the region that survives cropping is warped.
+class EnhancementPlan:
+    """Enhancement plan
+        \param shape input image shape
+        \param cropRect crop area (p1_y, p1_x, p2_y, p2_x), with p2 filled in
+        \param rotAngle rotation angle [deg]
+        \param clahe CLAHE object or None
+        \param gamma gamma correction
+        \param buffers number of output buffers to cycle through
+    """
+    def __init__(self, shape, cropRect, rotAngle, clahe, gamma, buffers=1):
+        height, width = shape[0:2]
+
+        # Gray scale buffer for color input
+        self.gray = np.empty((height, width), dtype=np.uint8) if len(shape) > 2 else None
+
+        # Rotation margins, as cut off by the crop
+        if 0.0 < abs(rotAngle) <= 5.0:
+            deltaw = int(.5*np.round(np.arcsin(np.pi*np.abs(rotAngle)/180)*height))
+            deltah = int(.5*np.round(np.arcsin(np.pi*np.abs(rotAngle)/180)*width))
+        else:
+            deltaw = deltah = 0
+
+        # Crop window, falls back to the full frame when empty
+        p1_y = cropRect[0] + deltah
+        p1_x = cropRect[1] + deltaw
+        p2_y = cropRect[2] - deltah
+        p2_x = cropRect[3] - deltaw
+        if not ((p2_y > p1_y) and (p2_x > p1_x)):
+            p1_y, p1_x, p2_y, p2_x = 0, 0, height, width
+        self.crop = (slice(p1_y, p2_y), slice(p1_x, p2_x))
+        self.size = (p2_x - p1_x, p2_y - p1_y)  # (width, height)
+
+        # Rotate about the frame centre, but shift the output so that it starts at the crop corner
+        if 0.0 < abs(rotAngle) <= 5.0:
+            image_center = (width / 2, height / 2)
+            self.rotMat = cv2.getRotationMatrix2D(image_center, rotAngle, 1.0) ## no scaling
+            self.rotMat[0, 2] -= p1_x
+            self.rotMat[1, 2] -= p1_y
+        else:
+            self.rotMat = None
+
+        # Contrast Limited Adaptive Histogram Equalization
+        self.clahe = clahe
+
+        # Gamma lookup table
+        self.table = gamma_table(gamma) if 1.0 < gamma < 10.0 else None
+
+        # Output buffers, plus a work buffer when both rotation and CLAHE write
+        self.writes = (self.rotMat is not None) or (self.clahe is not None) or (self.table is not None)
+        self.output = [np.empty((self.size[1], self.size[0]), dtype=np.uint8) for _ in range(max(1, buffers))]
+        self.work = np.empty((self.size[1], self.size[0]), dtype=np.uint8) if (self.rotMat is not None and self.clahe is not None) else None
+        self.index = 0
+
+    ## @brief EnhancementPlan::apply(self, image) runs the plan on image.
+    ## @param image the (color or gray scale) input image, with the shape the plan was built for
+    ## @return enhanced image, one of the output buffers, never a view of the input or the gray scale buffer
+    def apply(self, image):
+        # Convert to gray scale
+        if self.gray is not None:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self.gray)
+
+        out = self.output[self.index]
+        self.index = (self.index + 1) % len(self.output)
+
+        # Only crop, copy so the result does not change with the next frame or a reused camera slot
+        if not self.writes:
+            np.copyto(out, image[self.crop])
+            return out
+
+        # Crop and rotate in one warp
+        if self.rotMat is not None:
+            dst = out if self.clahe is None else self.work
+            image = cv2.warpAffine(image, self.rotMat, self.size, dst=dst, flags=cv2.INTER_LINEAR)
+        else:
+            image = image[self.crop]
+
+        # Contrast Limited Adaptive Histogram Equalization.
+        if self.clahe is not None:
+            image = self.clahe.apply(image, dst=out)
+
+        # Change gamma correction
+        if self.table is not None:
+            image = cv2.LUT(image, self.table, dst=out)
+
+        return image
+
+## @brief gamma_table(gamma) computes the 256-entry gamma correction lookup table.
+## @param gamma is the gamma correction
+## @return uint8 lookup table
+def gamma_table(gamma=1.0):
    invGamma = 1.0 / gamma
-   table = np.array([((i / 255.0) ** invGamma) * 255
-##   table = np.array([(  np.log(1.0 + i/255.0)*gamma) * 255  # log transform
-      for i in np.arange(0, 256)]).astype("uint8")
-   return cv2.LUT(image, table)
+   return ((np.arange(0, 256) / 255.0) ** invGamma * 255).astype("uint8")
+##   return ((np.log(1.0 + np.arange(0, 256)/255.0)*gamma) * 255).astype("uint8")  # log transform
+
+def adjust_gamma(image, gamma=1.0):
+   return cv2.LUT(image, gamma_table(gamma))
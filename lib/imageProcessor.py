@@ -14,36 +14,66 @@ import sys
 import os
 import cv2
 import traceback
+import threading
 import lib.signal as signal
 from lib.imageEnhancer import ImageEnhancer
 from lib.imageSegmenter import ImageSegmenter
 from lib.BlobDetector import BlobDetector
+from lib.frameQueue import FrameQueue
+from lib.pipeline import Pipeline, FrameJob
+from lib.imagePyramid import ImagePyramid
 from PySide2.QtCore import QThread, Slot, QEventLoop, QTimer
 
+## @param PREVIEW_SIZE is the (width, height) the frames are scaled to for the preview, the processing stages and the well positioning.
+PREVIEW_SIZE = (640, 480)
+
+## @param WORKER_BUFFERS is the number of enhancer output buffers of a worker: the frame being enhanced, plus the emitted frames still held by the result consumers.
+WORKER_BUFFERS = 3
+
 ## @author Jeroen Veen
 class ImageProcessor(QThread):
     '''
-    Worker thread
+    Long-lived worker thread, frames are passed via a bounded queue
 
-    :param callback: The function callback to run on this worker thread. Supplied args and 
-                     kwargs will be passed through to the runner.
-    :type callback: function
-    :param args: Arguments to pass to the callback function
-    :param kwargs: Keywords to pass to the callback function
+    :param policy: Queue overflow policy, one of FrameQueue.POLICIES (default keep-latest)
+    :param maxQueue: Maximum number of queued frames (default 1)
+    :param workers: Number of workers processing frames from the queue (default 1)
+    :param detection: Workers run the enhancer, the segmenter (when grid detection is set) and the
+                      blob detector on each frame; False only scales the frame for the preview (default False)
+    :param pipeline: Run enhancer, segmenter and detector as a pipeline, one thread per stage,
+                     instead of workers that process a frame from start to end; implies detection (default False)
+    :param handoff: Size of the hand-off queues between the pipeline stages (default 1)
 
     '''
 
-    def __init__(self):
+    def __init__(self, *args, **kwargs):
         super().__init__()
 
         self.name = 'image processor'
         self.image = None
         self.signals = signal.signalClass()
         self.isStopped = False
-        self.enhancer = ImageEnhancer()
-        self.segmenter = ImageSegmenter(plot=True)
-        self.detector = BlobDetector(plot=False)
+        self.queue = FrameQueue(maxsize=kwargs['maxQueue'] if 'maxQueue' in kwargs else 1,
+                                policy=kwargs['policy'] if 'policy' in kwargs else FrameQueue.KEEP_LATEST)
+        self.queue.onDrop = self.releaseFrame  # frames of the camera ring are retained while queued
+        self.workers = max(1, kwargs['workers'] if 'workers' in kwargs else 1)
         self.gridDetection = False
+        self.blobDetection = kwargs['detection'] if 'detection' in kwargs else False
+        self.frameIndex = 0
+        self.pipeline = None
+        if 'pipeline' in kwargs and kwargs['pipeline']:
+            self.pipeline = Pipeline(self.queue,
+                                     [('enhance', self.enhance), ('segment', self.segment), ('detect', self.detect)],
+                                     self.publish,
+                                     handoff=kwargs['handoff'] if 'handoff' in kwargs else 1,
+                                     onError=lambda err: self.signals.error.emit(err))
+            # Enhanced frames stay in use downstream while the enhancer continues, so each frame
+            # in flight needs its own output buffer, plus the frames held by the result consumers
+            self.stages = self.createStages(buffers=self.pipeline.inFlight() + 2)
+        else:
+            # The emitted frame is held by the result consumers while the worker enhances the next ones
+            self.stages = self.createStages(buffers=WORKER_BUFFERS)
+        self.enhancer, self.segmenter, self.detector = self.stages
        
     ## @brief ImageProcessor::msg(self, message) emits the message signal. This emit will be catched by the logging slot function in main.py.
     ## @param message is the string message to be emitted.
@@ -52,73 +82,161 @@ class ImageProcessor(QThread):
             self.signals.mes.emit(self.__class__.__name__ + ": " + str(message))
         return
 
-    @Slot(np.ndarray)
-    # Note that we need this wrapper around the Thread run function, since the latter will not accept any parameters
+    ## @brief ImageProcessor::createStages(self, buffers=1) creates a private set of processing stages for one worker.
+    ## @param buffers is the number of enhancer output buffers.
+    ## @return tuple (enhancer, segmenter, detector)
+    def createStages(self, buffers=1):
+        return ImageEnhancer(buffers=buffers), ImageSegmenter(plot=True), BlobDetector(plot=False)
+
+    @Slot(object)
+    ## @brief ImageProcessor::update(self, image) queues a frame (array or ImagePyramid) for the workers, according to the queue policy.
+    ## With the block policy the caller waits until there is room in the queue.
     def update(self, image=None):
         try:
-            
-            if self.isRunning():
-                # thread is already running
-                # drop frame
-                self.msg('I: {} busy, frame dropped'.format(self.name))
-            elif image is not None:
-                # we have a new image
-                self.image = image     
-                self.start()
-                
+            if image is not None and not self.isStopped:
+                if isinstance(image, ImagePyramid) and not image.retain():
+                    return  # the camera already reused the frame slot
+                self.queue.put(image)
         except Exception as err:
             traceback.print_exc()
             self.msg((type(err), err.args, traceback.format_exc()))
             self.signals.error.emit((type(err), err.args, traceback.format_exc()))
 
-       
     @Slot()
     def run(self):
         '''
-        Initialise the runner function with passed args, kwargs.
+        Start the workers, and process queued frames until stopped.
         '''
-        if not self.isStopped and self.image is not None:
-            self.msg('I: Running worker "{}"\n'.format(self.name))
-           
-            # Retrieve args/kwargs here; and fire processing using them
+        self.queue.open()
+        if self.pipeline is not None:
+            self.msg('I: Running pipeline "{}"'.format(self.name))
+            self.pipeline.start()
+            self.pipeline.join()
+            return
+        self.msg('I: Running {} worker(s) "{}"'.format(self.workers, self.name))
+        helpers = [threading.Thread(target=self.work, args=(self.createStages(buffers=WORKER_BUFFERS),), daemon=True)
+                   for i in range(self.workers - 1)]
+        for helper in helpers:
+            helper.start()
+        self.work(self.stages)
+        for helper in helpers:
+            helper.join()
+
+    ## @brief ImageProcessor::work(self, stages) takes frames from the queue and processes them with its own stages.
+    ## @param stages is the tuple of processing stages owned by this worker.
+    def work(self, stages):
+        while not self.isStopped:
+            image = self.queue.get()
+            if image is None:
+                break
             try:
-                result = None
-                self.image = cv2.resize(self.image, (640,480))
-                
-#                 # Enhance image
-#                 self.image = self.enhancer.start(self.image)
-#                 
-#                 # Segment image according to grid 
-#                 if self.gridDetection:
-#                     self.image = self.segmenter.start(self.image)
-#                     ROIs = self.segmenter.ROIs
-#                 else:
-#                     ROIs = [[int(self.image.shape[1]/4), int(self.image.shape[0]/4),
-#                              int(self.image.shape[1]/2), int(self.image.shape[0]/2)]]
-# 
-#                 # Blob detection
-#                 result = self.detector.start(self.image, ROIs)
-
-            except Exception as err:
-                traceback.print_exc()
-                self.signals.error.emit((type(err), err.args, traceback.format_exc()))
-            else:
-                self.signals.resultBlobs.emit(result,self.detector.blobs)
-                self.signals.result.emit(result)  # Return the result of the processing
+                self.process(image, stages)
             finally:
-                self.signals.finished.emit()  # Done
+                self.releaseFrame(image)
+                self.queue.taskDone()
+
+    ## @brief ImageProcessor::releaseFrame(self, image) releases the camera frame slot retained by update(), when it is processed or dropped.
+    def releaseFrame(self, image):
+        if isinstance(image, ImagePyramid):
+            image.release()
+        return
+
+    ## @brief ImageProcessor::process(self, image, stages) processes one frame and emits the results.
+    def process(self, image, stages):
+        enhancer, segmenter, detector = stages
+        try:
+            result = None
+            pyramid = ImagePyramid.of(image)
+            image = pyramid.owned(pyramid.resized(PREVIEW_SIZE))  # the result outlives the frame slot
+
+            if self.blobDetection:
+                # Enhance image
+                image = enhancer.start(image)
+
+                # Segment image according to grid 
+                if self.gridDetection:
+                    image = segmenter.start(image)
+                    ROIs = segmenter.ROIs if segmenter.ROIs is not None else []
+                else:
+                    ROIs = [[int(image.shape[1]/4), int(image.shape[0]/4),
+                             int(image.shape[1]/2), int(image.shape[0]/2)]]
+
+                # Blob detection
+                result = detector.start(image, ROIs)
+            self.image = image
+
+        except Exception as err:
+            traceback.print_exc()
+            self.signals.error.emit((type(err), err.args, traceback.format_exc()))
+        else:
+            self.signals.resultBlobs.emit(result, detector.blobs)
+            self.signals.result.emit(image)  # Return the processed image
+        finally:
+            self.signals.finished.emit()  # Done
+
+    ## @brief ImageProcessor::enhance(self, image) is the first pipeline stage, it wraps the frame in a FrameJob.
+    def enhance(self, image):
+        try:
+            job = FrameJob(ImagePyramid.of(image).resized(PREVIEW_SIZE), self.frameIndex)
+            self.frameIndex += 1
+            job.image = self.enhancer.start(job.image)  # into the enhancer buffers, the frame slot is no longer needed
+        finally:
+            self.releaseFrame(image)
+        return job
+
+    ## @brief ImageProcessor::segment(self, job) is the second pipeline stage, it finds the ROIs.
+    def segment(self, job):
+        if self.gridDetection:
+            job.image = self.segmenter.start(job.image)
+            job.ROIs = self.segmenter.ROIs if self.segmenter.ROIs is not None else []
+        else:
+            job.ROIs = [[int(job.image.shape[1]/4), int(job.image.shape[0]/4),
+                         int(job.image.shape[1]/2), int(job.image.shape[0]/2)]]
+        return job
+
+    ## @brief ImageProcessor::detect(self, job) is the last pipeline stage, it detects the blobs in the ROIs.
+    def detect(self, job):
+        job.result = self.detector.start(job.image, job.ROIs)
+        job.blobs = self.detector.blobs
+        return job
+
+    ## @brief ImageProcessor::publish(self, job) emits the results of a frame that passed the pipeline.
+    def publish(self, job):
+        self.image = job.image
+        self.signals.resultBlobs.emit(job.result, job.blobs)
+        self.signals.result.emit(job.image)
+        self.signals.finished.emit()
+
+    ## @brief ImageProcessor::statistics(self) returns the frame queue counters.
+    ## @return dict with received, processed and dropped frame counts, and the current and maximum queue depth,
+    ## in pipeline mode a dict of those per stage, including the busy time [ms] of each stage.
+    def statistics(self):
+        return self.pipeline.stats() if self.pipeline is not None else self.queue.stats()
+
+    @Slot(str)
+    def setQueuePolicy(self, policy):
+        self.queue.setPolicy(policy)
+        self.msg('I: Frame queue policy {}'.format(policy))
                 
     @Slot()
     def stop(self):
         if self.isRunning():
-            self.msg('I: Stopping worker "{}"\n'.format(self.name))
+            self.msg('I: Stopping worker "{}", {}'.format(self.name, self.statistics()))
             self.isStopped = True
+            if self.pipeline is not None:
+                self.pipeline.close()
+            else:
+                self.queue.close()
             self.quit()
 
     @Slot(bool)
     def setDetector(self, val):
         self.gridDetection = val  
 
+    @Slot(bool)
+    def setBlobDetection(self, val):
+        self.blobDetection = val
+
     ## @brief ImageProcessor::wait_ms(self, milliseconds) is a delay function.
     ## @param milliseconds is the number of milliseconds to wait.
     def wait_ms(self, milliseconds):
@@ -143,7 +261,7 @@ class WellPositionEvaluator(QThread):
     circle_maxRadius = None
     circle_minDistance = None
 
-    def __init__(self, resolution):
+    def __init__(self, resolution, **kwargs):
         super().__init__()
         self.img_width, self.img_height = resolution
         # The radius' are just initial values and will be reset once the first circle was found at the home position.
@@ -151,11 +269,31 @@ class WellPositionEvaluator(QThread):
         self.circle_minRadius = int((self.img_height/2) * 0.7) # minimum circle size covers 70% of img height
         self.circle_minDistance = int(self.img_height/480) # find as many circles as reasonably possible
 
+        # Coarse-to-fine mode: find the circle on a downsampled image, then refine it on a full resolution annulus
+        self.coarseToFine = kwargs['coarseToFine'] if 'coarseToFine' in kwargs else False
+
+        # Downsample factor of the coarse search, rounded to a power of two (pyramid level).
+        # By default 4 to 8, such that the coarse image is about 150 px high
+        self.downscale = kwargs['downscale'] if 'downscale' in kwargs else min(8, max(4, 2**math.ceil(math.log2(self.img_height / 150))))
+
+        # Number of largest blobs scored by the contour fallback
+        self.topK = kwargs['topK'] if 'topK' in kwargs else 5
+
+        # Number of rays sampled across the well edge to refine the circle
+        self.rays = kwargs['rays'] if 'rays' in kwargs else 90
+        angles = np.linspace(0, 2*np.pi, self.rays, endpoint=False)
+        self.rayCos = np.cos(angles).astype(np.float32)
+        self.raySin = np.sin(angles).astype(np.float32)
+
+        # Filters are created once and reused for every evaluation
+        self.clahe = cv2.createCLAHE(clipLimit=4.0, tileGridSize=(8, 8))
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (int(self.img_width / 128), int(self.img_height / 128)))
+
     ## @brief WellPositionEvaluator::evaluate(self, source, target=(0,0)) finds the position error by finding the well bottom centroid. 
     ## Find circle(s) using hough transform, and return the circle that is closest to the centre.
     ## If no circle could be found decrease param2 and increase contrast, though this might cause false negatives if it is too low.
     ## When this still fails, use blob detection and attempt to find a circle like object.
-    ## @param source 2d grayscale image list
+    ## @param source 2d grayscale image, or ImagePyramid of it
     ## @param target contains the target coordinates (topleft pixel is 0,0)
     ## @return offset tuple (x, y) position error
     def evaluate(self, source, target=(0, 0)):
@@ -163,14 +301,17 @@ class WellPositionEvaluator(QThread):
         best_match = None
         best_area = None
         best_radius = None
-        img = source.copy()
+        pyramid = ImagePyramid.of(source)
+        if self.coarseToFine:
+            error = self.evaluateCoarseToFine(pyramid, target)
+            if error is not None:
+                return error
         ## First attempt to find the well using the hough circles method.
         ## Hough circle is most accurate when the well is closest to the desired target.
-        ## Normalize and adjust contrast 'curve' using clahe
-        cv2.normalize(img, img, 0, 255, cv2.NORM_MINMAX)
+        ## Normalize and adjust contrast 'curve' using clahe, the source is shared read-only so normalize into a new image
+        img = cv2.normalize(pyramid.image, None, 0, 255, cv2.NORM_MINMAX)
         img = cv2.medianBlur(img, 11)
-        clahe = cv2.createCLAHE(clipLimit=4.0, tileGridSize=(8, 8))
-        img = clahe.apply(img)
+        img = self.clahe.apply(img)
         circles = cv2.HoughCircles(image=img, method=cv2.HOUGH_GRADIENT, dp=1, param1=40, param2=80, minDist=self.circle_minDistance, minRadius=self.circle_minRadius, maxRadius=self.circle_maxRadius)
         if not circles is None:
             circles = np.round(circles[0, :]).astype("int")
@@ -192,40 +333,108 @@ class WellPositionEvaluator(QThread):
         cv2.threshold(img, 200, 255, cv2.THRESH_OTSU, img)
 
         # Morph-close with a small kernel to close holes caused by objects within the well.
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (int(self.img_width / 128), int(self.img_height / 128)))
-        cv2.morphologyEx(img, cv2.MORPH_CLOSE, kernel, img, (-1, -1), 2)
+        cv2.morphologyEx(img, cv2.MORPH_CLOSE, self.kernel, img, (-1, -1), 2)
 
         ## Find contours and select best matching blob by looking at the mean score for rondness and eccentricity,
-        ## where lower is better. Apply a threshold on found objects,
-        ## Must have a minimum to prevent false negatives and maximum area to prevent false positives.
+        ## where lower is better. Apply a threshold on found objects, must have a minimum to prevent false negatives.
+        ## The area filter and ranking run on all contours at once, only the top-k largest remaining contours are scored.
         best_score = sys.maxsize
-        #_,contours,_ = cv2.findContours(img, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
         contours,_ = cv2.findContours(img, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-        for i, c in enumerate(contours):
-            area = cv2.contourArea(c)
-            if area > int((self.img_width/3) * (self.img_height/3)):
-                perimeter = cv2.arcLength(c, True)
-                roundness = 4 * np.pi * area / perimeter ** 2
-                m = cv2.moments(c)
-                eccentricity = ((m['nu20'] - m['nu02']) ** 2 + 4 * m['nu11'] ** 2) / (m['nu20'] + m['nu02']) ** 2
-                score = (1 - roundness + eccentricity) / 2
-                if score < best_score:
-                    best_score = score
-                    best_match = c
-                    best_area = int(area)
-                    best_radius = int(math.sqrt(area/np.pi))
+        areas = np.fromiter((cv2.contourArea(c) for c in contours), dtype=np.float64, count=len(contours))
+        candidates = np.flatnonzero(areas > int((self.img_width/3) * (self.img_height/3)))
+        candidates = candidates[np.argsort(-areas[candidates], kind='stable')[:self.topK]]
+        for i in candidates:
+            c, area = contours[i], areas[i]
+            perimeter = cv2.arcLength(c, True)
+            roundness = 4 * np.pi * area / perimeter ** 2
+            m = cv2.moments(c)
+            eccentricity = ((m['nu20'] - m['nu02']) ** 2 + 4 * m['nu11'] ** 2) / (m['nu20'] + m['nu02']) ** 2
+            score = (1 - roundness + eccentricity) / 2
+            if score < best_score:
+                best_score = score
+                best_match = (int(m["m10"] / m["m00"] + 0.5), int(m["m01"] / m["m00"] + 0.5))
+                best_area = int(area)
+                best_radius = int(math.sqrt(area/np.pi))
 
         if best_match is not None:
-            M = cv2.moments(best_match)
-            cX = int(M["m10"] / M["m00"] + 0.5)
-            cY = int(M["m01"] / M["m00"] + 0.5)
-            centroid = (cX, cY)
-            best_match = np.subtract(centroid, target)
+            best_match = np.subtract(best_match, target)
             error = (best_match, best_area, best_radius)
             return (error)
         else:
             return 0, 0, -1, -1
 
+    ## @brief WellPositionEvaluator::evaluateCoarseToFine(self, pyramid, target) finds the well with a hough transform on a downsampled pyramid level,
+    ## and refines its centre and radius on the full resolution image.
+    ## @param pyramid ImagePyramid of the 2d grayscale image
+    ## @param target contains the target coordinates (topleft pixel is 0,0)
+    ## @return (offset, area, radius) as evaluate, or None if the coarse search found no circle
+    def evaluateCoarseToFine(self, pyramid, target):
+        small = pyramid.level(max(0, int(round(math.log2(self.downscale)))))
+        scale = pyramid.shape[1] / small.shape[1]
+        img = cv2.normalize(small, None, 0, 255, cv2.NORM_MINMAX)
+        img = cv2.medianBlur(img, 3)
+        img = self.clahe.apply(img)
+        ## The accumulator votes scale with the circumference, so scale the threshold too.
+        ## At low resolution the largest circle is often a spurious one around the edge, so only the strongest circle is needed.
+        circles = cv2.HoughCircles(image=img, method=cv2.HOUGH_GRADIENT, dp=1, param1=40, param2=max(10, int(80/scale)),
+                                   minDist=max(img.shape), minRadius=int(self.circle_minRadius/scale),
+                                   maxRadius=int(math.ceil(self.circle_maxRadius/scale)))
+        if circles is None:
+            return None
+        x, y, r = circles[0, 0] * scale
+        refined = self.refineCircle(pyramid.image, x, y, r, int(math.ceil(3*scale)))
+        if refined is not None:
+            x, y, r = refined
+        best_match = np.subtract((int(round(x)), int(round(y))), target)
+        return (best_match, int(math.pi * r * r), int(round(r)))
+
+    ## @brief WellPositionEvaluator::refineCircle(self, image, x, y, r, band) refines a circle by locating the well edge along rays across it,
+    ## and fitting a circle to the edge points (Kasa least squares fit, with one pass of outlier rejection).
+    ## @param image full resolution 2d grayscale image
+    ## @param x, y, r coarse circle centre and radius
+    ## @param band half width of the annulus searched around the coarse radius [px]
+    ## @return refined (x, y, r), or None if too few edge points were found or the fit left the annulus
+    def refineCircle(self, image, x, y, r, band):
+        radii = r + np.arange(-band, band + 1, dtype=np.float32)
+        mapX = x + self.rayCos[:, None] * radii[None, :]
+        mapY = y + self.raySin[:, None] * radii[None, :]
+        valid = ((mapX.min(axis=1) >= 0) & (mapX.max(axis=1) <= image.shape[1] - 1) &
+                 (mapY.min(axis=1) >= 0) & (mapY.max(axis=1) <= image.shape[0] - 1))
+        if np.count_nonzero(valid) < self.rays // 4:
+            return None
+
+        ## Sample the annulus in polar coordinates, one row per ray, and smooth along the rays
+        polar = cv2.remap(image, mapX[valid], mapY[valid], cv2.INTER_LINEAR).astype(np.float32)
+        polar = cv2.GaussianBlur(polar, (5, 1), 0)
+        gradient = np.diff(polar, axis=1)
+
+        ## The edge polarity follows from the mean profile, then take the strongest edge of that polarity on each ray
+        meanGradient = gradient.mean(axis=0)
+        gradient *= np.sign(meanGradient[np.argmax(np.abs(meanGradient))])
+        index = np.argmax(gradient, axis=1)
+        rows = np.arange(index.size)
+        strength = gradient[rows, index]
+        inner = (index > 0) & (index < gradient.shape[1] - 1)
+        left = gradient[rows, np.maximum(index - 1, 0)]
+        right = gradient[rows, np.minimum(index + 1, gradient.shape[1] - 1)]
+        denominator = left - 2*strength + right
+        delta = np.where(inner & (denominator < 0), 0.5 * (left - right) / np.where(denominator < 0, denominator, -1), 0)
+        rho = radii[index] + 0.5 + delta
+        keep = strength > 0.5 * np.median(strength)
+        if np.count_nonzero(keep) < self.rays // 4:
+            return None
+        pointsX = x + self.rayCos[valid][keep] * rho[keep]
+        pointsY = y + self.raySin[valid][keep] * rho[keep]
+
+        fit = fitCircle(pointsX, pointsY)
+        residual = np.abs(np.hypot(pointsX - fit[0], pointsY - fit[1]) - fit[2])
+        inliers = residual <= max(1.0, 3 * np.median(residual))
+        if np.count_nonzero(inliers) >= self.rays // 4:
+            fit = fitCircle(pointsX[inliers], pointsY[inliers])
+        if np.hypot(fit[0] - x, fit[1] - y) > band or abs(fit[2] - r) > band:
+            return None
+        return fit
+
     ## @brief WellPositionEvaluator::wait_ms(self, milliseconds) is a delay function.
     ## @param milliseconds is the number of milliseconds to wait.
     def wait_ms(self, milliseconds):
@@ -246,3 +455,89 @@ class WellPositionEvaluator(QThread):
         self.stop()
         self.exit(0)
         return
+
+## @brief class WellTracker estimates the well offset on repeat visits by phase correlation with a reference patch of the same well.
+## On the first successful lock of a well a patch around it is stored. On later visits the shift between the reference
+## and the current image is found with windowed FFT phase correlation (sub-pixel), which is much faster than a hough search
+## and gives smoother corrections. When the correlation peak is weak, the caller falls back to the WellPositionEvaluator.
+class WellTracker:
+    def __init__(self, **kwargs):
+        # Minimal phase correlation peak response to trust the shift
+        self.minResponse = kwargs['minResponse'] if 'minResponse' in kwargs else 0.2
+
+        # Patch size around the well, relative to the well diameter
+        self.patchScale = kwargs['patchScale'] if 'patchScale' in kwargs else 1.2
+
+        # Largest shift [px] accepted, relative to the well radius
+        self.maxShift = kwargs['maxShift'] if 'maxShift' in kwargs else 0.5
+
+        self.references = {} # well id -> reference dict
+        self.windows = {}     # patch size -> Hanning window
+        self.tracked = 0
+        self.rejected = 0
+
+    ## @brief WellTracker::has(self, wellId) tells if a reference patch of the well is stored.
+    def has(self, wellId):
+        return wellId in self.references
+
+    ## @brief WellTracker::store(self, wellId, source, target, error) stores the reference patch of a well.
+    ## @param wellId identifies the well, e.g. its name in batch.ini
+    ## @param source 2d grayscale image, or ImagePyramid of it
+    ## @param target contains the target coordinates the error is relative to
+    ## @param error is the (offset, area, radius) evaluation of the well in source
+    def store(self, wellId, source, target, error):
+        image = ImagePyramid.of(source).image
+        offset, area, radius = error
+        centre = (target[0] + offset[0], target[1] + offset[1])
+        ## Square patch around the well, with a size the DFT handles efficiently
+        width = height = min(int(2 * self.patchScale * radius), image.shape[0], image.shape[1])
+        while cv2.getOptimalDFTSize(width) != width:
+            width = height = width - 1
+        left = int(min(max(centre[0] - width // 2, 0), image.shape[1] - width))
+        top = int(min(max(centre[1] - height // 2, 0), image.shape[0] - height))
+        self.references[wellId] = {'rect': (left, top, width, height),
+                                   'patch': image[top:top + height, left:left + width].astype(np.float32),
+                                   'offset': np.array(offset, dtype=np.float64), 'area': area, 'radius': radius}
+        return
+
+    ## @brief WellTracker::forget(self, wellId=None) removes the reference of a well, or of all wells.
+    def forget(self, wellId=None):
+        if wellId is None:
+            self.references.clear()
+        else:
+            self.references.pop(wellId, None)
+        return
+
+    ## @brief WellTracker::track(self, wellId, source) estimates the well offset relative to the target by phase correlation with the reference.
+    ## @param wellId identifies the well
+    ## @param source 2d grayscale image, or ImagePyramid of it
+    ## @return (offset, area, radius) as WellPositionEvaluator::evaluate, with a sub-pixel offset,
+    ## or None if there is no reference, the correlation peak is weak, or the shift is implausibly large
+    def track(self, wellId, source):
+        reference = self.references.get(wellId)
+        if reference is None:
+            return None
+        image = ImagePyramid.of(source).image
+        left, top, width, height = reference['rect']
+        if image.shape[1] < left + width or image.shape[0] < top + height:
+            return None
+        patch = image[top:top + height, left:left + width].astype(np.float32)
+        window = self.windows.get((width, height))
+        if window is None:
+            window = self.windows[(width, height)] = cv2.createHanningWindow((width, height), cv2.CV_32F)
+        shift, response = cv2.phaseCorrelate(reference['patch'], patch, window)
+        if response < self.minResponse or math.hypot(*shift) > self.maxShift * reference['radius']:
+            self.rejected += 1
+            return None
+        self.tracked += 1
+        return (reference['offset'] + shift, reference['area'], reference['radius'])
+
+## @brief fitCircle(x, y) fits a circle through points with the algebraic (Kasa) least squares method.
+## @param x, y point coordinates
+## @return (centre x, centre y, radius)
+def fitCircle(x, y):
+    A = np.stack([x, y, np.ones_like(x)], axis=1).astype(np.float64)
+    b = -(x.astype(np.float64)**2 + y.astype(np.float64)**2)
+    (a, c, d), _, _, _ = np.linalg.lstsq(A, b, rcond=None)
+    cx, cy = -a/2, -c/2
+    return cx, cy, math.sqrt(max(cx*cx + cy*cy - d, 0.0))
@@ -0,0 +1,95 @@
+"""@package docstring
+Lazily built image pyramid, shared by all consumers of a camera frame.
+
+Each pyramid level and each resized copy is computed at most once, on first request, and
+returned read-only so the consumers of a camera frame can share it: the ImageProcessor scales
+the preview from it, and the well positioning gets the pyramid of that same preview frame.
+Consumers that want to annotate a level must copy it first.
+"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import threading
+import cv2
+
+## @brief ImagePyramid holds a frame and its lazily computed pyrDown levels and resized copies.
+class ImagePyramid:
+
+    ## @brief ImagePyramid::__init__(self, image, handle) wraps a frame, no levels are computed yet.
+    ## @param image is the full resolution frame.
+    ## @param handle is the FrameHandle of the frame if it is a slot of a FrameRing, consumers that keep the pyramid retain and release it.
+    def __init__(self, image, handle=None):
+        self.image = readOnly(image)
+        self.handle = handle
+        self.levels = [self.image]
+        self.sizes = {}
+        self.children = {}
+        self.lock = threading.RLock()
+
+    ## @brief ImagePyramid::of(image) returns image if it already is a pyramid, otherwise a new pyramid of image.
+    @staticmethod
+    def of(image):
+        return image if isinstance(image, ImagePyramid) else ImagePyramid(image)
+
+    ## @brief ImagePyramid::retain(self) keeps the frame slot from being reused, for a consumer that keeps the pyramid after the capture signal.
+    ## @return True if the frame is valid, False if its slot was already reused.
+    def retain(self):
+        return self.handle is None or self.handle.retain() is not None
+
+    ## @brief ImagePyramid::release(self) releases the frame slot retained by retain().
+    def release(self):
+        if self.handle is not None:
+            self.handle.release()
+        return
+
+    ## @brief ImagePyramid::owned(self, image) returns image, or a copy if it is the frame slot itself, for results that outlive the frame.
+    def owned(self, image):
+        return image.copy() if self.handle is not None and image is self.image else image
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    ## @brief ImagePyramid::size(self) is the (width, height) of the full resolution frame.
+    def size(self):
+        return (self.image.shape[1], self.image.shape[0])
+
+    ## @brief ImagePyramid::level(self, n) returns pyramid level n, level 0 is the frame itself, each next level halves the size.
+    def level(self, n):
+        with self.lock:
+            while len(self.levels) <= n:
+                self.levels.append(readOnly(cv2.pyrDown(self.levels[-1])))
+            return self.levels[n]
+
+    ## @brief ImagePyramid::resized(self, size) returns the frame resized to size.
+    ## The copy is made from the coarsest level computed so far that is still at least as large as size,
+    ## no pyramid levels are built for it, since a single linear resize is cheaper than pyrDown.
+    ## @param size is the (width, height) of the resized frame.
+    def resized(self, size):
+        size = (int(size[0]), int(size[1]))
+        if size == self.size():
+            return self.image
+        with self.lock:
+            if size not in self.sizes:
+                source = self.image
+                for level in self.levels[1:]:
+                    if level.shape[1] < size[0] or level.shape[0] < size[1]:
+                        break
+                    source = level
+                self.sizes[size] = source if source.shape[1::-1] == size else readOnly(cv2.resize(source, size))
+            return self.sizes[size]
+
+    ## @brief ImagePyramid::scaled(self, size) returns the pyramid of the frame resized to size, shared by all consumers at that size.
+    ## Its level 0 is the copy made by resized(), so it does not hold the frame slot, its levels are built on demand.
+    ## @param size is the (width, height) of the resized frame.
+    def scaled(self, size):
+        size = (int(size[0]), int(size[1]))
+        with self.lock:
+            if size not in self.children:
+                self.children[size] = ImagePyramid(self.owned(self.resized(size)))
+            return self.children[size]
+
+def readOnly(image):
+    """Read-only view of image, the original stays writeable for its owner."""
+    view = image.view()
+    view.flags.writeable = False
+    return view
@@ -38,6 +38,28 @@ class ImageSegmenter(Manipulator):
         # Debug plot
         self.debugPlot = kwargs['debugPlot'] if 'debugPlot' in kwargs else False
 
+        # Tracking mode, use the grid found in previous frames as a prior
+        self.tracking = kwargs['tracking'] if 'tracking' in kwargs else False
+
+        # Tracking search range around each known grid line, as a fraction of the grid pitch.
+        # Beyond half a pitch a line can lock onto its neighbour; a tenth allows 14 px of drift per
+        # frame at a 144 px pitch (about three wells over 480 rows), and scales with the zoom.
+        self.trackRange = kwargs['trackRange'] if 'trackRange' in kwargs else 0.1
+
+        # Minimal normalized correlation for a grid line to count as found
+        self.minTrackScore = kwargs['minTrackScore'] if 'minTrackScore' in kwargs else 0.7
+
+        # Fall back to full detection when the mean line correlation (trackingScore) drops below this
+        self.minQualityFrac = kwargs['minQualityFrac'] if 'minQualityFrac' in kwargs else 0.8
+
+        # Number of tracked frames after which a full detection is forced
+        self.trackRefresh = kwargs['trackRefresh'] if 'trackRefresh' in kwargs else 100
+
+        # Row step used for the row averages while tracking
+        self.trackRowStep = kwargs['trackRowStep'] if 'trackRowStep' in kwargs else 8
+
+        self.resetTracking()
+
         if self.debugPlot:
             self.fig, (self.ax1, self.ax2) = plt.subplots(2,1)
             self.graph1 = None
@@ -56,53 +78,68 @@ class ImageSegmenter(Manipulator):
             self.startTimer()                
             self.image = Image
             self.ROIs = None
-            self.imageQuality = None
+            self.imageQuality = None  # measured by a full detection only, None for a tracked frame
+            self.trackingScore = None  # mean line correlation of a tracked frame, not comparable with imageQuality
 
             # Blur the image, beware this is very slow
             self.image = self.image if self.ksize < 1 else cv2.medianBlur(self.image, self.ksize)
 
-            # Find grid pattern along row and column averages
-            row_av = cv2.reduce(self.image, 0, cv2.REDUCE_AVG, dtype=cv2.CV_32S).flatten('F')
-            row_seg_list, row_mask, smooth_row_av = find1DGrid(row_av, int(self.sizeFrac*row_av.size))
-            col_av = cv2.reduce(self.image, 1, cv2.REDUCE_AVG, dtype=cv2.CV_32S).flatten('F')
-            col_seg_list, col_mask, smooth_col_av = find1DGrid(col_av, int(self.sizeFrac*col_av.size))
-
-            # Create ROI list and annotate image
-            list_width = len(row_seg_list)
-            list_length = len(col_seg_list)
-            self.ROIs = np.zeros([list_width*list_length,4], dtype=np.uint16)
-            self.ROI_total_area = 0
-            for i, x in enumerate(row_seg_list):
-                for j, y in enumerate(col_seg_list):
-                    # ROI: (left,top,width,height)
-                    self.ROIs[i+j*list_width] = [x[0],y[0],x[1],y[1]]
-                    cv2.rectangle(self.image, (x[0],y[0]), (x[0]+x[1],y[0]+y[1]), (0, 255, 0), 2)
-                    self.ROI_total_area += x[1]*y[1]
-
-            # Compute metrics from grid pattern
-            # Rationale: parameterize edge histogram by variance to amplitude (0-bin) ratio 
-            col_stuff = np.diff(smooth_col_av[~col_mask]) # slice masked areas
-            col_stuff = col_stuff[25:-25]  # slice edge effects
-            row_stuff = np.diff(smooth_row_av[~row_mask]) # slice masked areas
-            row_stuff = row_stuff[25:-25]  # slice edge effects
-            self.imageQuality = np.sqrt( np.var(col_stuff) # / col_stuff[np.abs(col_stuff) < .5].size
-                                         + np.var(row_stuff) ) # / row_stuff[np.abs(row_stuff) < .5].size )
-            # Rationale: sharp edges result in ROI increase
-            self.imageQuality *= (self.ROI_total_area/np.prod(self.image.shape[0:2]))             
-                
-            # Plot curves
-            if self.debugPlot:
-                col_hist, bin_edges = np.histogram(col_stuff, bins=np.arange(-5,5,.1), density=True)
-                
-                # Draw grid lines
-                self.ax1.clear()
-                self.graph1 = self.ax1.plot(row_stuff)[0]  # (col_hist)[0]
-                self.ax2.clear()
-                self.graph2 = self.ax2.plot(col_stuff)[0]  # smooth_col_av)[0]
-
-                # We need to draw *and* flush
-                self.fig.canvas.draw()
-                self.fig.canvas.flush_events()
+            # Follow the grid from the previous frame, or find it from scratch
+            if not (self.tracking and self.trackGrid()):
+                self.detectGrid()
+
+            # Finalize
+            self.stopTimer()
+            self.signals.finished.emit()                
+
+        except Exception as err:
+            exc = traceback.format_exception(type(err), err, err.__traceback__, chain=False)
+            self.signals.error.emit(exc)
+            self.signals.message.emit('E: {} exception: {}'.format(self.name, err))
+
+        return self.image
+
+    def detectGrid(self):
+        """Find the grid along the full row and column averages, and store it as tracking prior."""
+        # Find grid pattern along row and column averages
+        row_av = cv2.reduce(self.image, 0, cv2.REDUCE_AVG, dtype=cv2.CV_32S).flatten('F')
+        row_seg_list, row_mask, smooth_row_av = find1DGrid(row_av, int(self.sizeFrac*row_av.size))
+        col_av = cv2.reduce(self.image, 1, cv2.REDUCE_AVG, dtype=cv2.CV_32S).flatten('F')
+        col_seg_list, col_mask, smooth_col_av = find1DGrid(col_av, int(self.sizeFrac*col_av.size))
+
+        # Create ROI list and annotate image
+        self.setROIs(row_seg_list, col_seg_list)
+
+        # Compute metrics from grid pattern
+        # Rationale: parameterize edge histogram by variance to amplitude (0-bin) ratio 
+        col_stuff = np.diff(smooth_col_av[~col_mask]) # slice masked areas
+        col_stuff = col_stuff[25:-25]  # slice edge effects
+        row_stuff = np.diff(smooth_row_av[~row_mask]) # slice masked areas
+        row_stuff = row_stuff[25:-25]  # slice edge effects
+        self.imageQuality = np.sqrt( np.var(col_stuff) # / col_stuff[np.abs(col_stuff) < .5].size
+                                     + np.var(row_stuff) ) # / row_stuff[np.abs(row_stuff) < .5].size )
+        # Rationale: sharp edges result in ROI increase
+        self.imageQuality *= (self.ROI_total_area/np.prod(self.image.shape[0:2]))             
+
+        # Keep grid lines and their profiles as prior for the next frames
+        if self.tracking:
+            self.rowPrior = gridPrior(row_av, row_seg_list, int(self.sizeFrac*row_av.size))
+            self.colPrior = gridPrior(col_av, col_seg_list, int(self.sizeFrac*col_av.size))
+            self.trackedFrames = 0
+            
+        # Plot curves
+        if self.debugPlot:
+            col_hist, bin_edges = np.histogram(col_stuff, bins=np.arange(-5,5,.1), density=True)
+            
+            # Draw grid lines
+            self.ax1.clear()
+            self.graph1 = self.ax1.plot(row_stuff)[0]  # (col_hist)[0]
+            self.ax2.clear()
+            self.graph2 = self.ax2.plot(col_stuff)[0]  # smooth_col_av)[0]
+
+            # We need to draw *and* flush
+            self.fig.canvas.draw()
+            self.fig.canvas.flush_events()
 
 ### This way of plotting is probably faster, but right now can't get it to work with clearing as well                    
 ##                    if (self.graph1 is None):
@@ -117,28 +154,97 @@ class ImageSegmenter(Manipulator):
 ##                    self.ax2.relim()
 ##                    self.ax2.autoscale_view()
 
-            # Finalize
-            self.stopTimer()
-            self.signals.finished.emit()                
+    def trackGrid(self):
+        """Search each known grid line in a narrow window around its previous position.
 
-        except Exception as err:
-            exc = traceback.format_exception(type(err), err, err.__traceback__, chain=False)
-            self.signals.error.emit(exc)
-            self.signals.message.emit('E: {} exception: {}'.format(self.name, err))
+            \return False if there is no prior, a line went missing or the image quality dropped,
+                     in which case a full detection is needed
+        """
+        if self.rowPrior is None or self.colPrior is None:
+            return False
+        if self.trackRefresh > 0 and self.trackedFrames >= self.trackRefresh:
+            return False
+        if self.image.shape[0:2] != self.priorShape:
+            return False
 
-        return self.image
+        # Vertical grid lines are found in the row averages, which may skip rows,
+        # horizontal ones in the column averages
+        row_av = cv2.reduce(self.image[::max(1, self.trackRowStep), :], 0, cv2.REDUCE_AVG, dtype=cv2.CV_32F).flatten('F')
+        col_av = cv2.reduce(self.image, 1, cv2.REDUCE_AVG, dtype=cv2.CV_32F).flatten('F')
+        row_lines = trackLines(row_av, self.rowPrior, max(1, int(self.trackRange*self.rowPrior['pitch'])))
+        col_lines = trackLines(col_av, self.colPrior, max(1, int(self.trackRange*self.colPrior['pitch'])))
+        scores = np.concatenate([row_lines[1], col_lines[1]])
+        if scores.size == 0 or scores.min() < self.minTrackScore:
+            return False
+
+        # Rationale: the grid is about as sharp as in the reference frame when the line profiles match
+        score = float(scores.mean())
+        if score < self.minQualityFrac:
+            return False
+
+        row_seg_list = linesToSegments(row_lines[0], self.image.shape[1])
+        col_seg_list = linesToSegments(col_lines[0], self.image.shape[0])
+        if row_seg_list is None or col_seg_list is None:
+            return False
+
+        # Accept, and move the prior along with the grid
+        self.rowPrior['lines'] = row_lines[0]
+        self.colPrior['lines'] = col_lines[0]
+        self.trackedFrames += 1
+        self.setROIs(row_seg_list, col_seg_list)
+        self.trackingScore = score
+        return True
+
+    def setROIs(self, row_seg_list, col_seg_list):
+        """Create ROI list from the grid segments and annotate image."""
+        list_width = len(row_seg_list)
+        list_length = len(col_seg_list)
+        if not self.image.flags.writeable:
+            # shared pyramid level, annotate a copy
+            self.image = self.image.copy()
+        self.ROIs = np.zeros([list_width*list_length,4], dtype=np.uint16)
+        self.ROI_total_area = 0
+        for i, x in enumerate(row_seg_list):
+            for j, y in enumerate(col_seg_list):
+                # ROI: (left,top,width,height)
+                self.ROIs[i+j*list_width] = [x[0],y[0],x[1],y[1]]
+                cv2.rectangle(self.image, (x[0],y[0]), (x[0]+x[1],y[0]+y[1]), (0, 255, 0), 2)
+                self.ROI_total_area += x[1]*y[1]
+        self.priorShape = self.image.shape[0:2]
+
+    @Slot()
+    def resetTracking(self):
+        """Forget the grid prior, the next frame gets a full detection."""
+        self.rowPrior = None
+        self.colPrior = None
+        self.trackedFrames = 0
+        self.priorShape = None
+
+    @Slot(bool)
+    def setTracking(self, val):
+        self.tracking = val
+        self.resetTracking()
 
 def moving_average(x, N=5):
+    """Moving average along the last axis, so a 2-D array is treated as a stack of profiles."""
     if N > 1 and (N & 1) == 1:
-        x = np.pad(x, pad_width=(N // 2, N // 2),
+        pad_width = [(0, 0)] * (x.ndim - 1) + [(N // 2, N // 2)]
+        x = np.pad(x, pad_width=pad_width,
                    mode='constant')  # Assuming N is odd
-        cumsum = np.cumsum(np.insert(x, 0, 0))
-        return (cumsum[N:] - cumsum[:-N]) / float(N)
+        cumsum = np.cumsum(np.insert(x, 0, 0, axis=-1), axis=-1)
+        return (cumsum[..., N:] - cumsum[..., :-N]) / float(N)
     else:
         raise ValueError("Moving average size must be odd and greater than 1.")
 
 
-def find1DGrid(data, N):    
+def find1DGrid(data, N):
+    """Find the grid segments in a 1-D profile, or in each row of a 2-D stack of profiles.
+
+        \param data profile, or 2-D array with one profile per row
+        \param N findGrid parameter, i.e. grid line smoothing kernel size
+        \return (segmentList, mask_data, smooth_data), where segmentList is a list of
+                 (start, length) tuples, or a list of such lists for a stack of profiles
+    """
     if N <= 1:
         raise ValueError('findGrid parameter <= 1')
     if (N & 1) != 1:  # enforce N to be odd
@@ -148,30 +254,123 @@ def find1DGrid(data, N):
     
     # High-pass filter, to suppress uneven illumination
     data = np.abs(data - moving_average(data, int(3*N)))
-    data[:N] = 0 # cut off MA artifacts
-    data[-N:] = 0 # cut off MA artifacts, why not -(N-1)/2?? ??
+    data[..., :N] = 0 # cut off MA artifacts
+    data[..., -N:] = 0 # cut off MA artifacts, why not -(N-1)/2?? ??
     smooth_data = moving_average(data, gridSmoothKsize)
-    smooth_data = smooth_data - np.mean(smooth_data)
-    mask_data = np.zeros(data.shape, dtype='bool')  # mask grid lines
-    mask_data[np.where(smooth_data < 0)[0]] = True
-    
+    smooth_data = smooth_data - np.mean(smooth_data, axis=-1, keepdims=True)
+    mask_data = smooth_data < 0  # mask grid lines
+
     # Now filter mask_data based on segment length and suppress too short segments
-    prev_x = False
-    segmentLength = 0
-    segmentList = []
-    for index, x in enumerate(mask_data):
-        if x:  # segment
-            segmentLength += 1
-        elif x != prev_x:  # falling edge
-            if segmentLength < gridMinSegmentLength:  # suppress short segments
-                mask_data[index - segmentLength: index] = False
-                # print(diff(data[index - segmentLength:index]))
-            else:
-                segmentList.append((index - segmentLength, segmentLength))  # Save segment start and length
-            segmentLength = 0  # reset counter
-        prev_x = x
+    starts, lengths = segmentRuns(mask_data)
+    short = lengths < gridMinSegmentLength
+    suppressRuns(mask_data, starts[short], lengths[short])
+    starts, lengths = starts[~short], lengths[~short]
+
+    # Save segment start and length
+    cols = mask_data.shape[-1]
+    segmentList = list(zip((starts % cols).tolist(), lengths.tolist()))
+    if mask_data.ndim > 1:
+        rows = starts // cols
+        bounds = np.searchsorted(rows, np.arange(mask_data.shape[0] + 1))
+        segmentList = [segmentList[bounds[i]:bounds[i + 1]] for i in range(mask_data.shape[0])]
 
     return (segmentList, mask_data, smooth_data)
 
 
-    
+def segmentRuns(mask):
+    """Find the runs of True in each row of mask that are terminated by a falling edge.
+    A run that lasts until the end of its row is not terminated and hence not reported.
+
+        \param mask 1-D or 2-D boolean array
+        \return (starts, lengths), starts as flat indices into mask, in row-major order
+    """
+    mask = np.atleast_2d(mask)
+    edges = np.diff(mask.view(np.int8), axis=-1, prepend=0)
+    rising = np.flatnonzero(edges == 1)
+    falling = np.flatnonzero(edges == -1)
+
+    # Runs alternate with gaps, so each falling edge belongs to the last rising edge before it
+    starts = rising[np.searchsorted(rising, falling) - 1]
+    return starts, falling - starts
+
+
+def suppressRuns(mask, starts, lengths):
+    """Clear the runs given by flat start indices and lengths in mask, in place."""
+    if starts.size == 0:
+        return
+    flat = mask.reshape(-1)
+    toggle = np.zeros(flat.size + 1, dtype=np.int32)
+    np.add.at(toggle, starts, 1)
+    np.add.at(toggle, starts + lengths, -1)
+    flat[np.cumsum(toggle[:-1]) > 0] = False
+
+
+def gridPrior(data, segmentList, N):
+    """Store the grid line positions of segmentList with the profile around each line as template.
+
+        \param data profile in which the segments were found
+        \param segmentList list of (start, length) segments
+        \param N findGrid parameter, the template half width is 4N
+        \return prior dict, or None if there are no segments
+    """
+    if not segmentList:
+        return None
+    # The high-pass and smoothing of find1DGrid put the segment ends about 2N before the grid line,
+    # a template of 2N would only see the flat well bottom
+    halfWidth = 4*max(N, 1)
+    starts = np.array([x[0] for x in segmentList])
+    pitch = float(np.median(np.diff(starts))) if starts.size > 1 else float(segmentList[0][1])
+    lines = np.array([[x[0], x[0] + x[1]] for x in segmentList]).reshape(-1)
+    index = lines[:, np.newaxis] + np.arange(0, 2*halfWidth + 1)
+    data = np.pad(data, (halfWidth, halfWidth + 1), mode='edge')  # lines near the image border
+    templates = data[index].astype(np.float32)
+
+    # Segment ends in a flat profile, e.g. cut off by the moving average at the image border, cannot be matched
+    trackable = templates.std(axis=1) > 1.0
+    return {'lines': lines, 'templates': templates, 'trackable': trackable, 'halfWidth': halfWidth, 'pitch': pitch}
+
+
+def trackLines(data, prior, searchRange):
+    """Find each grid line of prior within +/- searchRange of its previous position,
+    by normalized cross-correlation of the line templates with profile data.
+
+        \param data profile along the axis of the grid lines
+        \param prior grid prior as created by gridPrior
+        \param searchRange search radius [px]
+        \return (lines, scores), with scores of the trackable lines only
+    """
+    halfWidth = prior['halfWidth']
+    trackable = prior['trackable']
+    lines = prior['lines'].copy()
+    if not trackable.any():
+        return lines, np.zeros(0, dtype=np.float32)
+
+    # Search windows around the trackable lines, edge padded near the image border,
+    # one more at the end for a segment that ends at the border
+    data = np.pad(data.astype(np.float32), (halfWidth + searchRange, halfWidth + searchRange + 1), mode='edge')
+    windows = np.lib.stride_tricks.sliding_window_view(data, 2*(halfWidth + searchRange) + 1)[lines[trackable]]
+    candidates = np.lib.stride_tricks.sliding_window_view(windows, 2*halfWidth + 1, axis=1)
+
+    # Normalized cross-correlation of every candidate position with the template
+    templates = prior['templates'][trackable]
+    templates = templates - templates.mean(axis=1, keepdims=True)
+    candidates = candidates - candidates.mean(axis=2, keepdims=True)
+    norm = np.sqrt((candidates**2).sum(axis=2) * (templates**2).sum(axis=1)[:, np.newaxis])
+    ncc = np.einsum('ijk,ik->ij', candidates, templates) / np.maximum(norm, 1e-6)
+    best = ncc.argmax(axis=1)
+    lines[trackable] += best - searchRange
+
+    # Untrackable lines move along with the rest of the grid
+    lines[~trackable] += int(np.median(best - searchRange))
+    return lines, ncc[np.arange(best.size), best]
+
+
+def linesToSegments(lines, size):
+    """Convert a flat array of (start, end) line pairs back to a list of (start, length) segments.
+
+        \return segment list, or None if the lines are out of order or leave the image
+    """
+    starts, ends = lines[0::2], lines[1::2]
+    if np.any(ends <= starts) or np.any(starts[1:] < ends[:-1]) or starts[0] < 0 or ends[-1] > size:
+        return None
+    return list(zip(starts.tolist(), (ends - starts).tolist()))
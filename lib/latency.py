@@ -0,0 +1,156 @@
+"""@package docstring
+Per-stage latency histograms.
+
+Durations are recorded in nanoseconds (time.perf_counter_ns) into log-linear buckets with a
+relative resolution of 1/16. Every histogram has a single writer (the thread running its stage),
+so recording takes no lock; readers merge the histograms of a stage into a snapshot with
+count, max, mean and the p50/p95/p99 percentiles in milliseconds. Snapshots are pulled on
+demand with snapshot(), or written periodically to a JSON file by a LatencyWriter.
+"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+import time
+
+SUB_BITS = 4
+SUB = 1 << SUB_BITS
+BUCKETS = SUB * 64
+
+## @brief bucketIndex(ns) maps a duration [ns] to its histogram bucket.
+def bucketIndex(ns):
+    if ns < 2 * SUB:
+        return max(0, ns)
+    e = ns.bit_length() - (SUB_BITS + 1)
+    return min(BUCKETS - 1, (e + 1) * SUB + (ns >> e) - SUB)
+
+## @brief bucketBounds(index) is the [lower, upper) duration range [ns] of a histogram bucket.
+def bucketBounds(index):
+    if index < 2 * SUB:
+        return index, index + 1
+    e = index // SUB - 1
+    m = index % SUB + SUB
+    return m << e, (m + 1) << e
+
+## @brief LatencyHistogram records the durations of one stage instance, it must be written by one thread only.
+class LatencyHistogram:
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    ## @brief LatencyHistogram::record(self, ns) adds a duration [ns].
+    def record(self, ns):
+        self.counts[bucketIndex(ns)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def reset(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+## @brief LatencyRegistry keeps the histograms of all stages, the histograms of stages with the same name are merged in snapshots.
+class LatencyRegistry:
+    def __init__(self):
+        self.histograms = []
+        self.lock = threading.Lock()  # guards the list, not the recording
+
+    ## @brief LatencyRegistry::histogram(self, name) creates and registers a new histogram for a stage instance.
+    def histogram(self, name):
+        histogram = LatencyHistogram(name)
+        with self.lock:
+            self.histograms.append(histogram)
+        return histogram
+
+    ## @brief LatencyRegistry::snapshot(self) summarises the histograms per stage name.
+    ## @return dict per stage name with count, and max, mean, p50, p95 and p99 in [ms].
+    def snapshot(self):
+        with self.lock:
+            histograms = list(self.histograms)
+        merged = {}
+        for histogram in histograms:
+            counts, count, total, maximum = list(histogram.counts), histogram.count, histogram.total, histogram.max
+            if histogram.name in merged:
+                m = merged[histogram.name]
+                m['counts'] = [a + b for a, b in zip(m['counts'], counts)]
+                m['count'] += count
+                m['total'] += total
+                m['max'] = max(m['max'], maximum)
+            else:
+                merged[histogram.name] = {'counts': counts, 'count': count, 'total': total, 'max': maximum}
+        return {name: summarise(m['counts'], m['count'], m['total'], m['max']) for name, m in merged.items()}
+
+    ## @brief LatencyRegistry::reset(self) clears all histograms.
+    def reset(self):
+        with self.lock:
+            for histogram in self.histograms:
+                histogram.reset()
+        return
+
+    ## @brief LatencyRegistry::write(self, path) writes a snapshot as JSON, replacing path atomically.
+    def write(self, path):
+        temp = path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'time': time.time(), 'stages': self.snapshot()}, f, indent=2)
+        os.replace(temp, path)
+        return
+
+def summarise(counts, count, total, maximum):
+    summary = {'count': count, 'max': maximum / 1e6, 'mean': total / count / 1e6 if count else 0.0}
+    targets = [('p50', 0.50), ('p95', 0.95), ('p99', 0.99)]
+    cumulative = 0
+    for index, n in enumerate(counts):
+        if n == 0:
+            continue
+        cumulative += n
+        while targets and cumulative >= targets[0][1] * count:
+            lower, upper = bucketBounds(index)
+            summary[targets[0][0]] = min((lower + upper) / 2, maximum) / 1e6
+            targets.pop(0)
+        if not targets:
+            break
+    for name, q in targets:
+        summary[name] = 0.0
+    return summary
+
+## @brief registry is the default latency registry, used by all Manipulator stages.
+registry = LatencyRegistry()
+
+## @brief histogram(name) creates a histogram in the default registry.
+def histogram(name):
+    return registry.histogram(name)
+
+## @brief snapshot() summarises the default registry.
+def snapshot():
+    return registry.snapshot()
+
+## @brief LatencyWriter periodically writes snapshots of a registry to a JSON file.
+class LatencyWriter(threading.Thread):
+    """Latency writer
+
+    :param path: JSON file to (over)write
+    :param interval: time between snapshots [s]
+    :param registry: registry to write (default the module registry)
+
+    """
+    def __init__(self, path, interval=60.0, **kwargs):
+        super().__init__(name='latency writer', daemon=True)
+        self.path = path
+        self.interval = interval
+        self.registry = kwargs['registry'] if 'registry' in kwargs else registry
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.registry.write(self.path)
+        return
+
+    ## @brief LatencyWriter::close(self) stops the writer after writing a final snapshot.
+    def close(self):
+        self.stopped.set()
+        self.registry.write(self.path)
+        return
@@ -0,0 +1,151 @@
+"""@package docstring
+Rate limited log of the messages of all classes.
+
+Every class emits its log messages as "ClassName: text" through its mes signal, often from the
+serial reader, camera or batch threads. Appending each message to the log window directly keeps
+the GUI thread busy during homing and move loops, and the positioning code waits in that event
+loop. The LogBuffer stores the messages as records (time, source, level, payload) in a fixed
+size ring buffer, from any thread, and coalesces a message that repeats the previous one. The
+MainWindow drains it at a fixed rate, appending the new records to the log window in one go
+and skipping the oldest when there are too many. All messages also go to a rotating log file.
+"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import collections
+import logging
+import logging.handlers
+import threading
+import time
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+## @brief messageLevel(payload) guesses the level of a message from the way the classes write them.
+def messageLevel(payload):
+    text = payload.lstrip()
+    upper = text[:16].upper()
+    if text.startswith('!!') or upper.startswith('ERROR') or upper.startswith('EXCEPTION'):
+        return ERROR
+    if upper.startswith('WARNING'):
+        return WARNING
+    if upper.startswith('DEBUG'):
+        return DEBUG
+    return INFO
+
+## @brief LogRecord is a message in the ring buffer, repeated messages are counted in one record.
+class LogRecord:
+    __slots__ = ('sequence', 'time', 'last', 'source', 'level', 'payload', 'repeats', 'shown')
+
+    def __init__(self, sequence, timestamp, source, level, payload):
+        self.sequence = sequence
+        self.time = timestamp  # first occurrence, time.time()
+        self.last = timestamp  # last repetition
+        self.source = source
+        self.level = level
+        self.payload = payload
+        self.repeats = 1
+        self.shown = 0  # repeats already drained
+
+    ## @brief LogRecord::text(self, repeats) formats the record as the classes emitted it.
+    def text(self, repeats=None):
+        message = self.source + ': ' + self.payload if self.source else self.payload
+        repeats = self.repeats if repeats is None else repeats
+        return message + ' (x{})'.format(repeats) if repeats > 1 else message
+
+## @brief LogBuffer is a thread safe ring buffer of log records with coalescing of repeated messages and a rotating log file.
+class LogBuffer:
+    """Log buffer
+
+    :param capacity: number of records kept in memory (default 2000)
+    :param path: rotating log file, None logs to memory only (default None)
+    :param maxBytes: size at which the log file is rotated (default 1 MB)
+    :param backupCount: number of rotated log files kept (default 5)
+
+    """
+    def __init__(self, capacity=2000, **kwargs):
+        self.records = collections.deque(maxlen=capacity)
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.drained = 0  # sequence of the last drained record
+        self.lost = 0  # records overwritten before they were drained
+        self.coalesced = 0
+        self.logger = None
+        path = kwargs['path'] if 'path' in kwargs else None
+        if path is not None:
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=kwargs['maxBytes'] if 'maxBytes' in kwargs else 1 << 20,
+                                                           backupCount=kwargs['backupCount'] if 'backupCount' in kwargs else 5)
+            handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(source)s: %(message)s'))
+            self.logger = logging.getLogger('logBuffer.' + path)
+            self.logger.setLevel(DEBUG)
+            self.logger.propagate = False
+            self.logger.addHandler(handler)
+
+    ## @brief LogBuffer::append(self, message, level) adds a message, connect the mes signals to this slot.
+    ## @param message is the message, "Source: payload" as emitted by the msg functions.
+    ## @param level is the logging level, None guesses it from the payload.
+    def append(self, message, level=None):
+        message = str(message).strip()
+        source, separator, payload = message.partition(': ')
+        if not separator or ' ' in source:
+            source, payload = '', message
+        if level is None:
+            level = messageLevel(payload)
+        now = time.time()
+        if self.logger is not None:
+            self.logger.log(level, payload, extra={'source': source or '-'})
+        with self.lock:
+            last = self.records[-1] if self.records else None
+            if last is not None and last.payload == payload and last.source == source and last.level == level:
+                last.repeats += 1
+                last.last = now
+                self.coalesced += 1
+                return
+            if len(self.records) == self.records.maxlen and self.records[0].sequence > self.drained:
+                self.lost += 1
+            self.sequence += 1
+            self.records.append(LogRecord(self.sequence, now, source, level, payload))
+        return
+
+    ## @brief LogBuffer::drain(self, maxLines, level) returns the log lines added since the previous drain.
+    ## A drained message that repeated since is reported again with the number of repeats.
+    ## @param maxLines is the maximum number of new lines, the oldest new records are skipped beyond it (default 100)
+    ## @param level is the lowest level to return (default DEBUG, all)
+    ## @return list of lines.
+    def drain(self, maxLines=100, level=DEBUG):
+        lines = []
+        with self.lock:
+            new = []
+            for record in reversed(self.records):
+                if record.sequence <= self.drained:
+                    ## Only the last record can repeat, the records before it are complete
+                    more = record.repeats - record.shown
+                    if more and record.level >= level:
+                        lines.append(record.text(1) + ' (repeated {} more)'.format(more))
+                    record.shown = record.repeats
+                    break
+                record.shown = record.repeats
+                if record.level >= level:
+                    new.append(record)
+            new.reverse()
+            skipped = max(0, len(new) - maxLines) + self.lost
+            if skipped:
+                lines.append('... {} messages skipped{}'.format(skipped, ', see the log file' if self.logger is not None else ''))
+            lines.extend(record.text() for record in new[-maxLines:])
+            self.lost = 0
+            self.drained = self.sequence
+        return lines
+
+    ## @brief LogBuffer::history(self, level) is a copy of the records in the buffer.
+    def history(self, level=DEBUG):
+        with self.lock:
+            return [record for record in self.records if record.level >= level]
+
+    ## @brief LogBuffer::close(self) flushes and closes the log file.
+    def close(self):
+        if self.logger is not None:
+            for handler in list(self.logger.handlers):
+                handler.close()
+                self.logger.removeHandler(handler)
+        return
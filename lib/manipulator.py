@@ -2,6 +2,7 @@ from abc import ABC, abstractmethod
 from PySide2.QtCore import *
 import time
 import lib.signal as signal
+import lib.latency as latency
 
 ## @author Jeroen Veen
 class Manipulator(ABC):
@@ -18,6 +19,7 @@ class Manipulator(ABC):
         self.show = False # Show intermediate results
         self.processsingTime = 0 # processing time [ms]
         self.startTime = 0
+        self.latency = latency.histogram(Name) # processing time histogram, see lib.latency.snapshot()
         self.signals = signal.signalClass()
     
     ## @brief Manipulator::msg(self, message) emits the message signal. This emit will be catched by the logging slot function in main.py.
@@ -33,14 +35,14 @@ class Manipulator(ABC):
         pass
 
     def startTimer(self):
-        """Start millisecond timer."""        
-        self.startTime = int(round(time.time() * 1000))
-        self.msg('I: {} started'.format(self.name))            
+        """Start nanosecond timer."""        
+        self.startTime = time.perf_counter_ns()
         
 
     def stopTimer(self):
-        """Stop millisecond timer."""        
-        self.processsingTime = int(round(time.time() * 1000)) - self.startTime
-        self.msg('I: {} finished in {} ms'.format(self.name, self.processsingTime))
+        """Stop nanosecond timer, and record the processing time in the latency histogram."""        
+        elapsed = time.perf_counter_ns() - self.startTime
+        self.processsingTime = elapsed / 1e6
+        self.latency.record(elapsed)
         
          
@@ -0,0 +1,110 @@
+"""@package docstring
+Frame pipeline, runs each processing stage in its own thread.
+
+Stages are connected by small blocking hand-off queues, so frame N+1 can be enhanced while
+frame N is segmented and frame N-1 is detected. The throughput approaches that of the slowest
+stage instead of the sum of all stages. Frames pass every stage in arrival order.
+"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import threading
+import time
+import traceback
+from lib.frameQueue import FrameQueue
+
+## @brief FrameJob carries one frame through the pipeline, the stages add their results as attributes.
+class FrameJob:
+    def __init__(self, image, index=0):
+        self.image = image
+        self.index = index
+        self.ROIs = None
+        self.result = None
+        self.blobs = None
+
+## @brief Pipeline runs a chain of stage functions, one thread per stage.
+class Pipeline:
+    """Pipeline
+
+    :param source: FrameQueue feeding the first stage
+    :param stages: list of (name, function) tuples, each function takes the output of the previous stage
+    :param sink: function called by the last stage thread with each finished item
+    :param handoff: size of the blocking queues between stages (default 1)
+    :param onError: function called with (name, traceback string) when a stage raises, the item is dropped
+
+    """
+    def __init__(self, source, stages, sink, **kwargs):
+        self.stages = stages
+        self.sink = sink
+        self.handoff = kwargs['handoff'] if 'handoff' in kwargs else 1
+        self.onError = kwargs['onError'] if 'onError' in kwargs else None
+        self.queues = [source] + [FrameQueue(maxsize=self.handoff, policy=FrameQueue.BLOCK) for stage in stages[1:]]
+        self.busy = [0.0] * len(stages)  # time spent in each stage [s]
+        self.threads = []
+
+    ## @brief Pipeline::inFlight(self) is the maximum number of items between the source queue and the sink.
+    def inFlight(self):
+        return len(self.stages) + self.handoff * (len(self.stages) - 1)
+
+    ## @brief Pipeline::start(self) starts the stage threads.
+    def start(self):
+        for queue in self.queues[1:]:
+            queue.open()
+        self.threads = [threading.Thread(target=self.runStage, args=(index,), name=name, daemon=True)
+                        for index, (name, function) in enumerate(self.stages)]
+        for thread in self.threads:
+            thread.start()
+        return
+
+    ## @brief Pipeline::runStage(self, index) takes items from the stage input, processes and hands them to the next stage.
+    ## When the input is closed and empty the next stage is closed too, after it has drained the items already handed off.
+    def runStage(self, index):
+        name, function = self.stages[index]
+        inQueue = self.queues[index]
+        outQueue = self.queues[index + 1] if index + 1 < len(self.queues) else None
+        while True:
+            item = inQueue.get()
+            if item is None:
+                break
+            startTime = time.perf_counter()
+            try:
+                item = function(item)
+            except Exception:
+                item = None
+                if self.onError is not None:
+                    self.onError((name, traceback.format_exc()))
+            finally:
+                self.busy[index] += time.perf_counter() - startTime
+                inQueue.taskDone()
+            if item is None:
+                continue
+            if outQueue is None:
+                self.sink(item)
+            else:
+                outQueue.put(item)
+        if outQueue is not None:
+            outQueue.close(drain=True)
+        return
+
+    ## @brief Pipeline::close(self, drain=False) closes the source, and the stage queues unless drained.
+    ## @param drain lets the stages finish the queued items when True.
+    def close(self, drain=False):
+        self.queues[0].close(drain)
+        if not drain:
+            for queue in self.queues[1:]:
+                queue.close()
+        return
+
+    ## @brief Pipeline::join(self) waits until all stage threads have finished.
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+        return
+
+    ## @brief Pipeline::stats(self) returns the counters of each stage.
+    ## @return dict per stage name with the input queue counters and the busy time [ms].
+    def stats(self):
+        stats = {}
+        for index, (name, function) in enumerate(self.stages):
+            stats[name] = self.queues[index].stats()
+            stats[name]['busy'] = int(round(self.busy[index] * 1000))
+        return stats
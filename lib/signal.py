@@ -22,7 +22,7 @@ class signalClass(QObject):
     previewRawUpdated = Signal()
     captureRawUpdated = Signal()
     signal_rdy_calibrator = Signal() # snapshot taken signal
-    signal_rdy_positioner = Signal(np.ndarray) # snapshot taken signal
+    signal_rdy_positioner = Signal(object) # snapshot taken signal, image or ImagePyramid
     signal_rdy_batchrun = Signal()    
 
     ## Well positioner
@@ -42,6 +42,9 @@ class signalClass(QObject):
     batch_active = Signal()
     batch_inactive = Signal()
 
+    ## Snapshot writer
+    snapshot_saved = Signal(str) ## emitted with the file name when a snapshot is completely written
+
     ## Main Window
     windowClosing = Signal()
     
@@ -0,0 +1,141 @@
+"""@package docstring
+Background writer of the batch snapshots.
+
+Encoding and writing a full resolution PNG takes long enough to hold up the next move of a
+batch run, so the Scanner hands the frame to the SnapshotWriter as soon as it is in memory and
+the batch continues. Each image is encoded and written to a hidden temporary file, synced, and
+then renamed to its final name, so a crash never leaves a half-written image under the final
+name. After the rename the image is committed to the journal in its directory; images that are
+not in the journal were not completely written.
+"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import glob
+import os
+import threading
+import time
+import cv2
+import lib.signal as signal
+from lib.frameQueue import FrameQueue
+
+JOURNAL = 'journal.csv'
+PARTIAL = '.partial'
+
+## @brief temporaryName(filename) is the hidden file an image is written to before it is renamed to filename.
+def temporaryName(filename):
+    directory, base = os.path.split(filename)
+    return os.path.join(directory, '.' + base + PARTIAL)
+
+## @brief recover(directory) removes the temporary files of images that were not completely written, e.g. after a crash.
+## @return list of the removed files.
+def recover(directory):
+    removed = []
+    for partial in glob.glob(os.path.join(directory, '.*' + PARTIAL)):
+        try:
+            os.remove(partial)
+            removed.append(partial)
+        except OSError:
+            pass
+    return removed
+
+## @brief journal(directory) reads the committed images of a directory.
+## @return list of (time, name, filename) of the images in the journal that exist.
+def journal(directory):
+    entries = []
+    try:
+        with open(os.path.join(directory, JOURNAL)) as f:
+            for line in f:
+                fields = line.rstrip('\n').split(',', 2)
+                if len(fields) == 3 and os.path.exists(os.path.join(directory, fields[2])):
+                    entries.append((float(fields[0]), fields[1], fields[2]))
+    except OSError:
+        pass
+    return entries
+
+## @brief SnapshotWriter encodes and writes snapshots in a background thread.
+class SnapshotWriter(threading.Thread):
+    """Snapshot writer
+
+    :param maxQueue: maximum number of snapshots waiting to be written, save() blocks when full (default 4)
+
+    """
+    signals = signal.signalClass()
+
+    def __init__(self, **kwargs):
+        super().__init__(name='snapshot writer', daemon=True)
+        maxQueue = kwargs['maxQueue'] if 'maxQueue' in kwargs else 4
+        self.queue = FrameQueue(maxQueue, FrameQueue.BLOCK)
+        self.written = 0
+        self.failed = 0
+
+    ## @brief SnapshotWriter::msg(self, message) emits the message signal. This emit will be catched by the logging slot function in main.py.
+    ## @param message is the string message to be emitted.
+    def msg(self, message):
+        if message is not None:
+            self.signals.mes.emit(self.__class__.__name__ + ": " + str(message))
+        return
+
+    ## @brief SnapshotWriter::save(self, filename, image, name, release) queues an image to be written.
+    ## The image must not be modified after it is queued. A camera frame is queued without a copy by retaining its ring slot and passing the release.
+    ## @param filename is the path of the image, the extension selects the format.
+    ## @param image is the image.
+    ## @param name identifies the image in the journal, e.g. the well (default the file name)
+    ## @param release is called when the image is written or failed, e.g. FrameHandle.release (default None)
+    ## @return True if queued, False if the writer is closed; release is not called then.
+    def save(self, filename, image, name=None, release=None):
+        return self.queue.put((filename, image, os.path.basename(filename) if name is None else str(name), release))
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            filename, image, name, release = job
+            try:
+                self.commit(filename, image, name)
+            finally:
+                if release is not None:
+                    release()
+            self.queue.taskDone()
+        return
+
+    ## @brief SnapshotWriter::commit(self, filename, image, name) encodes and writes an image, renames it to filename and adds it to the journal.
+    ## @return True if the image was committed.
+    def commit(self, filename, image, name):
+        directory = os.path.dirname(filename)
+        temporary = temporaryName(filename)
+        try:
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            ok, data = cv2.imencode(os.path.splitext(filename)[1], image)
+            if not ok:
+                raise ValueError('cannot encode ' + filename)
+            with open(temporary, 'wb') as f:
+                f.write(data.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, filename)
+            with open(os.path.join(directory, JOURNAL), 'a') as f:
+                f.write('{:.3f},{},{}\n'.format(time.time(), name.replace(',', ' '), os.path.basename(filename)))
+                f.flush()
+                os.fsync(f.fileno())
+        except (OSError, ValueError, cv2.error) as e:
+            self.failed += 1
+            self.msg("Writing " + filename + " failed: " + str(e))
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            return False
+        self.written += 1
+        self.signals.snapshot_saved.emit(filename)
+        return True
+
+    ## @brief SnapshotWriter::pending(self) is the number of snapshots waiting to be written.
+    def pending(self):
+        return self.queue.depth()
+
+    ## @brief SnapshotWriter::close(self) writes the queued snapshots and stops the writer.
+    def close(self):
+        self.queue.close(drain=True)
+        if self.is_alive():
+            self.join()
+        return
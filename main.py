@@ -21,6 +21,9 @@ from lib.checkOS import *
 from lib.imageProcessor import *
 from lib.PiCam import PiVideoStream
 from lib.temperature import ReadTemperatures
+from lib.latency import LatencyWriter
+from lib.snapshotWriter import SnapshotWriter
+from lib.logBuffer import LogBuffer
 
 current_milli_time = lambda: int(round(time.time() * 1000))
 
@@ -34,6 +37,8 @@ class MainWindow(QDialog):
     settings_batch = None
     Well_Map = None
     Well_Targets = None
+    logBuffer = None ## LogBuffer collecting the messages of all classes, drained into the log window by logTimer
+    logTimer = None
 
     ## @brief MainWindow::__init__ initializes the window with widgets, layouts and groupboxes and opens initialization files.
     def __init__(self):
@@ -95,6 +100,24 @@ class MainWindow(QDialog):
         self.log.appendPlainText(str(message) + "\n")
         return
 
+    ## @brief MainWindow::attachLogBuffer(self, logBuffer, interval) shows the messages collected by logBuffer in the log window, drained every interval.
+    # @param logBuffer is the LogBuffer the message signals are connected to.
+    # @param interval is the time between two updates of the log window [ms].
+    def attachLogBuffer(self, logBuffer, interval=200):
+        self.logBuffer = logBuffer
+        self.logTimer = QTimer(self)
+        self.logTimer.timeout.connect(self.drainLog)
+        self.logTimer.start(interval)
+        return
+
+    ## @brief MainWindow::drainLog(self) appends the messages collected since the previous call to the log window at once.
+    @Slot()
+    def drainLog(self):
+        lines = self.logBuffer.drain(maxLines=100)
+        if lines:
+            self.log.appendPlainText("\n".join(lines))
+        return
+
     ## @brief MainWindow::wait_ms(self, milliseconds) is a delay function.
     ## @param milliseconds is the number of milliseconds to wait.
     def wait_ms(self, milliseconds):
@@ -303,6 +326,7 @@ class MainWindow(QDialog):
         ## Logger screen widget (QPlainTextEdit)
         self.log = QPlainTextEdit()
         self.log.setReadOnly(True)
+        self.log.setMaximumBlockCount(5000) ## the full log is in the log file
         self.log.setStyleSheet("background-color: #AAAAAA;")
         self.logGridLayout.addWidget(self.log,1,0,1,1)
 
@@ -448,10 +472,12 @@ class Scanner():
     signals = signal.signalClass()
     preview = None ## @param preview contains the preview image
     capture = None ## @param capture contains the captured image
+    capturePyramid = None ## @param capturePyramid is the shared ImagePyramid of the captured camera frame, retained until the next frame
     DisplayTarget = None
     DisplayWell = None
     positioner_msg = str
     batchrun_msg = str
+    writer = None ## SnapshotWriter, writes the batch snapshots in the background, None writes them directly
 
     ## @brief Scanner::__init__() initialises the variables and instances
     def __init__(self, parent=None):
@@ -508,12 +534,16 @@ class Scanner():
         self.signals.previewUpdated.connect(self.snapshotPositioner)
 
     ## @brief Scanner::snapshotPositioner(self) signals the positioner ready signal if an capture image is stored.
+    ## The positioner gets the preview size pyramid of the camera frame, shared with the ImageProcessor that scaled the preview from it.
     @Slot()
     def snapshotPositioner(self):
         if not (self.capture is None):
             ## Disconnect the capture ready signal to only create snapshots when they are requested.
             self.signals.previewUpdated.disconnect(self.snapshotPositioner)
-            self.signals.signal_rdy_positioner.emit(self.preview)
+            if self.capturePyramid is not None:
+                self.signals.signal_rdy_positioner.emit(self.capturePyramid.scaled(PREVIEW_SIZE))
+            else:
+                self.signals.signal_rdy_positioner.emit(self.preview)
 
     ## @brief Scanner::snapshotRequestedBatchRun(self, message) sets the image part of the batch filename and connects the capture (high resolution capture image ready) signal to Scanner::snapshotBatchRun
     ## @param message is the snapshot unique name which will be part of the imagefilename 
@@ -536,7 +566,13 @@ class Scanner():
             filename = file_path + '/Snapshot_' + str(current_milli_time()) + '.png'
             self.msg(str(filename))
             print(filename)
-            cv2.imwrite(filename, self.capture)
+            ## The frame is in memory, the batch run can continue while it is written; its ring slot is kept until then
+            pyramid = self.capturePyramid if self.capturePyramid is not None and self.capturePyramid.retain() else None
+            release = pyramid.release if pyramid is not None else None
+            if self.writer is None or not self.writer.save(filename, self.capture, self.batchrun_msg, release):
+                cv2.imwrite(filename, self.capture)
+                if release is not None:
+                    release()
             self.signals.signal_rdy_batchrun.emit()
 
     ## @brief Scanner::prvUpdate(self, image=None) updates the preview image on the QLabel widget of the MainWindow
@@ -547,6 +583,8 @@ class Scanner():
             self.preview = image
             if len(image.shape) < 3:
                 image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB) ## convert to color image
+            elif not image.flags.writeable:
+                image = image.copy() ## shared read-only frame, draw on a copy
             if self.DisplayTarget is not None:
                 cv2.circle(image, (self.DisplayTarget[0], self.DisplayTarget[1]), self.DisplayTarget[2], (0,255,0), 1)
             if self.DisplayWell is not None:
@@ -564,12 +602,19 @@ class Scanner():
             self.PixImage.show()
             self.signals.previewUpdated.emit()
 
-    ## @brief Scanner::capUpdate(self, image=None) updates the image when a new one is available and emits a captureUpdated signal.
+    ## @brief Scanner::capUpdate(self, image=None, pyramid=None) updates the image when a new one is available and emits a captureUpdated signal.
     ## @param image is the new captured image.
+    ## @param pyramid is the retained ImagePyramid of a camera frame, used instead of image; it is released when the next image arrives.
     @Slot(np.ndarray)
-    def capUpdate(self, image=None):
+    def capUpdate(self, image=None, pyramid=None):
+        if pyramid is not None:
+            image = pyramid.image
         if not (image is None):
+            previous = self.capturePyramid
             self.capture = image
+            self.capturePyramid = pyramid
+            if previous is not None:
+                previous.release()
             self.signals.captureUpdated.emit()
 
 
@@ -622,16 +667,25 @@ if __name__ == '__main__':
         os.makedirs(path)
     stepper_well_positioning = stepper.StepperWellPositioning(steppers, mwi.Well_Map, path)
 
+    ## @param processorQueue and writerQueue are the queue sizes of the Image_Processor and the snapshotWriter
+    processorQueue = 2
+    writerQueue = 4
+
     ## @param Cam_Capturestream records images from the pi camera
+    ## Every queued frame holds a ring slot, as do the frames being processed and written, the Scanner capture,
+    ## the current and the latest frame of the stream and the frame being captured, so the ring has 6 slots more than the queues.
     Cam_Capturestream = PiVideoStream(resolution=(int(mwi.settings.value("Camera/width")),
                                                   int(mwi.settings.value("Camera/height"))),
                                       monochrome=True,
                                       framerate=int(mwi.settings.value("Camera/framerate")),
                                       effect='blur',
-                                      use_video_port=bool(mwi.settings.value("Camera/use_video_port")))
+                                      use_video_port=bool(mwi.settings.value("Camera/use_video_port")),
+                                      slots=processorQueue + writerQueue + 6)
     
     ## @param Image_Processor processes the images recorded by the PiVideoStream instance 
-    Image_Processor = ImageProcessor()
+    ## The processor only scales the frames for the preview, blob detection is off. The enhance/segment/detect
+    ## pipeline only pays off with detection on, and its preview is the enhanced frame, so it stays opt-in.
+    Image_Processor = ImageProcessor(policy=FrameQueue.KEEP_LATEST, maxQueue=processorQueue, workers=1, detection=False, pipeline=False)
     
     ## @param Batch handles the batch process of the wells specified by the user in batch.ini
     Batch = batch_processor.BatchProcessor(stepper_well_positioning,
@@ -643,6 +697,17 @@ if __name__ == '__main__':
                                            mwi.getSec(str(mwi.settings_batch.value("Run/interleave"))))
 
     tempControl = ReadTemperatures(10,55)
+
+    ## @param latencyWriter periodically writes the image processing stage latencies (p50/p95/p99, count, max) to latency.json
+    latencyWriter = LatencyWriter('latency.json', 60.0)
+
+    ## @param logBuffer collects the messages of all classes from any thread, the log window shows them at a fixed rate and the full log goes to well_reader.log
+    logBuffer = LogBuffer(capacity=2000, path='well_reader.log')
+    mwi.attachLogBuffer(logBuffer, 200)
+
+    ## @param snapshotWriter encodes and writes the batch snapshots in the background, and commits them to the journal of their directory
+    snapshotWriter = SnapshotWriter(maxQueue=writerQueue)
+    mwi.Well_Scanner.writer = snapshotWriter
     
     ## @param Thread_List is a list with instances which have functionality what has to be closed at exit. Thread_List member close functions are called at the end of the main function.
     Thread_List = [Cam_Capturestream, Image_Processor, Batch, stepper_well_positioning]
@@ -651,9 +716,6 @@ if __name__ == '__main__':
     ## --- Signal connection --- ##
     ###############################
 
-    ## connect STM message signal to readPort function
-    steppers.PrintHAT_serial.signals.stm_read_request.connect(steppers.PrintHAT_serial.readPort)
-    
     ## Signal if STM message contains confirmation ("ok")
     steppers.PrintHAT_serial.signals.confirmation.connect(steppers.setMoveConfirmed)
 
@@ -675,22 +737,26 @@ if __name__ == '__main__':
     ## Connect image signals to designated functions
 #     Cam_Capturestream.sig nals.prvReady.connect(lambda: Image_Processor.update(Cam_Capturestream.PreviewFrame), type=Qt.BlockingQueuedConnection)
     ## @todo Possibly duplicate above rule and connect the capture image too, because currently the preview image is captured in the batch run.
-    Cam_Capturestream.signals.capReady.connect(lambda: Image_Processor.update(Cam_Capturestream.CaptureFrame), type=Qt.BlockingQueuedConnection)
-    Cam_Capturestream.signals.capReady.connect(lambda: mwi.Well_Scanner.capUpdate(Cam_Capturestream.CaptureFrame)) ## For the capture/snapshot images
+    ## update() only queues the frame, so call it from the camera thread: with the block policy the camera waits for the workers instead of the GUI.
+    Cam_Capturestream.signals.capReady.connect(lambda: Image_Processor.update(Cam_Capturestream.CapturePyramid), type=Qt.DirectConnection)
+    Cam_Capturestream.signals.capReady.connect(lambda: mwi.Well_Scanner.capUpdate(pyramid=Cam_Capturestream.retainPyramid())) ## For the capture/snapshot images
 #     Image_Processor.signals.result.connect(lambda: mwi.Well_Scanner.capUpdate(Image_Processor.image)) ## For the capture/snapshot images
-    Image_Processor.signals.result.connect(lambda: mwi.Well_Scanner.prvUpdate(Image_Processor.image)) ## Image for the GUI preview (lower resolution)
+    Image_Processor.signals.result.connect(mwi.Well_Scanner.prvUpdate) ## Image for the GUI preview (lower resolution)
 
     tempControl.heatAlarm.connect(lambda: steppers.setFanPWM(1.0))
     tempControl.heatAlarmRemoved.connect(lambda: steppers.setFanPWM(0.5))
 
-    ## Class message signals
-    mwi.signals.mes.connect(mwi.LogWindowInsert)
-    steppers.PrintHAT_serial.signals.mes.connect(mwi.LogWindowInsert)
-    steppers.signals.mes.connect(mwi.LogWindowInsert)
-    stepper_well_positioning.signals.mes.connect(mwi.LogWindowInsert)
-    mwi.Well_Scanner.signals.mes.connect(mwi.LogWindowInsert)
-    Cam_Capturestream.signals.mes.connect(mwi.LogWindowInsert)
-    Batch.signals.mes.connect(mwi.LogWindowInsert)
+    ## Class message signals, appended to the log buffer in the emitting thread instead of queued to the GUI thread.
+    ## The LogBuffer is no QObject, an auto connection could still queue each message to the GUI thread; LogBuffer.append is thread safe
+    mwi.signals.mes.connect(logBuffer.append, type=Qt.DirectConnection)
+    steppers.PrintHAT_serial.signals.mes.connect(logBuffer.append, type=Qt.DirectConnection)
+    steppers.signals.mes.connect(logBuffer.append, type=Qt.DirectConnection)
+    stepper_well_positioning.signals.mes.connect(logBuffer.append, type=Qt.DirectConnection)
+    mwi.Well_Scanner.signals.mes.connect(logBuffer.append, type=Qt.DirectConnection)
+    Cam_Capturestream.signals.mes.connect(logBuffer.append, type=Qt.DirectConnection)
+    Batch.signals.mes.connect(logBuffer.append, type=Qt.DirectConnection)
+    Image_Processor.signals.mes.connect(logBuffer.append, type=Qt.DirectConnection)
+    snapshotWriter.signals.mes.connect(logBuffer.append, type=Qt.DirectConnection)
 
     ## GUI buttons signal connections
     mwi.b_firmware_restart.clicked.connect(steppers.firmwareRestart)
@@ -712,9 +778,15 @@ if __name__ == '__main__':
 
     Batch.signals.batch_active.connect(mwi.setBatchWindow)
     Batch.signals.batch_inactive.connect(mwi.setFullWindow)
+    ## Every batch snapshot must be analysed, so block the camera rather than drop frames during a batch run
+    Batch.signals.batch_active.connect(lambda: Image_Processor.setQueuePolicy(FrameQueue.BLOCK))
+    Batch.signals.batch_inactive.connect(lambda: Image_Processor.setQueuePolicy(FrameQueue.KEEP_LATEST))
 
     for Thread in Thread_List:
         mwi.signals.windowClosing.connect(Thread.close)
+    mwi.signals.windowClosing.connect(latencyWriter.close)
+    mwi.signals.windowClosing.connect(snapshotWriter.close)
+    mwi.signals.windowClosing.connect(logBuffer.close)
 
     ##########################
     ## --- Thread start --- ##
@@ -723,6 +795,8 @@ if __name__ == '__main__':
     ## Start threads
     Cam_Capturestream.start(QThread.HighPriority)
     Image_Processor.start(QThread.HighPriority)
+    latencyWriter.start()
+    snapshotWriter.start()
 
     ########################
     ## --- Exit stuff --- ##
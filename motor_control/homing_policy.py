@@ -0,0 +1,77 @@
+## @package homing_policy.py
+## @brief homing_policy.py decides when the XY stage needs to be homed, instead of homing before every batch run.
+
+import numpy as np
+
+## @brief HomingPolicy tracks how far the stage position has drifted since the last homing.
+## The drift estimate is the exponential average of the positioning residuals, the corrections goto_target needed on top of the feedforward position.
+## Random detection errors average out while lost steps show up as a persistent offset.
+## Homing is needed when the stage was never homed, after an error, after a number of runs or when the drift estimate exceeds a threshold.
+class HomingPolicy():
+    ## @brief HomingPolicy::__init__(self, **kwargs)
+    ## @param max_drift is the drift estimate [mm] above which the stage is homed (default 0.5)
+    ## @param max_runs is the number of batch runs after which the stage is homed anyway, 0 homes every run (default 8)
+    ## @param smoothing is the weight of a new residual in the drift estimate (default 0.3)
+    def __init__(self, **kwargs):
+        self.max_drift = kwargs['max_drift'] if 'max_drift' in kwargs else 0.5
+        self.max_runs = kwargs['max_runs'] if 'max_runs' in kwargs else 8
+        self.smoothing = kwargs['smoothing'] if 'smoothing' in kwargs else 0.3
+        self.homed_once = False
+        self.failure = "never homed"
+        self.reset()
+
+    ## @brief HomingPolicy::reset(self) clears the drift estimate and the run count.
+    def reset(self):
+        self.offset = np.zeros(2)
+        self.residuals = 0
+        self.runs = 0
+        return
+
+    ## @brief HomingPolicy::homed(self, success) records a homing attempt.
+    ## @param success is False if the endstops did not confirm the homing.
+    def homed(self, success):
+        if success:
+            self.homed_once = True
+            self.failure = None
+            self.reset()
+        else:
+            self.error("homing failed")
+        return
+
+    ## @brief HomingPolicy::error(self, reason) records that the stage position can no longer be trusted, e.g. after an emergency stop, disabling the motors or a failed positioning.
+    def error(self, reason):
+        self.failure = str(reason)
+        return
+
+    ## @brief HomingPolicy::record_residual(self, residual) adds the correction [mm] that was needed to centre a well on top of its feedforward position.
+    ## @param residual is the (dx, dy) correction [mm].
+    def record_residual(self, residual):
+        self.offset = (1 - self.smoothing) * self.offset + self.smoothing * np.asarray(residual, dtype=np.float64)
+        self.residuals += 1
+        return
+
+    ## @brief HomingPolicy::run_completed(self) counts a completed batch run.
+    def run_completed(self):
+        self.runs += 1
+        return
+
+    ## @brief HomingPolicy::drift(self) is the current drift estimate [mm].
+    def drift(self):
+        return float(np.linalg.norm(self.offset))
+
+    ## @brief HomingPolicy::reason(self) is the reason to home, or None if the position can be trusted.
+    def reason(self):
+        if self.failure is not None:
+            return self.failure
+        if self.runs >= self.max_runs:
+            return str(self.runs) + " runs since homing"
+        if self.drift() > self.max_drift:
+            return "drift {:.2f}mm".format(self.drift())
+        return None
+
+    ## @brief HomingPolicy::should_home(self) is True if the stage needs to be homed.
+    def should_home(self):
+        return self.reason() is not None
+
+    def __repr__(self):
+        return "HomingPolicy(drift={:.2f}mm over {} wells, {} runs since homing)".format(self.drift(), self.residuals, self.runs)
@@ -0,0 +1,342 @@
+## @package klipper_sim.py
+## @brief klipper_sim.py simulates klippy and the PrintHAT behind a pseudo terminal, so motor_control and the batch processor can run off the device.
+## The simulator answers the G-code subset of the well plate reader like klippy: every command is answered with "ok", preceded by its response lines
+## and by "!!" lines if it failed. Moves take the time klipper would plan for them, from the velocity and acceleration limits in printer.cfg.
+##
+## Usage, from the repository root:
+##     KLIPPER_SERVICE=off python3 -m motor_control.klipper_sim --link /tmp/printer
+## and start main.py with KLIPPER_SERVICE=off in another shell, or start a KlipperSimulator in the same process and connect a GcodeSerial to its port.
+
+import argparse
+import configparser
+import os
+import queue
+import re
+import shlex
+import sys
+import threading
+import time
+import tty
+import motor_control.motion_model as motion_model
+
+## @brief read_axis_limits(path) reads the travel range and homing speed of the X and Y steppers from a klipper config file.
+## @return dict of axis ('X', 'Y') to (position_min, position_max, homing_speed), klipper defaults for missing options.
+def read_axis_limits(path):
+    config = configparser.ConfigParser(inline_comment_prefixes=('#', ';'), strict=False)
+    try:
+        with open(path) as f:
+            config.read_file(f)
+    except (OSError, configparser.Error):
+        pass
+    limits = {}
+    for axis in ('X', 'Y'):
+        section = 'stepper_' + axis.lower()
+        if config.has_section(section):
+            stepper = config[section]
+            limits[axis] = (stepper.getfloat('position_min', 0.0), stepper.getfloat('position_max', 200.0), stepper.getfloat('homing_speed', 5.0))
+        else:
+            limits[axis] = (0.0, 200.0, 5.0)
+    return limits
+
+## @brief KlipperSimulator answers G-code on a pseudo terminal like klippy does on /tmp/printer.
+## Commands are executed in order by an executor thread. Moves are queued on a simulated toolhead and answered at once,
+## M400, G28 and M84 first wait until the queued moves are finished, M114 reports the position after them. M112 is handled as soon as it arrives, like klippy does.
+## Each move is timed from rest to rest by MotionModel, junction speeds between successive moves are ignored.
+class KlipperSimulator():
+    ## @brief KlipperSimulator::__init__(self, **kwargs)
+    ## @param config is the klipper config file (default the printer.cfg in File_Backup)
+    ## @param time_scale multiplies all simulated durations, 0 answers at once (default 1.0)
+    ## @param link is a path to create as a symbolic link to the pseudo terminal, e.g. /tmp/printer (default None)
+    ## @param homing_retract is the distance [mm] klipper retracts and homes again at half speed (default 5.0)
+    def __init__(self, **kwargs):
+        config = kwargs['config'] if 'config' in kwargs else motion_model.DEFAULT_CONFIG
+        self.time_scale = kwargs['time_scale'] if 'time_scale' in kwargs else 1.0
+        self.link = kwargs['link'] if 'link' in kwargs else None
+        self.homing_retract = kwargs['homing_retract'] if 'homing_retract' in kwargs else 5.0
+        self.model = motion_model.MotionModel.from_config(config)
+        self.limits = read_axis_limits(config)
+        self.port = None
+        self.master = None
+        self.slave = None
+        self.commands = queue.Queue()
+        self.stopped = threading.Event()
+        self.condition = threading.Condition() ## guards the toolhead state, notified on emergency stop
+        self.log = [] ## executed commands
+        self.reset()
+        return
+
+    ## @brief KlipperSimulator::reset(self) puts the simulated printer in its state after a firmware restart.
+    def reset(self):
+        with self.condition:
+            self.position = {'X': 0.0, 'Y': 0.0, 'Z': 0.0, 'E': 0.0}
+            self.homed = False
+            self.shutdown = False
+            self.speed = self.model.max_velocity
+            self.busy_until = time.monotonic()
+            self.pins = {}
+            self.moves = 0
+            self.travel = 0.0 ## mm
+            self.motion_time = 0.0 ## s, unscaled
+            self.condition.notify_all()
+        return
+
+    ## @brief KlipperSimulator::start(self) creates the pseudo terminal and starts answering.
+    ## @return the name of the pseudo terminal to connect to.
+    def start(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        if self.link is not None:
+            if os.path.islink(self.link):
+                os.remove(self.link)
+            os.symlink(self.port, self.link)
+        self.reader = threading.Thread(target=self.read_commands, name='klipper sim reader', daemon=True)
+        self.executor = threading.Thread(target=self.execute_commands, name='klipper sim executor', daemon=True)
+        self.reader.start()
+        self.executor.start()
+        return self.port
+
+    ## @brief KlipperSimulator::stop(self) stops answering and closes the pseudo terminal.
+    def stop(self):
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+        self.commands.put(None)
+        if self.link is not None and os.path.islink(self.link):
+            os.remove(self.link)
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        return
+
+    ## @brief KlipperSimulator::read_commands(self) is the reader thread, it splits the input in lines and queues them for the executor.
+    def read_commands(self):
+        buffer = b''
+        while not self.stopped.is_set():
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                break
+            if not data:
+                break
+            buffer += data
+            while b'\n' in buffer:
+                line, buffer = buffer.split(b'\n', 1)
+                line = line.decode('utf-8', 'replace').strip()
+                if not line:
+                    continue
+                if line.split()[0].upper() == 'M112':
+                    self.emergency_stop()
+                self.commands.put(line)
+        return
+
+    ## @brief KlipperSimulator::execute_commands(self) is the executor thread, it executes the queued commands in order and writes the answers.
+    def execute_commands(self):
+        while not self.stopped.is_set():
+            line = self.commands.get()
+            if line is None:
+                break
+            try:
+                lines = self.execute(line)
+            except Exception as e:
+                lines = ['!! Internal error on command:"' + line + '": ' + str(e)]
+            self.write(lines + ['ok'])
+        return
+
+    ## @brief KlipperSimulator::write(self, lines) writes answer lines to the pseudo terminal.
+    def write(self, lines):
+        try:
+            os.write(self.master, ''.join(line + '\n' for line in lines).encode('utf-8'))
+        except OSError:
+            pass
+        return
+
+    ## @brief KlipperSimulator::sleep_until(self, deadline) waits until the monotonic deadline, an emergency stop or stop() end the wait early.
+    ## @return False if the wait was interrupted by an emergency stop.
+    def sleep_until(self, deadline):
+        with self.condition:
+            while not self.shutdown and not self.stopped.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return True
+                self.condition.wait(remaining)
+            return not self.shutdown
+
+    ## @brief KlipperSimulator::emergency_stop(self) shuts the printer down as M112 does, queued moves are lost.
+    def emergency_stop(self):
+        with self.condition:
+            self.shutdown = True
+            self.homed = False
+            self.busy_until = time.monotonic()
+            self.condition.notify_all()
+        return
+
+    ## @brief KlipperSimulator::parse(line) splits a command in its name and parameters.
+    ## G-code parameters are a letter followed by a value (G0 X10), extended parameters are NAME=value (SET_PIN PIN=light VALUE=1).
+    ## @return (command, dict of parameters), parameter names in upper case.
+    @staticmethod
+    def parse(line):
+        line = line.split(';', 1)[0].strip()
+        if not line:
+            return None, {}
+        words = line.split(None, 1)
+        command = words[0].upper()
+        params = {}
+        if len(words) > 1:
+            if '=' in words[1]:
+                for word in shlex.split(words[1]):
+                    name, _, value = word.partition('=')
+                    params[name.upper()] = value
+            else:
+                for match in re.finditer(r'([A-Za-z])\s*([-+]?[0-9.]*)', words[1]):
+                    params[match.group(1).upper()] = match.group(2)
+        return command, params
+
+    ## @brief KlipperSimulator::execute(self, line) executes a command.
+    ## @return list of the response lines, without the final "ok".
+    def execute(self, line):
+        command, params = self.parse(line)
+        self.log.append(line)
+        if command is None:
+            return []
+        if command == 'FIRMWARE_RESTART':
+            self.reset()
+            return []
+        if command == 'M112':
+            return ['!! Shutdown due to M112 command']
+        if self.shutdown:
+            return ['!! Printer is shutdown']
+        handler = {
+            'G0': self.cmd_move, 'G1': self.cmd_move, 'G28': self.cmd_home, 'M400': self.cmd_wait,
+            'M114': self.cmd_position, 'SET_PIN': self.cmd_set_pin, 'M17': self.cmd_enable,
+            'M18': self.cmd_disable, 'M84': self.cmd_disable, 'RESPOND': self.cmd_respond, 'SYNC_MARK': self.cmd_sync_mark,
+        }.get(command)
+        if handler is None:
+            return ['// Unknown command:"' + command + '"']
+        return handler(params)
+
+    ## @brief KlipperSimulator::queue_motion(self, duration) appends a motion of duration [s] to the simulated toolhead.
+    def queue_motion(self, duration):
+        with self.condition:
+            self.busy_until = max(self.busy_until, time.monotonic()) + duration * self.time_scale
+            self.motion_time += duration
+        return
+
+    ## @brief KlipperSimulator::cmd_move(self, params) queues a G0/G1 move, answered before the move is executed.
+    def cmd_move(self, params):
+        target = dict(self.position)
+        try:
+            for axis in ('X', 'Y', 'Z', 'E'):
+                if axis in params:
+                    target[axis] = float(params[axis])
+            if 'F' in params:
+                self.speed = float(params['F']) / 60.0
+        except ValueError:
+            return ['!! Unable to parse move "' + ' '.join(k + v for k, v in params.items()) + '"']
+        moved = [axis for axis in ('X', 'Y') if target[axis] != self.position[axis]]
+        if not moved:
+            return []
+        coordinates = "{:.3f} {:.3f} {:.3f} [{:.3f}]".format(target['X'], target['Y'], target['Z'], target['E'])
+        if not self.homed:
+            return ['!! Must home axis first: ' + coordinates]
+        for axis in moved:
+            position_min, position_max, homing_speed = self.limits[axis]
+            if not position_min <= target[axis] <= position_max:
+                return ['!! Move out of range: ' + coordinates]
+        distance = self.model.distance(target['X'] - self.position['X'], target['Y'] - self.position['Y'])
+        model = self.model
+        if self.speed < model.max_velocity:
+            model = motion_model.MotionModel(self.speed, model.max_accel, max_accel_to_decel=model.max_accel_to_decel)
+        self.queue_motion(model.move_time(distance))
+        self.position = target
+        self.moves += 1
+        self.travel += distance
+        return []
+
+    ## @brief KlipperSimulator::cmd_home(self, params) homes the given axes, or all axes, one after the other after the queued moves.
+    def cmd_home(self, params):
+        axes = [axis for axis in ('X', 'Y') if axis in params] or ['X', 'Y']
+        if not self.sleep_until(self.busy_until):
+            return ['!! Homing aborted']
+        for axis in axes:
+            position_min, position_max, homing_speed = self.limits[axis]
+            ## Move to the endstop from where the stage is, or over the full range if the position is not known, then retract and home again at half speed
+            distance = self.position[axis] if self.homed else position_max
+            self.queue_motion((distance + self.homing_retract) / homing_speed + self.homing_retract / (homing_speed / 2))
+            self.position[axis] = 0.0
+        self.homed = True
+        if not self.sleep_until(self.busy_until):
+            return ['!! Homing aborted']
+        return []
+
+    ## @brief KlipperSimulator::cmd_wait(self, params) waits until the queued moves are finished.
+    def cmd_wait(self, params):
+        if not self.sleep_until(self.busy_until):
+            return ['!! Printer is shutdown']
+        return []
+
+    ## @brief KlipperSimulator::cmd_position(self, params) reports the commanded position, the position after the queued moves.
+    def cmd_position(self, params):
+        return ["X:{:.3f} Y:{:.3f} Z:{:.3f} E:{:.3f}".format(self.position['X'], self.position['Y'], self.position['Z'], self.position['E'])]
+
+    ## @brief KlipperSimulator::cmd_set_pin(self, params) sets a PWM output pin, e.g. the light.
+    def cmd_set_pin(self, params):
+        if 'PIN' not in params:
+            return ['!! Error on \'SET_PIN\': missing PIN']
+        try:
+            value = float(params.get('VALUE', ''))
+        except ValueError:
+            return ['!! Error on \'SET_PIN\': unable to parse VALUE']
+        if not 0.0 <= value <= 1.0:
+            return ['!! Error on \'SET_PIN\': VALUE must be between 0 and 1']
+        self.pins[params['PIN']] = value
+        return []
+
+    ## @brief KlipperSimulator::cmd_enable(self, params), klipper does not implement M17.
+    def cmd_enable(self, params):
+        return ['// Unknown command:"M17"']
+
+    ## @brief KlipperSimulator::cmd_disable(self, params) disables the motors after the queued moves, the axes need homing again.
+    def cmd_disable(self, params):
+        self.sleep_until(self.busy_until)
+        self.homed = False
+        return []
+
+    ## @brief KlipperSimulator::cmd_respond(self, params) echoes a message, as the [respond] module does.
+    def cmd_respond(self, params):
+        prefix = params.get('PREFIX', 'echo:')
+        return [prefix + ' ' + params.get('MSG', '')]
+
+    ## @brief KlipperSimulator::cmd_sync_mark(self, params) is the SYNC_MARK macro of printer.cfg.
+    def cmd_sync_mark(self, params):
+        return self.cmd_respond({'PREFIX': 'sync', 'MSG': params.get('NAME', '')})
+
+    ## @brief KlipperSimulator::statistics(self) summarises the executed motion.
+    ## @return dict with the number of moves, travel [mm] and motion time [s], not scaled by time_scale.
+    def statistics(self):
+        with self.condition:
+            return {'moves': self.moves, 'travel': self.travel, 'motion_time': self.motion_time}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate klippy and the PrintHAT on a pseudo terminal.')
+    parser.add_argument('--link', default='/tmp/printer', help='symbolic link to create to the pseudo terminal')
+    parser.add_argument('--config', default=motion_model.DEFAULT_CONFIG, help='klipper config file with the motion limits')
+    parser.add_argument('--time-scale', type=float, default=1.0, help='multiplies the simulated durations, 0 answers at once')
+    args = parser.parse_args(argv)
+
+    simulator = KlipperSimulator(config=args.config, time_scale=args.time_scale, link=args.link)
+    print('Simulating klipper on ' + simulator.start() + ' (' + args.link + '), ' + repr(simulator.model))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    simulator.stop()
+    print(simulator.statistics())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+## @package motion_model.py
+## @brief motion_model.py predicts how long the XY stage takes to complete a move, from the kinematic limits in the klipper printer.cfg,
+## and detects from consecutive camera frames when the stage has come to rest.
+
+import configparser
+import math
+import os
+import numpy as np
+import cv2
+
+## @param DEFAULT_CONFIG is the printer.cfg kept in the repository, a copy of the one used by klipper in /home/pi.
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'File_Backup', 'printer.cfg')
+
+## @brief read_printer_limits(path) reads the velocity and acceleration limits from the [printer] section of a klipper config file.
+## @param path is the config file.
+## @return dict with max_velocity [mm/s], max_accel [mm/s^2] and max_accel_to_decel [mm/s^2], or None if the file or section is missing.
+def read_printer_limits(path):
+    config = configparser.ConfigParser(inline_comment_prefixes=('#', ';'), strict=False)
+    try:
+        with open(path) as f:
+            config.read_file(f)
+    except (OSError, configparser.Error):
+        return None
+    if not config.has_section('printer'):
+        return None
+    printer = config['printer']
+    max_velocity = printer.getfloat('max_velocity')
+    max_accel = printer.getfloat('max_accel')
+    if max_velocity is None or max_accel is None:
+        return None
+    ## klipper default for the pseudo deceleration limiting the cruise speed of short moves
+    max_accel_to_decel = printer.getfloat('max_accel_to_decel', max_accel / 2)
+    return {'max_velocity': max_velocity, 'max_accel': max_accel, 'max_accel_to_decel': max_accel_to_decel}
+
+## @brief MotionModel predicts the duration of a single XY move, starting and ending at rest, as klipper plans it:
+## accelerate at max_accel, cruise at most at max_velocity, decelerate at max_accel, where the cruise speed of short moves
+## is further limited by max_accel_to_decel.
+class MotionModel():
+    ## @brief MotionModel::__init__(self, max_velocity, max_accel, **kwargs)
+    ## @param max_velocity is the maximum velocity of the toolhead [mm/s]
+    ## @param max_accel is the maximum acceleration of the toolhead [mm/s^2]
+    ## @param max_accel_to_decel limits the cruise speed of short moves [mm/s^2] (default max_accel/2)
+    ## @param latency is the time between sending the G-code and the start of the move [s], klipper buffers moves before flushing them to the MCU (default 0.3)
+    ## @param settle is the time for the vibrations to damp out after the move [s] (default 0.2)
+    def __init__(self, max_velocity=10.0, max_accel=5.0, **kwargs):
+        self.max_velocity = float(max_velocity)
+        self.max_accel = float(max_accel)
+        self.max_accel_to_decel = float(kwargs['max_accel_to_decel']) if 'max_accel_to_decel' in kwargs else self.max_accel / 2
+        self.latency = kwargs['latency'] if 'latency' in kwargs else 0.3
+        self.settle = kwargs['settle'] if 'settle' in kwargs else 0.2
+
+    ## @brief MotionModel::from_config(path, **kwargs) creates a model with the limits of a klipper config file.
+    ## Falls back to the default limits if the file can not be read.
+    ## @param path is the config file (default the printer.cfg in File_Backup)
+    @classmethod
+    def from_config(cls, path=None, **kwargs):
+        limits = read_printer_limits(DEFAULT_CONFIG if path is None else path)
+        if limits is not None:
+            limits.update(kwargs)
+            return cls(**limits)
+        return cls(**kwargs)
+
+    ## @brief MotionModel::move_time(self, distance) is the duration of a move over distance [mm] from rest to rest.
+    ## @return duration [s], without latency and settling.
+    def move_time(self, distance):
+        distance = abs(float(distance))
+        if distance <= 0:
+            return 0.0
+        ## Peak speed reached, limited by the maximum velocity and by the smoothed acceleration of short moves
+        peak = min(self.max_velocity, math.sqrt(distance * self.max_accel_to_decel), math.sqrt(distance * self.max_accel))
+        ramp = peak / self.max_accel ## duration of accelerating and of decelerating
+        cruise = (distance - peak * ramp) / peak
+        return 2 * ramp + max(0.0, cruise)
+
+    ## @brief MotionModel::distance(dx, dy) is the length of a cartesian XY move [mm].
+    @staticmethod
+    def distance(dx, dy):
+        return math.hypot(float(dx), float(dy))
+
+    ## @brief MotionModel::wait_time(self, distance, settle) is the time from sending a move until the stage is expected to be still.
+    ## @param distance is the length of the move [mm]
+    ## @param settle adds the settling time (default True), leave out when settling is detected from the camera.
+    ## @return duration [ms]
+    def wait_time(self, distance, settle=True):
+        duration = self.latency + self.move_time(distance) + (self.settle if settle else 0.0)
+        return int(math.ceil(duration * 1000))
+
+    def __repr__(self):
+        return "MotionModel(max_velocity={}, max_accel={}, max_accel_to_decel={})".format(self.max_velocity, self.max_accel, self.max_accel_to_decel)
+
+## @brief SettleDetector decides from consecutive frames whether the image, and thus the stage, is still.
+## Frames are reduced to small blurred grayscale images, the stage is still when the mean absolute difference
+## between successive frames stays below a threshold for a number of frames.
+class SettleDetector():
+    ## @brief SettleDetector::__init__(self, **kwargs)
+    ## @param threshold is the mean absolute grey level difference below which two frames are equal (default 2.0)
+    ## @param frames is the number of successive equal frame pairs required (default 2)
+    ## @param size is the (width, height) the frames are reduced to (default (160, 120))
+    def __init__(self, **kwargs):
+        self.threshold = kwargs['threshold'] if 'threshold' in kwargs else 2.0
+        self.frames = kwargs['frames'] if 'frames' in kwargs else 2
+        self.size = kwargs['size'] if 'size' in kwargs else (160, 120)
+        self.reset()
+
+    ## @brief SettleDetector::reset(self) forgets the previous frames, call before waiting for a new move to settle.
+    def reset(self):
+        self.previous = None
+        self.still = 0
+        self.difference = None
+        return
+
+    ## @brief SettleDetector::update(self, frame) adds a frame.
+    ## @param frame is a grayscale or BGR image.
+    ## @return True if the last frames were equal.
+    def update(self, frame):
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        small = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(small, (5, 5), 0)
+        if self.previous is not None:
+            self.difference = float(np.mean(cv2.absdiff(small, self.previous)))
+            self.still = self.still + 1 if self.difference < self.threshold else 0
+        self.previous = small
+        return self.still >= self.frames
@@ -0,0 +1,124 @@
+## @package motion_program.py
+## @brief motion_program.py builds G-code programs for a sequence of wells and streams them to klipper, blocking only at the capture points.
+
+## @brief MotionProgram is a G-code program of moves and capture points.
+## The program is divided in segments, each segment holds the commands up to and including a capture point.
+## A capture point waits for the moves before it to finish (M400) and then reports itself with the SYNC_MARK macro of printer.cfg.
+## Within a segment the moves are sent at once, so the klipper lookahead queue plans them together without round trips.
+class MotionProgram():
+    ## @brief MotionProgram::__init__(self) creates an empty program.
+    def __init__(self):
+        self.segments = [] ## list of (name, (x, y), commands), name and position None for a trailing segment without capture
+        self.commands = []
+        self.position = None
+
+    ## @brief MotionProgram::move(self, x_pos, y_pos, speed) adds a move.
+    ## @param x_pos is the X-position [mm]
+    ## @param y_pos is the Y-position [mm]
+    ## @param speed is the speed [mm/s], None uses the klipper default (limited to max_velocity)
+    def move(self, x_pos, y_pos, speed=None):
+        command = "G0 X" + str(x_pos) + " Y" + str(y_pos)
+        if speed is not None:
+            command += " F" + str(int(round(speed * 60)))
+        self.commands.append(command)
+        self.position = (x_pos, y_pos)
+        return self
+
+    ## @brief MotionProgram::set_pin(self, pin, value) adds an output pin change, e.g. the light, executed in order with the moves.
+    def set_pin(self, pin, value):
+        self.commands.append("SET_PIN PIN=" + str(pin) + " VALUE=" + str(value))
+        return self
+
+    ## @brief MotionProgram::capture(self, name) ends the current segment with a capture point at the last move.
+    ## @param name identifies the capture point, e.g. the well, spaces are replaced in the marker.
+    def capture(self, name):
+        self.commands.append("M400")
+        self.commands.append("SYNC_MARK NAME=" + str(name).replace(' ', '_'))
+        self.segments.append((name, self.position, self.commands))
+        self.commands = []
+        return self
+
+    ## @brief MotionProgram::finish(self) adds the commands after the last capture point as a segment without capture.
+    def finish(self):
+        if self.commands:
+            self.segments.append((None, self.position, self.commands))
+            self.commands = []
+        return self
+
+    ## @brief MotionProgram::gcode(self) is the program as text.
+    def gcode(self):
+        lines = [command for name, position, commands in self.segments for command in commands]
+        return "\n".join(lines + self.commands) + "\n"
+
+    ## @brief MotionProgram::estimate(self, model, start) estimates the duration [s] of the moves of the program, excluding the captures.
+    ## @param model is the MotionModel of the stage.
+    ## @param start is the (x, y) position [mm] the program starts at.
+    def estimate(self, model, start):
+        duration = 0.0
+        position = start
+        for name, target, commands in self.segments:
+            if position is not None and target is not None:
+                duration += model.move_time(model.distance(target[0] - position[0], target[1] - position[1]))
+            position = target
+        return duration
+
+    ## @brief MotionProgram::from_wells(wells, light) builds a program visiting each well and capturing it.
+    ## @param wells is a list of (name, x, y).
+    ## @param light is the PWM value of the light during the program, None leaves it unchanged.
+    @staticmethod
+    def from_wells(wells, light=None):
+        program = MotionProgram()
+        if light is not None:
+            program.set_pin("light", light)
+        for name, x_pos, y_pos in wells:
+            program.move(x_pos, y_pos).capture(name)
+        return program
+
+## @brief ProgramStreamer sends the segments of a MotionProgram over a GcodeSerial one at a time.
+## The next segment is released as soon as the capture of the previous one is done, so the host only blocks at capture points.
+class ProgramStreamer():
+    ## @brief ProgramStreamer::__init__(self, serial, program, **kwargs)
+    ## @param serial is the GcodeSerial.
+    ## @param program is the MotionProgram.
+    ## @param timeout is the time [s] to wait for a capture point, including the moves before it (default 60)
+    def __init__(self, serial, program, **kwargs):
+        self.serial = serial
+        self.program = program.finish()
+        self.timeout = kwargs['timeout'] if 'timeout' in kwargs else 60.0
+        self.index = 0
+        self.marker = None
+
+    ## @brief ProgramStreamer::release(self) sends the next segment.
+    ## @return (name, position) of its capture point, None if the program is done.
+    def release(self):
+        if self.index >= len(self.program.segments):
+            return None
+        name, position, commands = self.program.segments[self.index]
+        self.index += 1
+        future = None
+        for command in commands:
+            ## Only the marker needs a timeout, the commands before it are answered as klipper reads them
+            future = self.serial.send(command, self.timeout if command.startswith("SYNC_MARK") else None)
+        self.marker = future if name is not None else None
+        return (name, position)
+
+    ## @brief ProgramStreamer::wait(self) waits until the stage reached the capture point of the released segment, while the Qt event loop keeps running.
+    ## @return True if the capture point was reached, False if the segment has no capture point.
+    ## @exception GcodeError, TimeoutError if klipper did not confirm the capture point.
+    def wait(self):
+        if self.marker is None:
+            return False
+        lines = self.serial.wait_for(self.marker)
+        self.marker = None
+        return lines is not None
+
+    ## @brief ProgramStreamer::cancel(self) cancels the commands that were not written yet and skips the remaining segments.
+    def cancel(self):
+        self.serial.cancel()
+        self.index = len(self.program.segments)
+        self.marker = None
+        return
+
+    ## @brief ProgramStreamer::remaining(self) is the number of segments that are not released yet.
+    def remaining(self):
+        return len(self.program.segments) - self.index
@@ -0,0 +1,145 @@
+## @package position_service.py
+## @brief position_service.py follows the G-code sent to klipper and its answers, and keeps the position of the XY stage without asking the printer.
+
+import re
+import threading
+import time
+import motor_control.motion_model as motion_model
+from motor_control.serial_printhat import GcodeSerial
+
+## @param POSITION matches the position in the answer of M114, e.g. "X:10.000 Y:20.000 Z:0.000 E:0.000".
+POSITION = re.compile(r'X:\s*([-+]?[0-9.]+)\s+Y:\s*([-+]?[0-9.]+)')
+
+## @param MOTION are the commands that move the stage or wait for it, the stage is not idle while one of them is unanswered.
+MOTION = ('G0', 'G1', 'G28', 'M400')
+
+## @param LOST are the commands after which the stage position is unknown until it is homed.
+LOST = ('M112', 'FIRMWARE_RESTART', 'M18', 'M84')
+
+## @brief parse_position(line) reads the X and Y position from an M114 answer line.
+## @return (x, y) [mm] or None if the line is no position report.
+def parse_position(line):
+    match = POSITION.search(line)
+    if match is None:
+        return None
+    return (float(match.group(1)), float(match.group(2)))
+
+## @brief parse_move(command) reads the target axes of a G0/G1 command.
+## @return dict of axis ('X', 'Y') to position [mm], empty if the command does not move X or Y.
+def parse_move(command):
+    target = {}
+    for axis, value in re.findall(r'([XY])\s*([-+]?[0-9.]+)', command.upper()):
+        target[axis] = float(value)
+    return target
+
+## @brief PositionService keeps the stage position from the commands klipper answered, listening to a GcodeSerial.
+## Klipper answers a move as soon as it is queued, so an answered move only sets the target. The stage is at the target
+## when a later M400 or G28 is answered, or when an M114 reports it while no motion is pending; that position is timestamped.
+## The end of the queued motion is estimated with the MotionModel, so is_idle() needs no serial round trip.
+class PositionService():
+    ## @brief PositionService::__init__(self, serial, **kwargs) registers the service as listener of the serial connection.
+    ## @param serial is the GcodeSerial.
+    ## @param model is the MotionModel estimating the duration of the queued moves (default from printer.cfg)
+    def __init__(self, serial, **kwargs):
+        self.serial = serial
+        self.model = kwargs['model'] if 'model' in kwargs else motion_model.MotionModel.from_config()
+        self.lock = threading.Lock()
+        self.target = None ## (x, y) [mm] after the answered moves, None if unknown
+        self.position = None ## (x, y) [mm] the stage was confirmed at, None if unknown
+        self.timestamp = None ## time.monotonic() of the confirmation
+        self.pending = 0 ## motion commands written and not answered yet
+        self.moving_until = time.monotonic() ## estimated end of the queued motion
+        if hasattr(serial, 'listeners'):
+            serial.add_listener(self.update)
+        return
+
+    ## @brief PositionService::update(self, event, command, lines) follows a command, called by the GcodeSerial threads.
+    def update(self, event, command, lines):
+        name = command.split()[0].upper() if command.strip() else ''
+        now = time.monotonic()
+        with self.lock:
+            if name in LOST:
+                self.target = None
+                self.position = None
+                self.timestamp = now
+                self.moving_until = now
+            if event == GcodeSerial.SENT:
+                if name in MOTION:
+                    self.pending += 1
+                return
+            if name in MOTION:
+                self.pending = max(0, self.pending - 1)
+            if event != GcodeSerial.ANSWERED:
+                return
+            if name in ('G0', 'G1'):
+                self.queued(parse_move(command), now)
+            elif name == 'G28':
+                homed = parse_move(command) or {'X': 0.0, 'Y': 0.0}
+                previous = self.target if self.target is not None else (0.0, 0.0)
+                self.target = (0.0 if 'X' in homed else previous[0], 0.0 if 'Y' in homed else previous[1])
+                self.confirm(now)
+            elif name == 'M400':
+                self.confirm(now)
+            elif name == 'M114':
+                for line in lines or []:
+                    reported = parse_position(line)
+                    if reported is not None:
+                        self.target = reported
+                        if self.pending == 0 and now >= self.moving_until:
+                            self.confirm(now)
+        return
+
+    ## @brief PositionService::queued(self, target, now) adds an answered move to the target and to the estimated motion, lock held.
+    def queued(self, target, now):
+        if not target:
+            return
+        if self.target is None:
+            ## Unknown start, the target is only known if the move sets both axes and its duration cannot be estimated
+            self.target = (target['X'], target['Y']) if len(target) == 2 else None
+            return
+        previous = self.target
+        self.target = (target.get('X', previous[0]), target.get('Y', previous[1]))
+        distance = self.model.distance(self.target[0] - previous[0], self.target[1] - previous[1])
+        self.moving_until = max(self.moving_until, now) + self.model.move_time(distance)
+        return
+
+    ## @brief PositionService::confirm(self, now) records that the stage is at the target, lock held.
+    def confirm(self, now):
+        self.position = self.target
+        self.timestamp = now
+        self.moving_until = now
+        return
+
+    ## @brief PositionService::get(self) is the last confirmed position of the stage.
+    ## @return ((x, y), age [s]), or (None, None) if the position is unknown.
+    def get(self):
+        with self.lock:
+            if self.position is None:
+                return None, None
+            return self.position, time.monotonic() - self.timestamp
+
+    ## @brief PositionService::get_target(self) is the position the stage is at or moving to, after the moves klipper accepted.
+    def get_target(self):
+        with self.lock:
+            return self.target
+
+    ## @brief PositionService::is_idle(self) is True if no motion command is unanswered and the queued motion should be finished.
+    def is_idle(self):
+        with self.lock:
+            return self.pending == 0 and time.monotonic() >= self.moving_until
+
+    ## @brief PositionService::is_settled(self) is True if the stage is idle at a confirmed position.
+    def is_settled(self):
+        with self.lock:
+            return self.pending == 0 and self.position is not None and self.position == self.target and time.monotonic() >= self.moving_until
+
+    ## @brief PositionService::request(self) asks klipper for its position with M114, the cache is updated when it is answered.
+    ## @return the future of the M114 command, None if not connected.
+    def request(self):
+        return self.serial.send("M114")
+
+    def __repr__(self):
+        position, age = self.get()
+        if position is None:
+            return "PositionService(position unknown, target {})".format(self.get_target())
+        return "PositionService(position ({:.2f}, {:.2f}) {:.1f}s ago, {})".format(position[0], position[1], age, "idle" if self.is_idle() else "moving")
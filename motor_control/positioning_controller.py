@@ -0,0 +1,92 @@
+## @package positioning_controller.py
+## @brief positioning_controller.py converts the well position error in the image into a stage correction move,
+## using an image-to-stage Jacobian that is estimated from the observed response to previous moves.
+
+import numpy as np
+
+## @brief PositioningController estimates the 2x2 Jacobian J between stage moves [mm] and the change of the well position error [px],
+## error_after = error_before + J * move, with recursive least squares (RLS) on every observed move.
+## The Jacobian captures the image scale, the rotation of the camera and the direction of the axes.
+## Corrections solve J * move = -error, damped and capped depending on how well the Jacobian predicted the previous moves.
+## @note The controller keeps its estimate over wells, call begin() before positioning a new well.
+class PositioningController():
+    ## @brief PositioningController::__init__(self, resolution, **kwargs)
+    ## @param resolution is the initial image resolution [mm/px], the prior Jacobian is -I/resolution (the stage moving the well towards the target).
+    ## @param forgetting is the RLS forgetting factor, lower adapts faster to changes (default 0.95)
+    ## @param max_step is the largest correction move [mm] (default 2.0)
+    ## @param min_step is the smallest move [mm] used to update the Jacobian, smaller moves are dominated by detection noise (default 0.05)
+    ## @param max_condition is the largest condition number of the Jacobian, a worse estimate is reset to the prior (default 10)
+    def __init__(self, resolution, **kwargs):
+        self.forgetting = kwargs['forgetting'] if 'forgetting' in kwargs else 0.95
+        self.max_step = kwargs['max_step'] if 'max_step' in kwargs else 2.0
+        self.min_step = kwargs['min_step'] if 'min_step' in kwargs else 0.05
+        self.max_condition = kwargs['max_condition'] if 'max_condition' in kwargs else 10.0
+        self.updates = 0
+        self.reset(resolution)
+
+    ## @brief PositioningController::reset(self, resolution) replaces the estimate by the prior, e.g. when the light source target changed.
+    ## @param resolution is the image resolution [mm/px].
+    def reset(self, resolution):
+        self.resolution = float(resolution)
+        self.prior = -np.eye(2) / self.resolution
+        self.jacobian = self.prior.copy()
+        ## Covariance of the RLS estimate, about half of the residual of a 1 mm move goes into the first update
+        self.covariance = np.eye(2)
+        ## Exponential average of the prediction error of the moves relative to the predicted response
+        self.relative_residual = 0.0
+        self.begin()
+        return
+
+    ## @brief PositioningController::begin(self) starts positioning a new well, the next error is not a response to a correction move.
+    def begin(self):
+        self.last_error = None
+        self.last_move = None
+        return
+
+    ## @brief PositioningController::gain(self) is the damping of the corrections, 1 if the Jacobian predicts the moves well, lower if not.
+    def gain(self):
+        return 1.0 / (1.0 + self.relative_residual)
+
+    ## @brief PositioningController::observe(self, error) updates the Jacobian with the response of the stage to the last move.
+    ## @param error is the (x, y) well position error [px] measured after the move.
+    def observe(self, error):
+        error = np.asarray(error, dtype=np.float64)
+        if self.last_move is not None and np.linalg.norm(self.last_move) >= self.min_step:
+            move = self.last_move
+            response = error - self.last_error
+            predicted = self.jacobian @ move
+            residual = response - predicted
+            self.relative_residual = 0.5 * self.relative_residual + 0.5 * np.linalg.norm(residual) / max(np.linalg.norm(predicted), 1e-9)
+            ## RLS update, the rows of the Jacobian share the covariance of the move
+            k = self.covariance @ move / (self.forgetting + move @ self.covariance @ move)
+            self.jacobian = self.jacobian + np.outer(residual, k)
+            self.covariance = (self.covariance - np.outer(k, move @ self.covariance)) / self.forgetting
+            self.updates += 1
+            if np.linalg.cond(self.jacobian) > self.max_condition or np.linalg.det(self.jacobian) * np.linalg.det(self.prior) <= 0:
+                ## Mirrored or degenerate estimate, the measurements were wrong, start over
+                self.jacobian = self.prior.copy()
+                self.covariance = np.eye(2)
+        self.last_error = error
+        self.last_move = None
+        return
+
+    ## @brief PositioningController::correction(self, error) is the stage move that brings the well to the target.
+    ## @param error is the (x, y) well position error [px].
+    ## @return (dx, dy) move [mm], damped by gain() and capped at max_step scaled by gain().
+    def correction(self, error):
+        error = np.asarray(error, dtype=np.float64)
+        move = -np.linalg.solve(self.jacobian, error) * self.gain()
+        cap = self.max_step * self.gain()
+        length = np.linalg.norm(move)
+        if length > cap:
+            move = move * (cap / length)
+        return move
+
+    ## @brief PositioningController::moved(self, move) records the move that was actually made, after rounding to the stage resolution.
+    ## @param move is the (dx, dy) move [mm].
+    def moved(self, move):
+        self.last_move = np.asarray(move, dtype=np.float64)
+        return
+
+    def __repr__(self):
+        return "PositioningController(jacobian={}, gain={:.2f}, updates={})".format(np.round(self.jacobian, 2).tolist(), self.gain(), self.updates)
@@ -4,6 +4,11 @@
 
 import os
 import sys
+import collections
+import concurrent.futures
+import queue
+import threading
+import time
 import serial
 import lib.signal as signal
 
@@ -11,6 +16,26 @@ from PySide2.QtWidgets import *
 from PySide2.QtCore import QTimer, QEventLoop, QTimer
 from time import sleep
 
+## @brief GcodeError is raised by the future of a G-code command that klipper answered with an error ("!!").
+class GcodeError(Exception):
+    def __init__(self, command, lines):
+        super().__init__(command + ": " + " ".join(lines))
+        self.command = command
+        self.lines = lines
+
+## @brief resolve(future, result, exception) resolves a future unless the reader, a timeout or a reset already did.
+# The threads check future.done() without holding the lock over set_result, so another thread may resolve it in between.
+# @return True if this call resolved the future.
+def resolve(future, result=None, exception=None):
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except concurrent.futures.InvalidStateError:
+        return False
+    return True
+
 ## @brief class GcodeSerial handles the /tmp/printer pseudoserial connection and writes incoming G-code. It also reads responses of the serial port.
 ## @author Gert van Lagen
 class GcodeSerial:
@@ -26,6 +51,17 @@ class GcodeSerial:
     ## @param connection_state is the boolean state of the serial interface.
     connection_state = False
 
+    ## @param manage_service restarts the klipper service on start and stops it on disconnect. Set the environment variable KLIPPER_SERVICE=off to skip this, e.g. when /tmp/printer is the simulator of klipper_sim.py.
+    manage_service = os.environ.get('KLIPPER_SERVICE', 'on').lower() != 'off'
+
+    ## @param SENT, ANSWERED and FAILED are the events passed to the listeners.
+    SENT = 'sent'
+    ANSWERED = 'answered'
+    FAILED = 'failed'
+
+    ## @param timeout is the default time [s] to wait for the acknowledgement of a command, None waits indefinitely.
+    timeout = 30.0
+
     ## @brief GcodeSerial::__init__ creates a serial instance and checks if no more than one instance is created.
     # Furthermore it restarts the klipper service in order to make sure this service is not exited due to unexpected crashes of the window.
     def __init__(self):
@@ -38,9 +74,14 @@ class GcodeSerial:
             return
         
         GcodeSerial.ins+=1
+
+        ## @param listeners are called as listener(event, command, lines) from the writer thread when a command is written (SENT, lines None)
+        ## and from the reader thread when it is answered (ANSWERED or FAILED, with its response lines), see add_listener.
+        self.listeners = []
         
         # make sure klipper service is active
-        os.system('sudo service klipper restart && sudo service klipper status | more')
+        if self.manage_service:
+            os.system('sudo service klipper restart && sudo service klipper status | more')
 
         # wait a little bit before doing anything else
 ##        self.wait_ms(100)
@@ -72,59 +113,215 @@ class GcodeSerial:
         return
 
     ## @brief GcodeSerial::connect connects to the pseudo serial port /tmp/printer. This port is the link with the klipper library which handles all the g-code and communication with the STM microcontroller.
-    # On succeed it sets the connection state to true.
+    # On succeed it sets the connection state to true and starts the writer and reader threads.
+    # Commands are queued for the writer thread, which writes them in order. Klipper answers every command with "ok",
+    # preceded by the response lines of the command and by "!!" lines if the command failed, so the reader thread
+    # matches the answers to the written commands in order.
     # @param port is the port to be connected to. 
     def connect(self, port):
         print("\nDEBUG: in function ser_comm::connect(port)")
         try:
-            ## @param self.serial is the serial instance.
-            self.serial = serial.Serial(port, timeout=0.005)
+            ## @param self.serial is the serial instance. The read timeout sets how often the reader checks the command timeouts.
+            self.serial = serial.Serial(port, timeout=0.1)
             
             ## Open the serial port if it is not opened already.
             if not self.serial.is_open:
                 print("\nERROR: Cannot connect to device on port {}".format(port))
             else:
                 print("\nDEBUG: Opened serial communication on port {}".format(port))
+                self.commands = queue.Queue() ## (command, future, timeout) waiting to be written
+                self.in_flight = collections.deque() ## [command, future, deadline, response lines, error] written, waiting for "ok"
+                self.lock = threading.Lock() ## guards in_flight
+                self.write_lock = threading.Lock() ## serialises the writes of the writer thread and emergency()
+                self.stopped = threading.Event()
+                self.writer = threading.Thread(target=self.write_commands, name='gcode writer', daemon=True)
+                self.reader = threading.Thread(target=self.read_responses, name='gcode reader', daemon=True)
+                self.writer.start()
+                self.reader.start()
                 self.setConnectionState(True)
         except Exception as e:
             print("Exception in Ser_comm::connect(self, port)", e)
         return
-    
-    ## @brief Gcode_serial::executeGcode writes a bytearray containing a G-code to the serial port.
-    # @param gcode_string is the string to be written to the serial port.
+
+    ## @brief GcodeSerial::send(self, command, timeout) queues a G-code command.
+    # @param command is the G-code line.
+    # @param timeout is the time [s] to wait for the acknowledgement after writing, default GcodeSerial.timeout, None waits indefinitely (e.g. for M400).
+    # @return concurrent.futures.Future resolved with the response lines on "ok", or failing with GcodeError, TimeoutError or CancelledError. None if not connected.
+    def send(self, command, timeout=-1):
+        if not self.getConnectionState():
+            self.msg("DEBUG: No serial connection with STM microcontroller. Restart the program.")
+            return None
+        future = concurrent.futures.Future()
+        self.commands.put((command.strip(), future, self.timeout if timeout == -1 else timeout))
+        return future
+
+    ## @brief GcodeSerial::add_listener(self, listener) registers a function that follows the commands, e.g. to track the stage position.
+    # The listener runs in the writer or reader thread and must not block.
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+        return
+
+    ## @brief GcodeSerial::notify(self, event, command, lines) calls the listeners.
+    def notify(self, event, command, lines=None):
+        for listener in self.listeners:
+            try:
+                listener(event, command, lines)
+            except Exception as e:
+                self.msg(e)
+        return
+
+    ## @brief Gcode_serial::executeGcode writes a G-code to the serial port without waiting for the answer.
+    # @param gcode_string is the string to be written to the serial port, one command per line.
+    # @return the future of the (last) command, see GcodeSerial::send.
     def executeGcode(self, gcode_string):
+        future = None
+        for command in gcode_string.splitlines():
+            if command.strip():
+                future = self.send(command)
+        return future
+
+    ## @brief GcodeSerial::emergency(self, command) cancels the queued commands and writes the command immediately, klipper handles M112 on arrival.
+    def emergency(self, command):
+        self.cancel()
         if self.getConnectionState():
+            self.notify(self.SENT, command.strip())
             try:
-                gcode_byte_array = bytearray(gcode_string, 'utf-8')
-                self.serial.write(gcode_byte_array)
-                if self.serial.inWaiting:
-                    self.signals.stm_read_request.emit()
+                ## Wait for a write of the writer thread to complete, the lines must not interleave
+                with self.write_lock:
+                    self.serial.write(bytearray(command.strip() + "\n", 'utf-8'))
             except Exception as e:
                 self.msg(e)
-        else:
-            self.msg("DEBUG: No serial connection with STM microcontroller. Restart the program.")
         return
 
-    ## @brief Gcode_serial::readPort(self) reads data from port while port is not empty with a timeout of x seconds (which is initialised in the Gcode_serial::__init__ function).
-    # @return data is the read data from the port.
+    ## @brief GcodeSerial::cancel(self) cancels the commands that are queued and not written yet.
+    def cancel(self):
+        if self.getConnectionState():
+            while True:
+                try:
+                    command, future, timeout = self.commands.get_nowait()
+                except queue.Empty:
+                    break
+                future.cancel()
+        return
+
+    ## @brief GcodeSerial::reset(self) fails the commands waiting for an answer, e.g. after a firmware restart lost them.
+    def reset(self):
+        if self.getConnectionState():
+            with self.lock:
+                waiting = list(self.in_flight)
+                self.in_flight.clear()
+            for command, future, deadline, lines, error in waiting:
+                self.notify(self.FAILED, command, ["no answer before reset"])
+                resolve(future, exception=GcodeError(command, ["no answer before reset"]))
+        return
+
+    ## @brief GcodeSerial::write_commands(self) is the writer thread, it writes the queued commands in order.
+    def write_commands(self):
+        while not self.stopped.is_set():
+            try:
+                command, future, timeout = self.commands.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue ## cancelled while queued
+            deadline = None if timeout is None else time.monotonic() + timeout
+            with self.lock:
+                ## Append before writing, the answer may arrive before write returns
+                self.in_flight.append([command, future, deadline, [], False])
+            self.notify(self.SENT, command)
+            try:
+                with self.write_lock:
+                    self.serial.write(bytearray(command + "\n", 'utf-8'))
+            except Exception as e:
+                with self.lock:
+                    if self.in_flight and self.in_flight[-1][1] is future: ## a reset may have cleared it
+                        self.in_flight.pop()
+                resolve(future, exception=e)
+                self.notify(self.FAILED, command, [str(e)])
+        return
+
+    ## @brief GcodeSerial::read_responses(self) is the reader thread, it reads the answers line by line and resolves the futures of the commands in order.
+    def read_responses(self):
+        while not self.stopped.is_set():
+            try:
+                line = self.serial.readline()
+            except Exception as e:
+                if not self.stopped.is_set():
+                    self.msg(e)
+                    self.stopped.wait(0.1)
+                continue
+            ## The reader must survive any error, the commands would never be answered without it
+            try:
+                if line:
+                    self.handle_line(line.decode('utf-8', 'replace').strip())
+                self.expire()
+            except Exception as e:
+                self.msg("reader: " + str(e))
+        return
+
+    ## @brief GcodeSerial::handle_line(self, line) adds a response line to the oldest command waiting for an answer, and resolves it on "ok".
+    def handle_line(self, line):
+        if not line:
+            return
+        with self.lock:
+            entry = self.in_flight[0] if self.in_flight else None
+            if entry is not None and line.startswith('ok'):
+                self.in_flight.popleft()
+        if not line.startswith('ok'):
+            self.msg(line)
+        if entry is None:
+            return ## not an answer to a command, e.g. a shutdown message
+        if line.startswith('ok'):
+            command, future, deadline, lines, error = entry
+            self.notify(self.FAILED if error else self.ANSWERED, command, lines)
+            ## The future may have timed out
+            if error:
+                resolve(future, exception=GcodeError(command, lines))
+            else:
+                resolve(future, lines)
+            ## Check if confirmation is stored in data ("ok"). Alse verify if the first movement is already finished in order to avoid to early well analysation.
+            if self.first_move is True:
+                self.signals.confirmation.emit()
+            return
+        if line.startswith('!!'):
+            entry[4] = True
+        entry[3].append(line)
+        return
+
+    ## @brief GcodeSerial::expire(self) fails the futures of the commands that are not answered in time.
+    # The commands stay in flight, a late "ok" still belongs to them.
+    def expire(self):
+        now = time.monotonic()
+        with self.lock:
+            expired = [entry for entry in self.in_flight if entry[2] is not None and entry[2] < now and not entry[1].done()]
+        for command, future, deadline, lines, error in expired:
+            resolve(future, exception=TimeoutError(command))
+        return
+
+    ## @brief GcodeSerial::wait_for(self, future, timeout) keeps the Qt event loop running until the command is answered.
+    # @param future is a future returned by send or executeGcode.
+    # @param timeout is the maximum time [s] to wait, None waits until the future is done.
+    # @return the response lines, or None if there is no future.
+    # @exception GcodeError, TimeoutError or CancelledError if the command failed.
+    def wait_for(self, future, timeout=None):
+        if future is None:
+            return None
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not future.done():
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError("waiting for G-code answer")
+            self.wait_ms(10)
+        return future.result()
+
+    ## @brief Gcode_serial::readPort(self) reports the commands waiting for an answer, the answers themselves are read by the reader thread.
+    # @return the number of commands waiting for an answer.
     def readPort(self):
-        #self.msg("Please wait, reading data from STM...")
-        self.wait_ms(1)
-        empty = "b\'\'"
-        confirmation = 'ok'
-        data = self.serial.readline()
-        bytes_left = self.serial.inWaiting
-        if bytes_left:
-            data += self.serial.readline()
-        
-        read = str(data)
-        if not (read.find(empty) >= 0):
-            self.msg(read)
-        
-        ## Check if confirmation is stored in data ("ok"). Alse verify if the first movement is already finished in order to avoid to early well analysation.
-        if read.find(confirmation, 0, len(read)) >= 0 and self.first_move is True:
-            self.signals.confirmation.emit()
-        return data
+        if not self.getConnectionState():
+            return 0
+        with self.lock:
+            waiting = [entry[0] for entry in self.in_flight]
+        self.msg(str(len(waiting)) + " commands waiting for an answer" + (": " + ", ".join(waiting) if waiting else ""))
+        return len(waiting)
 
     ## @brief Gcode_serial::wait_ms(self, milliseconds) is a delay function.
     ## @param milliseconds is the number of milliseconds to wait.
@@ -140,11 +337,19 @@ class GcodeSerial:
         try:
             ## Stop motors
             print("\nDEBUG: stop motors using M18 G-code command")
-            self.serial.write(b"M18\r\n")
+            self.wait_for(self.send("M18"), 1.0)
+        except Exception as e:
+            print("exeption on stopping motors: \n", e)
+        try:
+            if self.getConnectionState():
+                self.stopped.set()
+                self.writer.join()
+                self.reader.join()
         
             ## Stop klipper service and show its status
-            print("\nDEBUG: stop klipper service")
-            os.system('sudo service klipper stop && sudo service klipper status | more')
+            if self.manage_service:
+                print("\nDEBUG: stop klipper service")
+                os.system('sudo service klipper stop && sudo service klipper status | more')
         
             ## Disconnect if connection is true
             if self.getConnectionState():
@@ -4,7 +4,13 @@
 
 ##import main
 import motor_control.serial_printhat as serial_printhat
+from motor_control.motion_model import MotionModel, SettleDetector
+import motor_control.positioning_controller as positioning_controller
+from motor_control.homing_policy import HomingPolicy
+import motor_control.motion_program as motion_program
+from motor_control.position_service import PositionService
 import lib.imageProcessor as imageProcessor
+from lib.imagePyramid import ImagePyramid
 import lib.signal as signal
 import numpy as np
 import math
@@ -23,6 +29,10 @@ class StepperControl():
     move_confirmed = False
     homing_confirmed = False
     PrintHAT_serial = serial_printhat.GcodeSerial()
+    homing_policy = HomingPolicy() ## decides when the stage position can no longer be trusted and needs homing
+    position_service = PositionService(PrintHAT_serial) ## stage position and idle state from the answers of klipper
+    homing_timeout = 120.0 ## s, homing 210mm at 5mm/s plus the retracts
+    move_timeout = 60.0 ## s, longest move plus the moves queued before it
 
     ## @brief StepperControl::__init__(self) sets the motor position instance variable to zero.
     def __init__(self):
@@ -47,10 +57,14 @@ class StepperControl():
         GeneralEventLoop.exec_()
         return
 
+    ## @brief StepperControl::getPositionFromSTM(self) asks klipper for the stage position and updates the position service with the answer.
     def getPositionFromSTM(self):
         if self.PrintHAT_serial.getConnectionState():
-            gcode_string = "M114\r\n"
-            self.PrintHAT_serial.executeGcode(gcode_string)
+            try:
+                self.PrintHAT_serial.wait_for(self.position_service.request(), 1.0)
+            except Exception as e:
+                self.msg("M114 failed: " + str(e))
+            self.msg(self.position_service)
         else:
             self.msg("DEBUG: No serial connection with STM microcontroller. Restart the program.")
         return
@@ -77,6 +91,15 @@ class StepperControl():
         self.position_y = float(y_pos)
         return        
 
+    ## @brief StepperControl::syncPosition(self) takes the commanded position from the position service when no move is pending,
+    ## so a move klipper rejected, e.g. out of range, does not shift the following jogs.
+    def syncPosition(self):
+        target = self.position_service.get_target()
+        if target is not None and self.position_service.is_idle():
+            self.setPositionX(target[0])
+            self.setPositionY(target[1])
+        return
+
     @Slot()
     def setMoveConfirmed(self):
         self.move_confirmed = True
@@ -84,62 +107,45 @@ class StepperControl():
 
     ## @brief StepperControl::homeXY(self) creates and executes a homing G-code string for the X-axis.
     def homeXY(self):
-        read = str
-        confirmation = 'ok'
-        triggered = 'still triggered'
         if self.PrintHAT_serial.getConnectionState():
             self.msg("Homing X and Y axis")
-            gcode_string = "G28 X0 Y0\r\n"
-            self.PrintHAT_serial.executeGcode(gcode_string)
-            
             self.homing_confirmed = False
-            read = str(self.PrintHAT_serial.readPort())
-            while (read.find(confirmation, 0, len(read)) <= 0) and (read.find(triggered, 0, len(read)) <= 0):
-                read = str(self.PrintHAT_serial.readPort())
-                ## Manually confirmed somewhere in software
-                if self.homing_confirmed:
-                    self.msg("Homing manually confirmed in software")
-                    break
-            
-                if read.find(confirmation, 0, len(read)) >= 0:
-                    self.msg("Homing confirmed by STM")
-                    self.homing_confirmed = True
-
-                if read.find(triggered, 0, len(read)) >= 0:
-                    self.msg("Homing failed")
-                    self.homing_confirmed = False
-                
+            try:
+                self.PrintHAT_serial.wait_for(self.PrintHAT_serial.send("G28 X0 Y0", self.homing_timeout))
+                self.msg("Homing confirmed by STM")
+                self.homing_confirmed = True
+            except Exception as e:
+                ## e.g. "!! Endstop x still triggered after retract"
+                self.msg("Homing failed: " + str(e))
             self.setPositionX(0)
             self.setPositionY(0)
+            self.homing_policy.homed(self.homing_confirmed)
         else:
             self.msg("DEBUG: No serial connection with STM microcontroller. Restart the program.")
         return
 
+    ## @brief StepperControl::move(self, x_pos, y_pos) sends a move and waits until klipper reports it finished (M400), while the Qt event loop keeps running.
+    ## @param x_pos is the desired X-position
+    ## @param y_pos is the desired Y-position
+    ## @return True if the move finished.
+    def move(self, x_pos, y_pos):
+        self.move_confirmed = False
+        self.PrintHAT_serial.send("G0 X" + str(x_pos) + " Y" + str(y_pos))
+        try:
+            self.PrintHAT_serial.wait_for(self.PrintHAT_serial.send("M400", self.move_timeout))
+            self.move_confirmed = True
+        except Exception as e:
+            self.msg("Move to (" + str(x_pos) + ", " + str(y_pos) + ") failed: " + str(e))
+        return self.move_confirmed
+
     ## @brief StepperControl::gotoXY(self, x_pos, y_pos) creates and executes a move G-code string for the XY-axis
     ## @param x_pos is the desired X-position
     ## @param y_pos is the desired Y-position
     def gotoXY(self, x_pos, y_pos):
         print("in functionStepperControl::gotoXY")
-        read = str
-        confirmation = 'ok'
         if self.PrintHAT_serial.getConnectionState():
-            gcode_string = "G0 X" + str(x_pos) + " Y" + str(y_pos) + "\r\n"
-            wait_for_finishing = "M400\r\n"
-            self.PrintHAT_serial.executeGcode(gcode_string)
-            self.PrintHAT_serial.executeGcode(wait_for_finishing)
             self.signals.well_unknown.emit()
-            self.move_confirmed = False
-            read = str(self.PrintHAT_serial.readPort())
-            while (read.find(confirmation, 0, len(read)) <= 0):
-                #print("Waiting for gotoXY move confirmation")
-                read = str(self.PrintHAT_serial.readPort())
-                if read.find(confirmation, 0, len(read)) >= 0:
-                    #self.msg("Move confirmed by STM")
-                    self.move_confirmed = True
-                ## If manually confirmed somewhere in software
-                if self.move_confirmed:
-                    break    
-            
+            self.move(x_pos, y_pos)
             self.setPositionX(x_pos)
             self.setPositionY(y_pos)
         else:
@@ -152,29 +158,8 @@ class StepperControl():
     ## @param row is the desired Y-position
     def moveToWell(self, column, row):
 ##        print("StepperControl::moveToWell thread check: " + str(QThread.currentThread()))
-        self.move_confirmed = False
-        read = str
-        confirmation = 'ok'
         if self.PrintHAT_serial.getConnectionState():
-            gcode_string = "G0 X" + str(column) + " Y" + str(row) + "\r\n"
-            wait_for_finishing = "M400\r\n"
-            self.PrintHAT_serial.executeGcode(gcode_string)
-            self.PrintHAT_serial.executeGcode(wait_for_finishing)
-
-            read = str(self.PrintHAT_serial.readPort())
-            while (read.find(confirmation, 0, len(read)) <= 0) and not self.move_confirmed:
-                print("Waiting for moveToWell move confirmation")
-##                read = str(self.PrintHAT_serial.readPort())
-                ## If manually confirmed somewhere in software
-                if self.move_confirmed:
-                    #self.msg("Move to well manually confirmed in software")
-                    break  
-                if read.find(confirmation, 0, len(read)) >= 0:
-##                    self.msg("Move confirmed by STM")
-                    print("Move confirmed by STM")
-                    self.move_confirmed = True
-                    break  
-
+            self.move(column, row)
             self.setPositionX(column)
             self.setPositionY(row)
         else:
@@ -186,6 +171,7 @@ class StepperControl():
         print("in function StepperControl::turnUp()")
         if self.PrintHAT_serial.getConnectionState():
             self.signals.well_unknown.emit()
+            self.syncPosition()
             newPosition = self.getPositionY()
             newPosition +=1
             self.setPositionY(newPosition)
@@ -202,6 +188,7 @@ class StepperControl():
         print("in function StepperControl::turnLeft()")
         if self.PrintHAT_serial.getConnectionState():
             self.signals.well_unknown.emit()
+            self.syncPosition()
             if self.getPositionX() > 0:
                 newPosition = self.getPositionX()
                 newPosition -=1
@@ -221,6 +208,7 @@ class StepperControl():
         print("in function StepperControl::turnRight()")
         if self.PrintHAT_serial.getConnectionState():
             self.signals.well_unknown.emit()
+            self.syncPosition()
             newPosition = self.getPositionX()
             newPosition +=1
             self.setPositionX(newPosition)
@@ -237,6 +225,7 @@ class StepperControl():
         print("in function StepperControl::turnDown()")
         if self.PrintHAT_serial.getConnectionState():
             self.signals.well_unknown.emit()
+            self.syncPosition()
             if self.getPositionY() > 0:
                 newPosition = self.getPositionY()
                 newPosition -=1
@@ -255,7 +244,10 @@ class StepperControl():
     def firmwareRestart(self):
         print("in function StepperControl::firmwareRestart(self)")
         gcode_string = "FIRMWARE_RESTART\r\n"
+        self.PrintHAT_serial.cancel()
+        self.PrintHAT_serial.reset() ## the commands in flight are not answered after the restart
         self.PrintHAT_serial.executeGcode(gcode_string)
+        self.homing_policy.error("firmware restart")
         return
 
     ## @brief StepperControl::emergencyBreak(self) stops all motors and shuts down the STM microcontroller. A firmware restart command is necessary to restart the system.
@@ -263,7 +255,8 @@ class StepperControl():
         print("in function Steppercontrol::emergencyBreak(self)")
         gcode_string = "M112\r\n"
         self.msg("Emergency break! Restart the firmware usingn the button FIRMWARE_RESTART")
-        self.PrintHAT_serial.executeGcode(gcode_string)
+        self.PrintHAT_serial.emergency(gcode_string) ## skip the queued commands
+        self.homing_policy.error("emergency break")
         self.signals.process_inactive.emit() ## Stops current batch process if running
         return
 
@@ -314,6 +307,7 @@ class StepperControl():
         if self.PrintHAT_serial.getConnectionState():
             gcode_string = "M84\r\n"
             self.PrintHAT_serial.executeGcode(gcode_string)
+            self.homing_policy.error("motors disabled")
             self.msg("DEBUG: Stop the idle hold on all axis ")
             # see https://reprap.org/wiki/G-code#M84:_Stop_idle_hold
         else:
@@ -335,12 +329,19 @@ class StepperWellPositioning():
     SnapshotEventLoop = None
     SnapshotTaken = False
     image = np.ndarray
+    pyramid = None ## ImagePyramid of self.image, shared with the preview when the snapshot comes from the camera
     image_area = None
     WPE = None
     WPE_target = None
     WPE_targetRadius = None
+    tracker = None ## WellTracker, reference patches of the wells locked before
+    current_well_id = None
     Well_Map = None
     diaphragm_diameter = 12.0 ## mm
+    motion_model = None ## MotionModel, predicts the duration of the moves
+    controller = None ## PositioningController, converts the well position error into a correction move
+    settle_detector = None ## SettleDetector, detects from the snapshots when the stage is still, None waits the modelled settling time
+    settle_timeout_ms = 3000 ## maximum time to wait for the image to settle after the predicted end of a move
 
     ## @brief StepperWellPositioning()::__init__ initialises the stepper objects for X and Y axis and initialises the gcodeSerial to the class member variable.
     ## @param steppers is the StepperControl object representing the X- and Y-axis
@@ -350,6 +351,8 @@ class StepperWellPositioning():
         self.Well_Map = Well_data        
         log_fine_tuning = False if record_path is None else True            
         self.path = record_path
+        self.motion_model = MotionModel.from_config()
+        self.settle_detector = SettleDetector()
         return
 
     ## @brief StepperWellPositioning()::msg emits the message signal. This emit will be catched by the logging slot function in main.py.
@@ -388,17 +391,94 @@ class StepperWellPositioning():
         QTimer.singleShot(milliseconds, GeneralEventLoop.exit)
         GeneralEventLoop.exec_()
         return
-    
+
+    ## @brief StepperWellPositioning()::wait_for_move(self, distance, start_time) waits until the stage is still after a move.
+    ## StepperControl::move() already returns when klipper reports the motion finished (M400), so only the settling is left:
+    ## takes snapshots until successive frames are equal, or waits the modelled settling time if there is no settle detector.
+    ## @param distance is the length of the move [mm], only logged against the duration predicted by the motion model
+    ## @param start_time is the time the move was sent [ms]
+    def wait_for_move(self, distance, start_time):
+        predicted = self.motion_model.wait_time(distance, settle=False)
+        self.wait_for_settle()
+        self.msg("Move of {:.1f}mm took {}ms, predicted {}ms".format(distance, current_milli_time() - start_time, predicted))
+        return
+
+    ## @brief StepperWellPositioning()::wait_for_settle(self) takes snapshots until successive frames are equal, after the motion itself finished.
+    ## Waits the modelled settling time if there is no settle detector.
+    def wait_for_settle(self):
+        if self.settle_detector is None:
+            self.wait_ms(int(self.motion_model.settle * 1000))
+            return
+        self.settle_detector.reset()
+        deadline = current_milli_time() + self.settle_timeout_ms
+        while not self.Stopped:
+            self.snapshot_request()
+            self.snapshot_await()
+            if self.image is not None and self.settle_detector.update(self.image):
+                break
+            if current_milli_time() > deadline:
+                self.msg("Image not settled after " + str(self.settle_timeout_ms) + "ms, difference: " + str(self.settle_detector.difference))
+                break
+        return
+
+    ## @brief StepperWellPositioning()::run_program(self, program, capture) streams a motion program and calls capture at each of its capture points.
+    ## The moves up to a capture point are sent at once, klipper confirms the capture point when they are finished.
+    ## The stage holds at the capture point until capture returns, then the next segment is released.
+    ## @param program is the MotionProgram, its captures are named by the well id.
+    ## @param capture is called with the name of the capture point when the stage is still, returning False aborts the program.
+    ## @return True if the program completed.
+    def run_program(self, program, capture=None):
+        serial = self.stepper_control.PrintHAT_serial
+        if not serial.getConnectionState():
+            self.msg("DEBUG: No serial connection with STM microcontroller. Restart the program.")
+            return False
+        self.signals.process_active.emit()
+        self.Stopped = False
+        streamer = motion_program.ProgramStreamer(serial, program, timeout=self.stepper_control.move_timeout)
+        self.msg("Streaming " + str(streamer.remaining()) + " segments, estimated travel time {:.1f}s".format(
+            program.estimate(self.motion_model, (self.stepper_control.getPositionX(), self.stepper_control.getPositionY()))))
+        completed = True
+        while streamer.remaining() > 0:
+            start_time = current_milli_time()
+            name, target = streamer.release()
+            try:
+                reached = streamer.wait()
+            except Exception as e:
+                self.msg("Motion program stopped before " + str(name) + ": " + str(e))
+                streamer.cancel()
+                self.stepper_control.homing_policy.error("motion program failed")
+                self.reset_current_well()
+                completed = False
+                break
+            if target is not None:
+                self.stepper_control.setPositionX(target[0])
+                self.stepper_control.setPositionY(target[1])
+                self.set_current_well(target[0], target[1])
+            if not reached:
+                continue
+            self.wait_for_settle()
+            self.msg("Reached " + str(name) + " after " + str(current_milli_time() - start_time) + "ms")
+            self.current_well_id = name
+            if self.Stopped or (capture is not None and capture(name) is False):
+                streamer.cancel()
+                completed = False
+                break
+        self.stepper_control.setLightPWM(0.0)
+        self.stepper_control.move_confirmed = True
+        return completed
+
     ## @brief StepperWellPositioning()::goto_well(self, row, column): 
     ## @author Robin Meekers
     ## @author Gert van Lagen (ported to new prototype which makes use of the Wrecklab PrintHAT)
+    ## @param well_id identifies the well for the tracker, e.g. its name in batch.ini, None disables tracking
     @Slot()
-    def goto_well(self, row, column, adapt_to_well=False):
+    def goto_well(self, row, column, adapt_to_well=False, well_id=None):
         print("In goto_well function")
         print(" adapt to well is " + str(adapt_to_well))
 ##        self.stepper_control.enableMotors()
         self.signals.process_active.emit()
         self.Stopped = False
+        self.current_well_id = well_id
         self.stepper_control.setLightPWM(1.0)
 
         ## If the Well Position Evaluator is not initialized.
@@ -407,29 +487,36 @@ class StepperWellPositioning():
             self.snapshot_request()
             self.snapshot_await()
             self.WPE_target = (int(self.image.shape[1] / 2), int(self.image.shape[0] / 2))
-            self.WPE = imageProcessor.WellPositionEvaluator((self.image.shape[0], self.image.shape[1]))
+            self.WPE = imageProcessor.WellPositionEvaluator((self.image.shape[1], self.image.shape[0]), coarseToFine=True) ## (width, height)
+            self.tracker = imageProcessor.WellTracker()
 
         self.msg("Current well: " + str(self.get_current_well()))
         current_row, current_column = self.get_current_well()
         
+        ## Well unknown, the stage position is still trusted if the light source was located before and the homing policy sees no reason to home
+        if (current_row is None or current_column is None) and self.WPE_targetRadius is not None and not self.stepper_control.homing_policy.should_home():
+            self.msg("Current well unknown, homing skipped: " + str(self.stepper_control.homing_policy))
+
         ## Position unknown
-        if current_row is None or current_column is None:
+        elif current_row is None or current_column is None:
             ## Need to go to home position first
-            self.msg("Current position unknown. Moving to home...")
+            self.msg("Current position unknown (" + str(self.stepper_control.homing_policy.reason()) + "). Moving to home...")
             self.stepper_control.homeXY()
 
             ## If homing is succeeded and confirmed by the STM of the Wrecklab PrintHAT
             if self.stepper_control.homing_confirmed:
+                ## Wait for the stage to come to rest at the endstops, the last snapshot is stored in self.image
                 self.image = None
-                self.snapshot_request()
-                self.snapshot_await()
-                self.wait_ms(1000) ## Wait for the snapshot to be stored in self.image
+                self.wait_for_settle()
+                if self.image is None:
+                    self.snapshot_request()
+                    self.snapshot_await()
                 
                 ## Arrived at home, move to first well.
                 ## The exact centre of the image can more easily be determined at the home position,
                 ## as there is no distortion in the image by light refracting.
                 self.msg("Looking for light source...")
-                WPE_Error = self.WPE.evaluate(self.image, (int(self.image.shape[1] / 2), int(self.image.shape[0] / 2)))
+                WPE_Error = self.WPE.evaluate(self.pyramid, (int(self.image.shape[1] / 2), int(self.image.shape[0] / 2)))
                 self.msg("Found light-source at: (" + str(WPE_Error[0][0]) + " | " + str(WPE_Error[0][1]) + "). Radius: " + str(WPE_Error[2]))
                 
                 self.WPE_targetRadius = WPE_Error[2]
@@ -440,6 +527,12 @@ class StepperWellPositioning():
                 
                 self.WPE.circle_minRadius = int(self.WPE_targetRadius * 0.8) ## Roughly the amount remaining if the target is on the edge between wells.
                 self.WPE.circle_maxRadius = int(self.WPE_targetRadius) ## The well can never be larger than the diaphragm of the light source.
+                self.tracker.forget() ## The target changed, the stored offsets are no longer valid
+                ## The resolution follows from the size of the light source in the image
+                if self.controller is None:
+                    self.controller = positioning_controller.PositioningController(self.diaphragm_diameter/self.WPE_targetRadius)
+                else:
+                    self.controller.reset(self.diaphragm_diameter/self.WPE_targetRadius)
                 
 ##                ## Homing succeeded, light source found, lets move to the first target of Well_map
 ##                self.set_current_well(column, row)
@@ -452,41 +545,19 @@ class StepperWellPositioning():
         if self.process_activity:
 
             # JV: column and row is probably X and Y in Robin's functions, also in Gert's functions?
+            dist = self.motion_model.distance(float(column) - self.stepper_control.getPositionX(), float(row) - self.stepper_control.getPositionY())
+            start_time = current_milli_time()
             self.stepper_control.moveToWell(column, row)
-            
-            ## Wait for ms depending on moving distance, JV:why?
-            if self.current_well_column is None or self.current_well_row is None:
-                dist = 60
-            else:
-                dist = math.sqrt(float(abs(float(column)-float(self.current_well_column)) * abs(float(column)-float(self.current_well_column))) + float(abs(float(row)-float(self.current_well_row)) * abs(float(row)-float(self.current_well_row))))
-            self.msg("Moving distance: " + str(dist))
-            if dist < 20:
-                self.msg("Delay: 1999ms | dist: " + str(dist) + "mm")
-                self.wait_ms(1999)
-            elif dist < 50:
-                self.msg("Delay: 3999ms | dist: " + str(dist) + "mm")
-                self.wait_ms(3999)
-            elif dist < 70:
-                self.msg("Delay: 5999ms | dist: " + str(dist) + "mm")
-                self.wait_ms(5999)
-            elif dist < 85:
-                self.msg("Delay: 8999ms | dist: " + str(dist) + "mm")
-                self.wait_ms(8999)
-            elif dist > 85:
-                self.msg("Delay: 11999ms | dist: " + str(dist) + "mm")
-                self.wait_ms(11999)
-            else:
-                self.msg("Delay: 4999ms | Unknown dist: " + str(dist) + "mm")
-                self.wait_ms(4999)
-            
+
+            ## Wait until the move is finished and the stage is still
+            self.wait_for_move(dist, start_time)
+
             self.set_current_well(column, row)
             print(str(self.WPE_target[0]) + " | " + str(self.WPE_target[1]) + " first run " + str(adapt_to_well))
             
 
             if adapt_to_well:
                 self.goto_target()
-            else:
-                self.wait_ms(2000) ## Wait for the snapshot to be stored in self.image
             self.msg("Well positioning succeeded.")
             ## Manual confirmation needed. STM is too fast for the software to catch the last confirmation.
             self.stepper_control.move_confirmed = True
@@ -523,10 +594,13 @@ class StepperWellPositioning():
         loops_ = 0
         error_count = 0
         WPE_Error = None
+        tracked = False
         new_column = 0
         new_row = 0
         error_threshold = 100#50#120 # higher number means lower error...
-        resolution = self.diaphragm_diameter/self.WPE_targetRadius # [mm/px]
+        if self.controller is None:
+            self.controller = positioning_controller.PositioningController(self.diaphragm_diameter/self.WPE_targetRadius)
+        self.controller.begin()
 
         run_start_time = current_milli_time()
         if self.path is not None:
@@ -546,16 +620,20 @@ class StepperWellPositioning():
                     #self.msg("!Returning from alignment controller loop in StepperWellPositioning::goto_target")
                     print("!Returning from alignment controller loop in StepperWellPositioning::goto_target")
                     return False
-                ## Wait for image to stabilize and request new snapshot
-                self.wait_ms(2000)
+                ## The stage is still after goto_well and after each correction move, request a new snapshot
+                ## and wait for it to be stored in self.image
                 self.snapshot_request()
-                
-                ## Wait for snapshot to be stored in self.image
-                self.wait_ms(1000) 
+                self.snapshot_await()
 
                 ## Evaluate current wellposition relative to the light source.
-                WPE_Error = self.WPE.evaluate(self.image, self.WPE_target)
-                self.msg("WPE target at (" + str(self.WPE_target[0]) + " | " + str(self.WPE_target[1]) + ")")
+                ## Track a well locked before by phase correlation, use the evaluator if there is no reference or the correlation is weak.
+                WPE_Error = None
+                if self.tracker is not None and self.current_well_id is not None:
+                    WPE_Error = self.tracker.track(self.current_well_id, self.pyramid)
+                tracked = WPE_Error is not None
+                if not tracked:
+                    WPE_Error = self.WPE.evaluate(self.pyramid, self.WPE_target)
+                self.msg("WPE target at (" + str(self.WPE_target[0]) + " | " + str(self.WPE_target[1]) + ")" + (" (tracked)" if tracked else ""))
 
                 ## Area error, surface smaller or equal to 0
                 if WPE_Error[1] <= 0:
@@ -563,11 +641,15 @@ class StepperWellPositioning():
                     error_count = error_count + 1
                     if (error_count >=3):
                         self.msg("Error_count = " + str(error_count))
+                        self.stepper_control.homing_policy.error("well not found")
                         return False
                     continue
                 else:
-                    self.msg("Well found at offset (" + str(WPE_Error[0][0]) + " | " + str(WPE_Error[0][1]) + ")")
-                    self.signals.well_located.emit((self.WPE_target[0]+WPE_Error[0][0], self.WPE_target[1]+WPE_Error[0][1], WPE_Error[2]))
+                    self.msg("Well found at offset (" + str(np.round(WPE_Error[0][0], 1)) + " | " + str(np.round(WPE_Error[0][1], 1)) + ")")
+                    self.signals.well_located.emit((int(round(self.WPE_target[0]+WPE_Error[0][0])), int(round(self.WPE_target[1]+WPE_Error[0][1])), WPE_Error[2]))
+
+                ## Learn from the response to the previous correction move
+                self.controller.observe(WPE_Error[0])
 
 #                     ## Some 
 #                     error_count = 0
@@ -594,21 +676,26 @@ class StepperWellPositioning():
                 print(" well placement error: {}, while acceptable error:{}".format(error,threshold))
 
                 if error > threshold:
-                    # Decrease stepsize on each iteration for smooth convergence
-                    new_column = float(WPE_Error[0][0])*resolution / (loops_+1)
-                    new_row = float(WPE_Error[0][1])*resolution / (loops_+1)
+                    # Correction damped and capped by the controller, depending on how well it predicted the previous moves
+                    step = self.controller.correction(WPE_Error[0])
                     column, row = self.get_current_well()
-                    new_column += column
-                    new_row += row
-                    new_column = round(new_column,1)
-                    new_row = round(new_row,1)
+                    new_column = round(column + step[0], 1)
+                    new_row = round(row + step[1], 1)
+                    self.controller.moved((new_column - column, new_row - row))
+                    self.msg("Correction (" + str(round(new_column - column, 1)) + " | " + str(round(new_row - row, 1)) + ") mm, " + str(self.controller))
+                    start_time = current_milli_time()
                     self.stepper_control.moveToWell(new_column, new_row)
+                    self.wait_for_move(self.motion_model.distance(new_column - column, new_row - row), start_time)
                     self.set_current_well(new_column, new_row)
                 else:
+                    ## Locked by the evaluator, keep this view as reference for the next visits (tracked locks keep the old reference)
+                    if self.tracker is not None and self.current_well_id is not None and not tracked:
+                        self.tracker.store(self.current_well_id, self.pyramid, self.WPE_target, WPE_Error)
                     break
                 loops_ += 1
                 if loops_ > 5:
                     self.msg("Too many correction loops, giving up")
+                    self.stepper_control.homing_policy.error("positioning did not converge")
                     break
             if not self.process_activity:
                 #self.msg("Returning from alignment controller loop in StepperWellPositioning::goto_target")
@@ -634,9 +721,11 @@ class StepperWellPositioning():
 
     ## @brief StepperWellPositioning()::snapshot_confirmed(self, snapshot) exits the event loop of snapshot_await when the new image is arived. 
     ## It updates the self.image variable with the new variable and defines the image area and WPE_target. 
-    @Slot(np.ndarray)
+    ## @param snapshot is the image, or the ImagePyramid of it
+    @Slot(object)
     def snapshot_confirmed(self, snapshot):
-        self.image = snapshot
+        self.pyramid = ImagePyramid.of(snapshot)
+        self.image = self.pyramid.image
 #         self.WPE_target = (int(self.image.shape[1] / 2), int(self.image.shape[0] / 2))
         self.image_area = int((self.image.shape[0]*self.image.shape[1]))
         self.SnapshotTaken = True
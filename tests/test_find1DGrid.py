@@ -0,0 +1,108 @@
+"""@package docstring
+Equivalence test of the vectorised find1DGrid against the original per-sample loop.
+
+Run from the repository root:
+    python -m pytest -q tests
+"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+import cv2
+from lib.imageSegmenter import find1DGrid
+from benchmark.synthetic import renderPlate
+
+## @brief referenceMovingAverage(x, N) is the original 1-D moving average.
+def referenceMovingAverage(x, N=5):
+    if N > 1 and (N & 1) == 1:
+        x = np.pad(x, pad_width=(N // 2, N // 2),
+                   mode='constant')  # Assuming N is odd
+        cumsum = np.cumsum(np.insert(x, 0, 0))
+        return (cumsum[N:] - cumsum[:-N]) / float(N)
+    else:
+        raise ValueError("Moving average size must be odd and greater than 1.")
+
+## @brief referenceFind1DGrid(data, N) is a frozen copy of find1DGrid before it was vectorised.
+def referenceFind1DGrid(data, N):
+    if N <= 1:
+        raise ValueError('findGrid parameter <= 1')
+    if (N & 1) != 1:  # enforce N to be odd
+        N += 1
+    gridSmoothKsize = N
+    gridMinSegmentLength = 10*N
+
+    # High-pass filter, to suppress uneven illumination
+    data = np.abs(data - referenceMovingAverage(data, int(3*N)))
+    data[:N] = 0 # cut off MA artifacts
+    data[-N:] = 0 # cut off MA artifacts
+    smooth_data = referenceMovingAverage(data, gridSmoothKsize)
+    smooth_data = smooth_data - np.mean(smooth_data)
+    mask_data = np.zeros(data.shape, dtype='bool')  # mask grid lines
+    mask_data[np.where(smooth_data < 0)[0]] = True
+
+    # Now filter mask_data based on segment length and suppress too short segments
+    prev_x = False
+    segmentLength = 0
+    segmentList = []
+    for index, x in enumerate(mask_data):
+        if x:  # segment
+            segmentLength += 1
+        elif x != prev_x:  # falling edge
+            if segmentLength < gridMinSegmentLength:  # suppress short segments
+                mask_data[index - segmentLength: index] = False
+            else:
+                segmentList.append((index - segmentLength, segmentLength))  # Save segment start and length
+            segmentLength = 0  # reset counter
+        prev_x = x
+
+    return (segmentList, mask_data, smooth_data)
+
+## @brief plateProfiles(seed, size) are the row and column averages of a synthetic plate, computed as ImageSegmenter.detectGrid does.
+def plateProfiles(seed, size=(640, 480)):
+    rng = np.random.default_rng(seed)
+    image, truth = renderPlate(size, seed, pitch=rng.uniform(0.15, 0.5), lineWidth=rng.uniform(0.01, 0.04),
+                               noise=rng.uniform(1, 12), vignetting=rng.uniform(0, 0.6),
+                               offset=(int(rng.integers(-40, 40)), int(rng.integers(-40, 40))))
+    row_av = cv2.reduce(image, 0, cv2.REDUCE_AVG, dtype=cv2.CV_32S).flatten('F')
+    col_av = cv2.reduce(image, 1, cv2.REDUCE_AVG, dtype=cv2.CV_32S).flatten('F')
+    return row_av, col_av
+
+## @brief assertMatchesReference(data, N) compares find1DGrid with the reference on one profile.
+## @return the segment list.
+def assertMatchesReference(data, N):
+    segments, mask, smooth = find1DGrid(data.copy(), N)
+    expectedSegments, expectedMask, expectedSmooth = referenceFind1DGrid(data.copy(), N)
+    assert segments == expectedSegments
+    np.testing.assert_array_equal(mask, expectedMask)
+    np.testing.assert_allclose(smooth, expectedSmooth)
+    return segments
+
+@pytest.mark.parametrize('seed', range(200))
+def test_plate_matches_reference(seed):
+    rng = np.random.default_rng(seed)
+    size = [(640, 480), (1280, 720), (1920, 1080)][seed % 3]
+    for data in plateProfiles(seed, size):
+        ## The segmenter default sizeFrac 0.005, and coarser kernels
+        for N in (int(0.005 * data.size), int(rng.integers(2, 12))):
+            assertMatchesReference(data, N)
+
+def test_random_mask_matches_reference():
+    ## Uncorrelated samples give many short runs, which exercises the suppression
+    rng = np.random.default_rng(1)
+    for i in range(50):
+        assertMatchesReference(rng.normal(0, 1, 640), 3)
+
+@pytest.mark.parametrize('seed', range(20))
+def test_stack_matches_rows(seed):
+    rng = np.random.default_rng(1000 + seed)
+    N = int(rng.integers(2, 8))
+    stack = np.stack([plateProfiles(1000 + seed * 16 + i)[0] for i in range(int(rng.integers(1, 12)))])
+    segments, mask, smooth = find1DGrid(stack.copy(), N)
+    assert len(segments) == stack.shape[0]
+    for row in range(stack.shape[0]):
+        rowSegments, rowMask, rowSmooth = find1DGrid(stack[row].copy(), N)
+        expectedSegments, expectedMask, expectedSmooth = referenceFind1DGrid(stack[row].copy(), N)
+        assert segments[row] == rowSegments == expectedSegments
+        np.testing.assert_array_equal(mask[row], rowMask)
+        np.testing.assert_array_equal(mask[row], expectedMask)
+        np.testing.assert_allclose(smooth[row], expectedSmooth)